@@ -0,0 +1,260 @@
+"""
+Analysis Job Queue
+Persists imagery analysis jobs in MongoDB and runs them with leased workers
+"""
+import os
+import asyncio
+import logging
+import socket
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+
+
+class AnalysisJobQueue:
+    """
+    Mongo-backed queue around ImageryService.process_field_imagery
+
+    Workers claim jobs by taking a lease (lease_owner / lease_expires_at) and
+    renew it while the analysis runs. A job whose lease has expired, e.g.
+    because the server restarted mid-analysis, is picked up again by the
+    next free worker instead of being dropped.
+
+    `on_success(field_id, result)` runs before a successful job is marked
+    completed, so it can store derived values (and add them to the result).
+
+    Finished jobs carry their result document, so they are kept for
+    ANALYSIS_JOB_RETENTION_SECONDS after `finished_at` and then removed by
+    a TTL index.
+    """
+
+    def __init__(self, collection, imagery_service,
+                 on_success: Optional[Callable[[str, Dict], Awaitable[None]]] = None):
+        self.collection = collection
+        self.imagery_service = imagery_service
+        self.on_success = on_success
+        self.worker_count = int(os.environ.get('ANALYSIS_WORKERS', str(imagery_service.max_workers)))
+        self.lease_seconds = int(os.environ.get('ANALYSIS_JOB_LEASE_SECONDS', '120'))
+        self.max_attempts = int(os.environ.get('ANALYSIS_JOB_MAX_ATTEMPTS', '3'))
+        self.poll_interval = float(os.environ.get('ANALYSIS_JOB_POLL_SECONDS', '5'))
+        self.retention_seconds = int(os.environ.get('ANALYSIS_JOB_RETENTION_SECONDS', str(7 * 24 * 3600)))
+        self.heartbeat_interval = min(
+            float(os.environ.get('ANALYSIS_JOB_HEARTBEAT_SECONDS', '2')),
+            self.lease_seconds / 3
+        )
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+
+    async def create_indexes(self):
+        await self.collection.create_index('id', unique=True)
+        await self.collection.create_index([('status', 1), ('created_at', 1)])
+        await self.collection.create_index([('field_id', 1), ('status', 1)])
+        # Unfinished jobs have finished_at None, which the TTL monitor ignores
+        try:
+            await self.collection.create_index('finished_at', expireAfterSeconds=self.retention_seconds)
+        except OperationFailure:
+            # The retention period changed since the index was created
+            await self.collection.database.command(
+                'collMod', self.collection.name,
+                index={'keyPattern': {'finished_at': 1}, 'expireAfterSeconds': self.retention_seconds}
+            )
+
+    async def enqueue(self, field: Dict, user_id: str, indices: List[str],
+                      colormap: Optional[str] = None) -> Dict:
+        """
+        Queue an analysis of the given indices for a field, reusing an
+        unfinished job for the same field, imagery, indices and colormap
+        instead of queueing a duplicate
+        """
+        existing = await self.collection.find_one({
+            'field_id': field['id'],
+            'imagery_url': field['imagery_url'],
+            'indices': indices,
+            'colormap': colormap,
+            'status': {'$in': [JOB_QUEUED, JOB_RUNNING]}
+        }, {'_id': 0})
+        if existing:
+            return existing
+
+        now = datetime.now(timezone.utc)
+        job = {
+            'id': str(uuid.uuid4()),
+            'field_id': field['id'],
+            'user_id': user_id,
+            'imagery_url': field['imagery_url'],
+            'coordinates': field['coordinates'],
+            'indices': indices,
+            'colormap': colormap,
+            'status': JOB_QUEUED,
+            'progress': 0,
+            'stage': JOB_QUEUED,
+            'result': None,
+            'error': None,
+            'attempts': 0,
+            'lease_owner': None,
+            'lease_expires_at': None,
+            'created_at': now,
+            'updated_at': now,
+            'finished_at': None
+        }
+        await self.collection.insert_one(dict(job))
+        logger.info(f"Queued analysis job {job['id']} for field {field['id']}")
+        return job
+
+    async def get_job(self, job_id: str, user_id: str) -> Optional[Dict]:
+        return await self.collection.find_one({'id': job_id, 'user_id': user_id}, {'_id': 0})
+
+    def wake(self):
+        """Signal idle workers that a new job is waiting"""
+        self._wakeup.set()
+
+    def start(self):
+        for _ in range(self.worker_count):
+            self._workers.append(asyncio.create_task(self._worker()))
+        logger.info(f"Started {self.worker_count} analysis job workers as {self.owner}")
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # Hand leases back so another instance can pick the jobs up at once
+        await self.collection.update_many(
+            {'status': JOB_RUNNING, 'lease_owner': self.owner},
+            {'$set': {'status': JOB_QUEUED, 'lease_owner': None, 'lease_expires_at': None}}
+        )
+
+    async def _claim(self) -> Optional[Dict]:
+        """Atomically lease the oldest queued job, or one whose lease expired"""
+        now = datetime.now(timezone.utc)
+        return await self.collection.find_one_and_update(
+            {
+                '$or': [
+                    {'status': JOB_QUEUED},
+                    {'status': JOB_RUNNING, 'lease_expires_at': {'$lt': now}}
+                ]
+            },
+            {
+                '$set': {
+                    'status': JOB_RUNNING,
+                    'lease_owner': self.owner,
+                    'lease_expires_at': now + timedelta(seconds=self.lease_seconds),
+                    'updated_at': now
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('created_at', 1)],
+            projection={'_id': 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error claiming analysis job: {str(e)}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # E.g. Mongo unavailable while finishing: keep the worker alive,
+                # the job's lease expires and it is claimed again
+                logger.error(f"Error running analysis job {job['id']}: {str(e)}")
+
+    async def _run(self, job: Dict):
+        job_id = job['id']
+        if job['attempts'] > self.max_attempts:
+            await self._finish(job_id, JOB_FAILED, error=f"Gave up after {self.max_attempts} attempts")
+            return
+
+        state = {'progress': 0, 'stage': 'starting'}
+
+        def on_progress(progress: int, stage: str):
+            # Called from the imagery executor thread; the heartbeat persists it
+            state['progress'] = progress
+            state['stage'] = stage
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, state))
+        try:
+            result = await self.imagery_service.process_field_imagery(
+                job['field_id'], job['imagery_url'], job.get('coordinates'), job.get('indices'),
+                job.get('colormap'), progress=on_progress
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Analysis job {job_id} failed: {str(e)}")
+            await self._finish(job_id, JOB_FAILED, error=str(e))
+            return
+        finally:
+            heartbeat.cancel()
+
+        if result.get('status') == 'success':
+            if self.on_success is not None:
+                try:
+                    await self.on_success(job['field_id'], result)
+                except Exception as e:
+                    logger.error(f"Error storing results of analysis job {job_id}: {str(e)}")
+            await self._finish(job_id, JOB_COMPLETED, result=result)
+        else:
+            await self._finish(job_id, JOB_FAILED, error=result.get('message'), result=result)
+
+    async def _heartbeat(self, job_id: str, state: Dict):
+        """Renew the lease and publish progress while the job runs"""
+        while True:
+            now = datetime.now(timezone.utc)
+            try:
+                await self.collection.update_one(
+                    {'id': job_id, 'lease_owner': self.owner},
+                    {'$set': {
+                        'progress': state['progress'],
+                        'stage': state['stage'],
+                        'lease_expires_at': now + timedelta(seconds=self.lease_seconds),
+                        'updated_at': now
+                    }}
+                )
+            except Exception as e:
+                logger.error(f"Error renewing lease for analysis job {job_id}: {str(e)}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _finish(self, job_id: str, status: str, result: Optional[Dict] = None, error: Optional[str] = None):
+        now = datetime.now(timezone.utc)
+        update = {
+            'status': status,
+            'stage': status,
+            'result': result,
+            'error': error,
+            'lease_owner': None,
+            'lease_expires_at': None,
+            'updated_at': now,
+            'finished_at': now
+        }
+        if status == JOB_COMPLETED:
+            update['progress'] = 100
+        await self.collection.update_one({'id': job_id, 'lease_owner': self.owner}, {'$set': update})
+        logger.info(f"Analysis job {job_id} {status}")
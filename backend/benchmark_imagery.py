@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Imagery Pipeline Benchmarks
+Compares the index engine and overlay rendering against the original
+per-index NumPy expressions and float colorizing
+
+Usage: python benchmark_imagery.py [--size 4000] [--repeat 3] [--threads 1 2 4 8 16]
+"""
+import argparse
+import io
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+import colormaps
+import index_engine
+import overlay_encoding
+from imagery_streaming import downsample
+
+
+def legacy_indices(blue, green, red, nir):
+    """calculate_indices as originally written, kept as the baseline"""
+    epsilon = 1e-10
+    return {
+        'ndvi': (nir - red) / (nir + red + epsilon),
+        'ndwi': (green - nir) / (green + nir + epsilon),
+        'evi': 2.5 * ((nir - red) / (nir + 6*red - 7.5*blue + 1 + epsilon)),
+        'savi': ((nir - red) / (nir + red + 0.5 + epsilon)) * 1.5,
+        'ndre': (nir - red) / (nir + red + epsilon),
+        'gndvi': (nir - green) / (nir + green + epsilon)
+    }
+
+
+def make_bands(size: int, dtype) -> list:
+    rng = np.random.default_rng(42)
+    return [rng.integers(1, 4000, (size, size)).astype(dtype) for _ in range(4)]
+
+
+def measure(name: str, func, args, repeat: int, baseline: Optional[float] = None) -> float:
+    """
+    Print the best wall time and traced peak allocation of func(*args), and
+    the speedup over a baseline time if given; returns the time
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    speedup = f"  {baseline / min(times):5.2f}x" if baseline else ''
+    print(f"  {name:<36} {min(times) * 1000:9.1f} ms  {peak / 1024 ** 2:9.1f} MiB peak{speedup}")
+    return min(times)
+
+
+def benchmark_indices(size: int, repeat: int):
+    print(f"Index computation, {size}x{size} pixels")
+    builtin = ('ndvi', 'ndwi', 'evi', 'savi', 'ndre', 'gndvi')
+    engines = [('numpy', False)] + ([('numexpr', True)] if index_engine.numexpr is not None else [])
+    for dtype in ('float64', 'float32'):
+        bands = make_bands(size, dtype)
+        measure(f"legacy ({dtype})", legacy_indices, bands, repeat)
+        for engine, use_numexpr in engines:
+            for label, names in (('', builtin), (', ndvi', ('ndvi',))):
+                measure(f"fused {engine}{label} ({dtype})",
+                        lambda *args: index_engine.compute_indices(*args, use_numexpr=use_numexpr),
+                        bands + [names], repeat)
+
+
+def legacy_colorize(index_array):
+    """create_colored_overlay's original float red-green colorizing, the baseline"""
+    outside = np.isnan(index_array)
+    normalized = np.clip(np.nan_to_num((index_array + 1) / 2), 0, 1)
+    rgb_image = np.zeros(index_array.shape + (4,), dtype=np.uint8)
+    rgb_image[:, :, 0] = ((1 - normalized) * 255).astype(np.uint8)
+    rgb_image[:, :, 1] = (normalized * 255).astype(np.uint8)
+    rgb_image[:, :, 2] = 0
+    rgb_image[:, :, 3] = 180
+    rgb_image[outside, 3] = 0
+    return rgb_image
+
+
+def benchmark_colorize(size: int, repeat: int):
+    print(f"Overlay colorizing, {size}x{size} pixels, float32")
+    rng = np.random.default_rng(42)
+    values = rng.uniform(-1, 1, (size, size)).astype(np.float32)
+    values[:size // 10] = np.nan
+    measure('legacy float channels', legacy_colorize, [values], repeat)
+    for name in colormaps.COLORMAPS:
+        measure(f"LUT {name}", colormaps.colorize, [values, name], repeat)
+
+
+def benchmark_overlay(size: int, repeat: int, max_dimension: int = 1024):
+    """Full resolution colorizing then LANCZOS, against reducing the index array first"""
+    print(f"Overlay from {size}x{size} pixels to {max_dimension}x{max_dimension}, float32")
+    rng = np.random.default_rng(42)
+    values = rng.uniform(-1, 1, (size, size)).astype(np.float32)
+    values[:size // 10] = np.nan
+
+    def colorize_then_resize(values):
+        img = Image.fromarray(colormaps.colorize(values), mode='RGBA')
+        return img.resize((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+    def downsample_then_colorize(values):
+        return Image.fromarray(colormaps.colorize(downsample(values, (max_dimension, max_dimension))), mode='RGBA')
+
+    measure('colorize, then resize', colorize_then_resize, [values], repeat)
+    measure('downsample, then colorize', downsample_then_colorize, [values], repeat)
+
+
+def benchmark_encoding(repeat: int, size: int = 1024):
+    """Encode time and size of an overlay in each format, against the original optimized RGBA PNG"""
+    print(f"Overlay encoding, {size}x{size} pixels")
+    rows, cols = np.mgrid[0:size, 0:size] / size
+    values = (np.sin(rows * 7) * np.cos(cols * 5)).astype(np.float32)
+    values[:, :size // 8] = np.nan
+    lut = colormaps.get_lut(colormaps.DEFAULT_COLORMAP)
+    img = overlay_encoding.palette_image(colormaps.quantize(values), lut)
+    rgba = Image.fromarray(colormaps.colorize(values), mode='RGBA')
+
+    def legacy_png(rgba):
+        buffer = io.BytesIO()
+        rgba.save(buffer, format='PNG', optimize=True)
+        return buffer.getvalue()
+
+    cases = [('legacy RGBA PNG, optimize', legacy_png, [rgba])]
+    cases += [(f"png, level {level}", overlay_encoding.encode, [img, 'png', level]) for level in (1, 6, 9)]
+    cases += [(name, overlay_encoding.encode, [img, name]) for name in ('png32', 'webp', 'webp-lossy')]
+    for name, func, args in cases:
+        measure(f"{name} ({len(func(*args)) // 1024} KiB)", func, args, repeat)
+
+
+def benchmark_rendering(size: int, repeat: int, thread_counts: list, max_dimension: int = 1024):
+    """The overlay stage for the six built-in indices, one after another and in a thread pool"""
+    print(f"Overlay rendering, 6 indices, {size}x{size} to {max_dimension}x{max_dimension} palette PNG")
+    names = ('ndvi', 'ndwi', 'evi', 'savi', 'ndre', 'gndvi')
+    indices = index_engine.compute_indices(*make_bands(size, 'float32'), names)
+    lut = colormaps.get_lut(colormaps.DEFAULT_COLORMAP)
+
+    def render(values):
+        quantized = colormaps.quantize(downsample(values, (max_dimension, max_dimension)))
+        return overlay_encoding.encode(overlay_encoding.palette_image(quantized, lut), 'png')
+
+    slowest = max(min(measure_once(render, values) for _ in range(repeat)) for values in indices.values())
+    print(f"  {'slowest single overlay':<36} {slowest * 1000:9.1f} ms")
+    for threads in thread_counts:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            measure(f"{threads} threads", lambda: list(pool.map(render, indices.values())), [], repeat)
+
+
+def measure_once(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def set_strip_threads(threads: int):
+    if index_engine._executor is not None:
+        index_engine._executor.shutdown()
+        index_engine._executor = None
+    index_engine.STRIP_THREADS = threads
+
+
+def benchmark_strips(size: int, repeat: int, thread_counts: list):
+    """
+    Scaling of the strip-parallel NumPy kernel with the number of threads,
+    through compute_indices' default engine. Thread counts above the
+    usable CPUs can't scale, so those are reported too.
+    """
+    print(f"Strip-parallel NumPy kernel, {size}x{size} pixels, float32, "
+          f"{index_engine.usable_cpus()} usable CPUs, engine {index_engine.ENGINE}")
+    bands = make_bands(size, 'float32')
+    names = ('ndvi', 'ndwi', 'evi', 'savi', 'ndre', 'gndvi')
+    baseline = None
+    for threads in thread_counts:
+        set_strip_threads(threads)
+        elapsed = measure(f"{threads} threads", index_engine.compute_indices, bands + [names], repeat, baseline)
+        baseline = baseline or elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=4000, help='raster side length in pixels')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case (best is reported)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help='strip thread counts to compare')
+    args = parser.parse_args()
+
+    benchmark_indices(args.size, args.repeat)
+    benchmark_colorize(args.size, args.repeat)
+    benchmark_overlay(args.size, args.repeat)
+    benchmark_encoding(args.repeat)
+    benchmark_rendering(args.size, args.repeat, args.threads)
+    benchmark_strips(args.size, args.repeat, args.threads)
+
+
+if __name__ == '__main__':
+    main()
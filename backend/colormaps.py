@@ -0,0 +1,109 @@
+"""
+Overlay Colormaps
+Index values are quantized to uint8 once and colored with a single lookup
+into a 256x4 RGBA table, instead of float math per output channel
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Opacity of pixels inside the field, so the basemap shows through
+OVERLAY_ALPHA = 180
+
+# The last LUT entry is reserved for pixels outside the field (NaN), so
+# values are quantized onto the first 255 entries
+NODATA_INDEX = 255
+LEVELS = NODATA_INDEX
+
+DEFAULT_COLORMAP = 'red-yellow-green'
+
+# Evenly spaced color stops from the low to the high end of the range
+COLORMAPS: Dict[str, Dict] = {
+    'red-yellow-green': {
+        'description': 'Red (low) through yellow to green (high), for vegetation indices',
+        'colors': ['#d73027', '#fc8d59', '#fee08b', '#d9ef8b', '#91cf60', '#1a9850']
+    },
+    'viridis': {
+        'description': 'Perceptually uniform and colorblind safe, purple (low) to yellow (high)',
+        'colors': ['#440154', '#482475', '#414487', '#355f8d', '#2a788e', '#21918c',
+                   '#22a884', '#44bf70', '#7ad151', '#bddf26', '#fde725']
+    },
+    'brown-white-blue': {
+        'description': 'Diverging, brown (dry) through white to blue (wet), for water indices',
+        'colors': ['#8c510a', '#d8b365', '#f5f5f5', '#67a9cf', '#2166ac']
+    }
+}
+
+# name -> (256x4 uint8 table, the same table as 256 packed uint32 pixels)
+_luts: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+
+def _rgb(color: str) -> Tuple[int, int, int]:
+    color = color.lstrip('#')
+    return tuple(int(color[position:position + 2], 16) for position in (0, 2, 4))
+
+
+def build_lut(colors: List[str], alpha: int = OVERLAY_ALPHA) -> np.ndarray:
+    """256x4 uint8 RGBA table interpolating the color stops linearly"""
+    stops = np.array([_rgb(color) for color in colors], np.float64)
+    positions = np.linspace(0, 1, len(stops))
+    levels = np.linspace(0, 1, LEVELS)
+    lut = np.zeros((256, 4), np.uint8)
+    for channel in range(3):
+        lut[:LEVELS, channel] = np.round(np.interp(levels, positions, stops[:, channel]))
+    lut[:LEVELS, 3] = alpha
+    # lut[NODATA_INDEX] stays fully transparent
+    return lut
+
+
+def get_lut(name: str) -> np.ndarray:
+    """
+    Lookup table of a named colormap, built on first use
+
+    Raises:
+        ValueError: for unknown colormaps
+    """
+    return _get(name)[0]
+
+
+def _get(name: str) -> Tuple[np.ndarray, np.ndarray]:
+    luts = _luts.get(name)
+    if luts is None:
+        if name not in COLORMAPS:
+            raise ValueError(f"Unknown colormap '{name}'. Available: {', '.join(COLORMAPS)}")
+        lut = build_lut(COLORMAPS[name]['colors'])
+        luts = _luts[name] = (lut, lut.view(np.uint32).ravel())
+    return luts
+
+
+def definitions() -> List[Dict]:
+    """Name, description and color stops of every colormap, for legends"""
+    return [{'name': name, **colormap} for name, colormap in COLORMAPS.items()]
+
+
+def quantize(values: np.ndarray, value_range: Tuple[float, float] = (-1.0, 1.0)) -> np.ndarray:
+    """
+    Map values onto LUT positions 0-254, clipping to the range; NaN (outside
+    the field) maps to NODATA_INDEX
+    """
+    low, high = value_range
+    scaled = np.subtract(values, low, dtype=np.float32)
+    scaled *= (LEVELS - 1) / (high - low)
+    # Round half up; clipping after the shift keeps infinities in range
+    scaled += 0.5
+    np.clip(scaled, 0, LEVELS - 0.5, out=scaled)
+    # fmin replaces NaN with the bound and leaves the clipped values alone,
+    # without the mask nan_to_num would allocate
+    np.fmin(scaled, NODATA_INDEX + 0.5, out=scaled)
+    return scaled.astype(np.uint8)
+
+
+def colorize(values: np.ndarray, name: str = DEFAULT_COLORMAP,
+             value_range: Tuple[float, float] = (-1.0, 1.0)) -> np.ndarray:
+    """
+    HxWx4 uint8 RGBA image of an index array, in one LUT lookup. Gathering
+    whole pixels as uint32 is several times faster than indexing the rows
+    of the 256x4 table, and writes the output buffer in one pass.
+    """
+    packed = _get(name)[1][quantize(values, value_range)]
+    return packed.view(np.uint8).reshape(*values.shape, 4)
@@ -0,0 +1,542 @@
+"""
+Imagery File Cache
+Content-addressed on-disk cache for downloaded GeoTIFF scenes
+"""
+import os
+import json
+import shutil
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+from filelock import FileLock
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_source(drive_url: str) -> str:
+    """
+    Stable cache key for an imagery URL. Google Drive sharing links, open
+    links and direct download links for the same file all map to its file id.
+    """
+    parsed = urlparse(drive_url)
+    if 'drive.google.com' in parsed.netloc or 'docs.google.com' in parsed.netloc:
+        if '/file/d/' in parsed.path:
+            return 'gdrive:' + parsed.path.split('/file/d/')[1].split('/')[0]
+        file_ids = parse_qs(parsed.query).get('id')
+        if file_ids:
+            return 'gdrive:' + file_ids[0]
+    return drive_url.strip()
+
+
+class CacheWriter:
+    """
+    Streams a download into a temporary file inside the cache directory,
+    hashing it on the way. Nothing is visible to readers until commit()
+    renames the finished file into place.
+    """
+
+    def __init__(self, cache: 'ImageryFileCache', source_key: str):
+        self.cache = cache
+        self.source_key = source_key
+        self.temp_path = os.path.join(cache.cache_dir, f".{uuid.uuid4().hex}.part")
+        self._file = open(self.temp_path, 'wb')
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self, etag: Optional[str] = None, last_modified: Optional[str] = None) -> str:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        return self.cache._commit(self.source_key, self.temp_path, self._sha256.hexdigest(),
+                                  self.size, etag, last_modified)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.temp_path):
+            os.unlink(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+
+
+class PartialDownload:
+    """
+    A resumable download kept in the cache's partial directory. Byte ranges
+    are written in place at their offsets and progress is recorded in a
+    sidecar state file, so an interrupted download continues where it
+    stopped as long as the server still reports the same validators.
+    """
+
+    def __init__(self, cache: 'ImageryFileCache', source_key: str):
+        self.cache = cache
+        self.source_key = source_key
+        name = hashlib.sha256(source_key.encode()).hexdigest()
+        self.data_path = os.path.join(cache.partial_dir, f"{name}.part")
+        self.state_path = os.path.join(cache.partial_dir, f"{name}.json")
+        self.state: Optional[Dict] = None
+        self._fd: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def open(self, size: int, etag: Optional[str], last_modified: Optional[str], segments: int) -> Dict:
+        """
+        Resume the partial download if it matches the server's current
+        version, otherwise start a new one split into `segments` ranges
+        """
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+
+        if (state and os.path.exists(self.data_path) and state['size'] == size
+                and state['etag'] == etag and state['last_modified'] == last_modified):
+            done = sum(segment['written'] for segment in state['segments'])
+            logger.info(f"Resuming download of {self.source_key} at {done}/{size} bytes")
+        else:
+            step = -(-size // segments)
+            state = {
+                'size': size,
+                'etag': etag,
+                'last_modified': last_modified,
+                'segments': [{'start': start, 'end': min(start + step, size) - 1, 'written': 0}
+                             for start in range(0, size, step)]
+            }
+            with open(self.data_path, 'wb') as f:
+                f.truncate(size)
+        self.state = state
+        self._fd = os.open(self.data_path, os.O_WRONLY)
+        self.save_state()
+        return state
+
+    def write(self, segment: Dict, chunk: bytes):
+        os.pwrite(self._fd, chunk, segment['start'] + segment['written'])
+        segment['written'] += len(chunk)
+
+    def save_state(self):
+        with self._lock:
+            temp_path = self.state_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(temp_path, self.state_path)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def discard(self):
+        self.close()
+        for path in (self.data_path, self.state_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def commit(self) -> str:
+        """Hash the finished file and move it into the cache"""
+        os.fsync(self._fd)
+        self.close()
+        sha256 = hashlib.sha256()
+        with open(self.data_path, 'rb') as f:
+            for block in iter(lambda: f.read(8 * 1024 ** 2), b''):
+                sha256.update(block)
+        path = self.cache._commit(self.source_key, self.data_path, sha256.hexdigest(),
+                                  self.state['size'], self.state['etag'], self.state['last_modified'])
+        os.unlink(self.state_path)
+        return path
+
+
+class ImageryFileCache:
+    """
+    LRU cache of downloaded scenes bounded by a byte budget
+
+    Files are stored under their sha256 so identical content is kept once.
+    The index maps each normalized source to the file it last resolved to,
+    together with the ETag / Last-Modified validators the server sent.
+    Within `revalidate_seconds` of the last check a cached scene is served
+    without any network I/O; after that it is revalidated with a
+    conditional request. Files derived from a scene (see pyramid_dir) count
+    towards its size and are evicted with it.
+    """
+
+    INDEX_NAME = 'index.json'
+    # last_access only orders evictions, so a hit rewrites it only once it
+    # is this stale; other hits read the index without the cross-process lock
+    ACCESS_RESOLUTION_SECONDS = 60
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None,
+                 revalidate_seconds: Optional[int] = None):
+        self.cache_dir = cache_dir or os.environ.get(
+            'IMAGERY_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'maplink-imagery'))
+        self.max_bytes = max_bytes if max_bytes is not None else int(
+            os.environ.get('IMAGERY_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))
+        self.revalidate_seconds = revalidate_seconds if revalidate_seconds is not None else int(
+            os.environ.get('IMAGERY_CACHE_REVALIDATE_SECONDS', '86400'))
+        self.partial_dir = os.path.join(self.cache_dir, 'partial')
+        os.makedirs(self.partial_dir, exist_ok=True)
+        # Serializes index updates between threads and between worker processes
+        self._lock = threading.RLock()
+        self._index_lock = FileLock(self._index_path() + '.lock')
+        # (mtime, size, inode) of the index file as last loaded or saved
+        self._index_signature: Optional[Tuple] = None
+        with self._index_lock:
+            self._index = self._load_index()
+
+    def _index_path(self) -> str:
+        return os.path.join(self.cache_dir, self.INDEX_NAME)
+
+    def _file_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, f"{digest}.tif")
+
+    def pyramid_dir(self, digest: str) -> str:
+        """Directory for rasters derived from a scene, evicted along with it"""
+        return os.path.join(self.cache_dir, 'pyramids', digest)
+
+    def _index_file_signature(self) -> Optional[Tuple]:
+        try:
+            stat = os.stat(self._index_path())
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load_index(self, check_files: bool = True) -> Dict:
+        self._index_signature = self._index_file_signature()
+        try:
+            with open(self._index_path()) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault('sources', {})
+        index.setdefault('files', {})
+        if check_files:
+            # Drop entries whose files were removed behind our back
+            index['files'] = {digest: entry for digest, entry in index['files'].items()
+                              if os.path.exists(self._file_path(digest))}
+        index['sources'] = {key: entry for key, entry in index['sources'].items()
+                            if entry['digest'] in index['files']}
+        return index
+
+    def _save_index(self):
+        temp_path = self._index_path() + f".{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(temp_path, self._index_path())
+        self._index_signature = self._index_file_signature()
+
+    def _refresh_index(self):
+        """
+        Reload the index if another process replaced it since we last read
+        or wrote it. Needs no file lock: the index is replaced atomically.
+        """
+        if self._index_file_signature() != self._index_signature:
+            self._index = self._load_index(check_files=False)
+
+    def lookup(self, source_key: str) -> Optional[Dict]:
+        """
+        Return the cache entry for a source, or None on a miss. The entry
+        carries 'path', 'digest', 'etag', 'last_modified' and 'fresh'.
+        """
+        with self._lock:
+            # Other worker processes may share the directory; the disk index wins
+            self._refresh_index()
+            source = self._index['sources'].get(source_key)
+            if not source:
+                return None
+            source = dict(source)
+            last_access = self._index['files'].get(source['digest'], {}).get('last_access', 0)
+        path = self._file_path(source['digest'])
+        if not os.path.exists(path):
+            with self._lock, self._index_lock:
+                # Loading drops the missing file and its sources
+                self._index = self._load_index()
+                self._save_index()
+            return None
+        now = time.time()
+        if now - last_access > self.ACCESS_RESOLUTION_SECONDS:
+            self._touch(source['digest'], now)
+        fresh = now - source['validated_at'] < self.revalidate_seconds
+        return dict(source, path=path, fresh=fresh)
+
+    def _touch(self, digest: str, now: float):
+        """Record an access for LRU eviction"""
+        with self._lock, self._index_lock:
+            self._index = self._load_index()
+            entry = self._index['files'].get(digest)
+            if entry:
+                entry['last_access'] = now
+                self._save_index()
+
+    def mark_validated(self, source_key: str):
+        """Record that the server confirmed the cached copy is current (304)"""
+        with self._lock, self._index_lock:
+            self._index = self._load_index()
+            source = self._index['sources'].get(source_key)
+            if source:
+                source['validated_at'] = time.time()
+                self._save_index()
+
+    def update_derived_size(self, digest: str):
+        """
+        Count the files in a scene's pyramid_dir towards its size, so they
+        share the cache budget, and evict if that puts the cache over it.
+        Derived files of a scene evicted meanwhile are removed.
+        """
+        directory = self.pyramid_dir(digest)
+        derived = 0
+        for root, _, names in os.walk(directory):
+            for name in names:
+                try:
+                    derived += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        with self._lock, self._index_lock:
+            self._index = self._load_index()
+            entry = self._index['files'].get(digest)
+            if entry is None:
+                shutil.rmtree(directory, ignore_errors=True)
+                return
+            entry['derived'] = derived
+            self._evict(keep=digest)
+            self._save_index()
+
+    def writer(self, source_key: str) -> CacheWriter:
+        return CacheWriter(self, source_key)
+
+    def partial(self, source_key: str) -> PartialDownload:
+        return PartialDownload(self, source_key)
+
+    @staticmethod
+    def digest_of(path: str) -> str:
+        """Content hash of a cached file, taken from its name"""
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def _commit(self, source_key: str, temp_path: str, digest: str, size: int,
+                etag: Optional[str], last_modified: Optional[str]) -> str:
+        path = self._file_path(digest)
+        with self._lock, self._index_lock:
+            # Atomic within the cache directory, so a partial file is never served
+            os.replace(temp_path, path)
+            self._index = self._load_index()
+            now = time.time()
+            self._index['files'][digest] = {'size': size, 'last_access': now}
+            self._index['sources'][source_key] = {
+                'digest': digest,
+                'etag': etag,
+                'last_modified': last_modified,
+                'validated_at': now
+            }
+            self._evict(keep=digest)
+            self._save_index()
+        logger.info(f"Cached imagery {source_key} as {digest} ({size} bytes)")
+        return path
+
+    def _evict(self, keep: Optional[str] = None):
+        """Remove least recently used files until the cache fits its budget"""
+        files = self._index['files']
+        total = sum(entry['size'] + entry.get('derived', 0) for entry in files.values())
+        for digest, entry in sorted(files.items(), key=lambda item: item[1]['last_access']):
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            try:
+                os.unlink(self._file_path(digest))
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(self.pyramid_dir(digest), ignore_errors=True)
+            total -= entry['size'] + entry.get('derived', 0)
+            del files[digest]
+            for key in [key for key, source in self._index['sources'].items() if source['digest'] == digest]:
+                del self._index['sources'][key]
+            logger.info(f"Evicted cached imagery {digest}")
+
+
+def coordinates_hash(coordinates: Optional[List[Dict]]) -> str:
+    """Stable hash of a field boundary as stored in Mongo"""
+    points = [(round(float(c['lat']), 9), round(float(c['lng']), 9)) for c in coordinates or []]
+    return hashlib.sha256(json.dumps(points).encode()).hexdigest()[:16]
+
+
+class AnalysisResultCache:
+    """
+    In-memory LRU cache of analysis results with a TTL and a byte budget
+
+    Keys are (field_id, imagery content hash, coordinates hash, index), so a
+    new scene or boundary can never be served a stale result; invalidate_field
+    just releases the memory early when a field is edited.
+
+    With a `shared_dir`, results are also written there so other worker
+    processes on the host can pick them up instead of recomputing. The shared
+    directory is bounded by `shared_max_bytes` as well as the TTL; it is pruned
+    every PRUNE_INTERVAL_SECONDS, or sooner once a tenth of the budget has been
+    written since the last pass.
+    """
+
+    PRUNE_INTERVAL_SECONDS = 60
+
+    def __init__(self, ttl_seconds: Optional[int] = None, max_bytes: Optional[int] = None,
+                 shared_dir: Optional[str] = None, shared_max_bytes: Optional[int] = None):
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else int(
+            os.environ.get('ANALYSIS_CACHE_TTL_SECONDS', '3600'))
+        self.max_bytes = max_bytes if max_bytes is not None else int(
+            os.environ.get('ANALYSIS_CACHE_MAX_BYTES', str(256 * 1024 ** 2)))
+        self.shared_max_bytes = shared_max_bytes if shared_max_bytes is not None else int(
+            os.environ.get('ANALYSIS_CACHE_SHARED_MAX_BYTES', str(1024 ** 3)))
+        self.shared_dir = shared_dir
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+        self._entries: 'OrderedDict[Tuple, Dict]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self._last_prune = 0.0
+        self._written_since_prune = 0
+
+    # Shared file suffix and (de)serialization, overridden for other payloads
+    suffix = 'json'
+
+    def _encode(self, result) -> bytes:
+        return json.dumps(result, default=str).encode()
+
+    def _decode(self, serialized: bytes):
+        return json.loads(serialized)
+
+    def _shared_path(self, key: Tuple) -> str:
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()[:32]
+        return os.path.join(self.shared_dir, f"{key[0]}-{digest}.{self.suffix}")
+
+    def get(self, key: Tuple) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if time.time() - entry['stored_at'] <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    return entry['result']
+                self._remove(key)
+        return self._load_shared(key)
+
+    def _load_shared(self, key: Tuple) -> Optional[Dict]:
+        if not self.shared_dir:
+            return None
+        path = self._shared_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if time.time() - stored_at > self.ttl_seconds:
+                return None
+            with open(path, 'rb') as f:
+                serialized = f.read()
+        except OSError:
+            return None
+        result = self._decode(serialized)
+        self._put_memory(key, result, len(serialized), stored_at)
+        return result
+
+    def put(self, key: Tuple, result: Dict):
+        serialized = self._encode(result)
+        self._put_memory(key, result, len(serialized), time.time())
+        if self.shared_dir:
+            path = self._shared_path(key)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(serialized)
+            os.replace(temp_path, path)
+            with self._lock:
+                self._written_since_prune += len(serialized)
+                due = (time.time() - self._last_prune >= self.PRUNE_INTERVAL_SECONDS
+                       or self._written_since_prune * 10 >= self.shared_max_bytes)
+                if due:
+                    self._last_prune = time.time()
+                    self._written_since_prune = 0
+            if due:
+                self._prune_shared()
+
+    def _put_memory(self, key: Tuple, result: Dict, size: int, stored_at: float):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {'result': result, 'size': size, 'stored_at': stored_at}
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _prune_shared(self):
+        """Drop shared results past their TTL, then the oldest until under shared_max_bytes"""
+        now = time.time()
+        live = []
+        with os.scandir(self.shared_dir) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                    if now - stat.st_mtime > self.ttl_seconds:
+                        os.unlink(entry.path)
+                    else:
+                        live.append((stat.st_mtime, stat.st_size, entry.path))
+                except OSError:
+                    pass
+        total = sum(size for _, size, _ in live)
+        for _, size, path in sorted(live):
+            if total <= self.shared_max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def invalidate_field(self, field_id: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == field_id]:
+                self._remove(key)
+        if self.shared_dir:
+            for name in os.listdir(self.shared_dir):
+                if name.startswith(f"{field_id}-"):
+                    try:
+                        os.unlink(os.path.join(self.shared_dir, name))
+                    except OSError:
+                        pass
+        logger.info(f"Invalidated cached analyses for field {field_id}")
+
+    def _remove(self, key: Tuple):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry['size']
+
+
+class OverlayCache(AnalysisResultCache):
+    """
+    Encoded overlay images (raw bytes), cached like analysis results and
+    keyed by the per-index result key plus the image format
+    """
+
+    suffix = 'img'
+
+    def __init__(self, ttl_seconds: Optional[int] = None, max_bytes: Optional[int] = None,
+                 shared_dir: Optional[str] = None, shared_max_bytes: Optional[int] = None):
+        super().__init__(
+            ttl_seconds,
+            max_bytes if max_bytes is not None else int(
+                os.environ.get('OVERLAY_CACHE_MAX_BYTES', str(256 * 1024 ** 2))),
+            shared_dir,
+            shared_max_bytes if shared_max_bytes is not None else int(
+                os.environ.get('OVERLAY_CACHE_SHARED_MAX_BYTES', str(1024 ** 3)))
+        )
+
+    def _encode(self, result: bytes) -> bytes:
+        return result
+
+    def _decode(self, serialized: bytes) -> bytes:
+        return serialized
@@ -0,0 +1,232 @@
+"""
+Imagery Downloader
+Asyncio-native streaming downloads of GeoTIFF scenes into the file cache
+"""
+import os
+import asyncio
+import logging
+from typing import Optional
+
+import httpx
+
+from imagery_cache import ImageryFileCache, normalize_source
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadTooLarge(Exception):
+    """Raised when a download exceeds the configured size cap"""
+
+
+class ResourceChanged(Exception):
+    """Raised when the remote file changes while a ranged download is running"""
+
+
+def get_download_url(drive_url: str) -> str:
+    """Convert a Google Drive sharing URL to a direct download URL if needed"""
+    if 'drive.google.com' in drive_url and '/file/d/' in drive_url:
+        file_id = drive_url.split('/file/d/')[1].split('/')[0]
+        return f"https://drive.google.com/uc?export=download&id={file_id}"
+    return drive_url
+
+
+class ImageryDownloader:
+    """
+    Downloads scenes on the event loop with a shared, keep-alive connection
+    pool, so concurrent downloads don't hold any imagery worker threads.
+    Disk writes are handed to a thread so large chunks never block the loop.
+    """
+
+    def __init__(self, file_cache: ImageryFileCache, single_flight: Optional[SingleFlight] = None):
+        self.file_cache = file_cache
+        # Concurrent requests for the same scene share one download
+        self.single_flight = single_flight or SingleFlight()
+        self.chunk_size = int(os.environ.get('IMAGERY_DOWNLOAD_CHUNK_BYTES', str(4 * 1024 ** 2)))
+        self.timeout_seconds = float(os.environ.get('IMAGERY_DOWNLOAD_TIMEOUT_SECONDS', '600'))
+        self.max_bytes = int(os.environ.get('IMAGERY_DOWNLOAD_MAX_BYTES', str(2 * 1024 ** 3)))
+        self.max_connections = int(os.environ.get('IMAGERY_DOWNLOAD_MAX_CONNECTIONS', '16'))
+        # Scenes served with Range support are fetched as parallel segments
+        self.segments = int(os.environ.get('IMAGERY_DOWNLOAD_SEGMENTS', '4'))
+        self.min_segment_bytes = int(os.environ.get('IMAGERY_DOWNLOAD_MIN_SEGMENT_BYTES', str(16 * 1024 ** 2)))
+        self.retries = int(os.environ.get('IMAGERY_DOWNLOAD_RETRIES', '3'))
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=httpx.Timeout(60.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                )
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def download(self, drive_url: str) -> str:
+        """
+        Return the path of the cached scene for a URL, downloading it or
+        revalidating the cached copy as needed
+
+        Raises:
+            httpx.HTTPError, DownloadTooLarge, asyncio.TimeoutError
+        """
+        source_key = normalize_source(drive_url)
+        cached = await self._lookup_fresh(source_key)
+        if cached:
+            logger.info(f"Using cached imagery for {source_key}: {cached['path']}")
+            return cached['path']
+
+        async def fetch():
+            cached = await asyncio.to_thread(self.file_cache.lookup, source_key)
+            if cached and cached['fresh']:
+                return cached['path']
+            return await asyncio.wait_for(
+                self._fetch(get_download_url(drive_url), source_key, cached),
+                timeout=self.timeout_seconds
+            )
+
+        async def recheck():
+            # Another worker process may have downloaded it while we waited
+            cached = await self._lookup_fresh(source_key)
+            return cached['path'] if cached else None
+
+        return await self.single_flight.run(f"download:{source_key}", fetch, recheck)
+
+    async def _lookup_fresh(self, source_key: str) -> Optional[dict]:
+        cached = await asyncio.to_thread(self.file_cache.lookup, source_key)
+        return cached if cached and cached['fresh'] else None
+
+    async def _fetch(self, download_url: str, source_key: str, cached: Optional[dict]) -> str:
+        headers = {}
+        if cached:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        # Probe for Range support; servers without it send the whole body
+        headers['Range'] = 'bytes=0-0'
+
+        logger.info(f"Downloading imagery from: {download_url}")
+
+        async with self.client.stream('GET', download_url, headers=headers) as response:
+            if cached and response.status_code == 304:
+                await asyncio.to_thread(self.file_cache.mark_validated, source_key)
+                logger.info(f"Cached imagery for {source_key} is still current")
+                return cached['path']
+            response.raise_for_status()
+
+            total = _content_range_total(response)
+            if response.status_code != 206:
+                return await self._stream_single(response, source_key)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        if not total:
+            async with self.client.stream('GET', download_url) as response:
+                response.raise_for_status()
+                return await self._stream_single(response, source_key)
+        return await self._fetch_ranges(download_url, source_key, total, etag, last_modified)
+
+    async def _stream_single(self, response: httpx.Response, source_key: str) -> str:
+        """Stream a full (non-ranged) response body into the cache"""
+        content_length = int(response.headers.get('Content-Length') or 0)
+        if content_length > self.max_bytes:
+            raise DownloadTooLarge(f"Imagery is {content_length} bytes, limit is {self.max_bytes}")
+
+        # Stream into the cache; the file only appears once complete
+        writer = await asyncio.to_thread(self.file_cache.writer, source_key)
+        try:
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                if writer.size + len(chunk) > self.max_bytes:
+                    raise DownloadTooLarge(f"Imagery exceeds the {self.max_bytes} byte limit")
+                await asyncio.to_thread(writer.write, chunk)
+            file_path = await asyncio.to_thread(
+                writer.commit,
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified')
+            )
+        except BaseException:
+            await asyncio.to_thread(writer.abort)
+            raise
+
+        logger.info(f"Imagery downloaded to: {file_path}")
+        return file_path
+
+    async def _fetch_ranges(self, download_url: str, source_key: str, total: int,
+                            etag: Optional[str], last_modified: Optional[str]) -> str:
+        """
+        Download a scene as parallel byte-range segments into a resumable
+        partial file. Progress survives dropped connections and restarts.
+        """
+        if total > self.max_bytes:
+            raise DownloadTooLarge(f"Imagery is {total} bytes, limit is {self.max_bytes}")
+
+        segments = max(1, min(self.segments, total // self.min_segment_bytes))
+        partial = self.file_cache.partial(source_key)
+        state = await asyncio.to_thread(partial.open, total, etag, last_modified, segments)
+        # If-Range needs a strong validator
+        validator = etag if etag and not etag.startswith('W/') else last_modified
+        tasks = [asyncio.create_task(self._fetch_segment(download_url, partial, segment, validator))
+                 for segment in state['segments']]
+        try:
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            file_path = await asyncio.to_thread(partial.commit)
+        except ResourceChanged:
+            await asyncio.to_thread(partial.discard)
+            raise
+        except BaseException:
+            # Keep what we have for the next attempt
+            await asyncio.to_thread(partial.save_state)
+            partial.close()
+            raise
+
+        logger.info(f"Imagery downloaded in {len(state['segments'])} segments to: {file_path}")
+        return file_path
+
+    async def _fetch_segment(self, download_url: str, partial, segment: dict, validator: Optional[str]):
+        attempt = 0
+        while segment['start'] + segment['written'] <= segment['end']:
+            headers = {'Range': f"bytes={segment['start'] + segment['written']}-{segment['end']}"}
+            if validator:
+                # The server answers 200 instead of 206 if the file changed
+                headers['If-Range'] = validator
+            written = segment['written']
+            try:
+                async with self.client.stream('GET', download_url, headers=headers) as response:
+                    if response.status_code == 200:
+                        raise ResourceChanged(f"{download_url} changed during download")
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        remaining = segment['end'] + 1 - segment['start'] - segment['written']
+                        if remaining <= 0:
+                            break
+                        await asyncio.to_thread(partial.write, segment, chunk[:remaining])
+                        await asyncio.to_thread(partial.save_state)
+                if segment['written'] == written:
+                    raise httpx.RemoteProtocolError('Range response ended without data')
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                logger.warning(f"Segment {segment['start']}-{segment['end']} interrupted ({str(e) or type(e).__name__}), resuming")
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+
+def _content_range_total(response: httpx.Response) -> Optional[int]:
+    """Total size from a 'Content-Range: bytes 0-0/12345' header, if known"""
+    content_range = response.headers.get('Content-Range', '')
+    total = content_range.rpartition('/')[2]
+    return int(total) if total.isdigit() else None
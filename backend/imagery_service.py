@@ -3,27 +3,346 @@ Satellite Imagery Processing Service
 Processes Planet SkySat GeoTIFF imagery from Google Drive
 """
 import os
+import glob
+import asyncio
 import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import numpy as np
 from PIL import Image
 import rasterio
-from rasterio.warp import transform_bounds
-import requests
-import tempfile
-from typing import Dict, List, Optional, Tuple
+from affine import Affine
+from rasterio.features import geometry_mask
+from rasterio.warp import reproject, transform_bounds, transform_geom
+from rasterio.enums import Resampling
+from rasterio.transform import array_bounds, from_bounds
+from rasterio.windows import Window
+import math
+from typing import Callable, Dict, List, Optional, Tuple
 import io
-import base64
+import json
+import hashlib
+import colormaps
+import overlay_encoding
+from imagery_cache import AnalysisResultCache, ImageryFileCache, OverlayCache, coordinates_hash, normalize_source
+from imagery_download import ImageryDownloader
+from imagery_streaming import RunningStats, downsample, plan_chunks, stream_window
+from index_engine import BAND_NAMES, compute_indices, registry as index_registry, required_bands, usable_cpus
+from single_flight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
+# Planet SkySat band order
+DEFAULT_BAND_MAP = 'blue=1,green=2,red=3,nir=4'
+
+
+# CPU priority (nice value) of background pyramid builds
+PYRAMID_NICENESS = 10
+
+# Web map tiles: 256 px squares of the spherical Mercator grid
+TILE_SIZE = 256
+TILE_MAX_ZOOM = 24
+MERCATOR_EXTENT = math.pi * 6378137
+
+
+def image_payload(content: bytes, image_format: str) -> Dict:
+    """Encoded image with its media type and a strong ETag"""
+    return {
+        'content': content,
+        'media_type': overlay_encoding.FORMATS[image_format]['media_type'],
+        'etag': f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+    }
+
+
+def overlay_version(key: Tuple) -> str:
+    """Version parameter of an overlay URL, from its result cache key"""
+    return hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+
+
+def _empty_tile() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)).save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+# Served for every tile without field pixels, encoded once
+EMPTY_TILE = image_payload(_empty_tile(), 'png')
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(left, bottom, right, top) of an XYZ tile in EPSG:3857 meters"""
+    size = 2 * MERCATOR_EXTENT / 2 ** z
+    left = -MERCATOR_EXTENT + x * size
+    top = MERCATOR_EXTENT - y * size
+    return left, top - size, left + size, top
+
+
+def tile_lnglat_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(west, south, east, north) of an XYZ tile in degrees"""
+    def lat(row: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / 2 ** z))))
+    return x / 2 ** z * 360 - 180, lat(y + 1), (x + 1) / 2 ** z * 360 - 180, lat(y)
+
+
+def parse_band_map(value: str) -> Dict[str, int]:
+    """
+    Parse a band-to-sensor mapping such as "blue=1,green=2,red=3,nir=4"
+    into 1-based GeoTIFF band indexes. Every band must be mapped.
+
+    Raises:
+        ValueError: for unknown, missing or non-positive bands
+    """
+    band_map = {}
+    for item in value.split(','):
+        name, _, index = item.partition('=')
+        name = name.strip().lower()
+        if name not in BAND_NAMES:
+            raise ValueError(f"Unknown band '{name}' in band map '{value}'")
+        band_map[name] = int(index)
+        if band_map[name] < 1:
+            raise ValueError(f"Band indexes start at 1, got {name}={band_map[name]}")
+    missing = [name for name in BAND_NAMES if name not in band_map]
+    if missing:
+        raise ValueError(f"Band map '{value}' does not map: {', '.join(missing)}")
+    return band_map
+
+
+def parse_indices(value: Optional[str]) -> Tuple[str, ...]:
+    """
+    Parse a comma separated index list such as "ndvi,evi", keeping the
+    requested order. Empty means all registered indices.
+
+    Raises:
+        ValueError: for unknown index names
+    """
+    names = [name.strip().lower() for name in (value or '').split(',') if name.strip()]
+    if not names:
+        return index_registry.names
+    unknown = [name for name in names if name not in index_registry]
+    if unknown:
+        raise ValueError(f"Unknown indices: {', '.join(unknown)}. Supported: {', '.join(index_registry.names)}")
+    return tuple(dict.fromkeys(names))
+
+
+def parse_colormap(value: Optional[str]) -> Optional[str]:
+    """
+    Validate a requested colormap name. Empty means each index's default.
+
+    Raises:
+        ValueError: for unknown colormaps
+    """
+    name = (value or '').strip().lower()
+    if not name:
+        return None
+    colormaps.get_lut(name)
+    return name
+
+
+def fit_dimensions(width: int, height: int, max_dimension: Optional[int]) -> Tuple[int, int]:
+    """Scale (width, height) down so the longer side is at most max_dimension"""
+    if max_dimension and max(width, height) > max_dimension:
+        scale = max_dimension / max(width, height)
+        width, height = max(1, int(width * scale)), max(1, int(height * scale))
+    return width, height
+
+
+def register_custom_indices(value: str):
+    """
+    Register indices from a JSON object mapping names to expressions, e.g.
+    {"ci_green": "nir / green - 1"}, or to {"expression": ..., "description": ...,
+    "colormap": ...}
+
+    Raises:
+        ValueError: for malformed JSON or invalid index definitions
+    """
+    try:
+        definitions = json.loads(value)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Custom indices must be a JSON object: {str(e)}")
+    if not isinstance(definitions, dict):
+        raise ValueError("Custom indices must be a JSON object")
+    for name, definition in definitions.items():
+        if isinstance(definition, str):
+            definition = {'expression': definition}
+        if not isinstance(definition, dict) or not isinstance(definition.get('expression'), str):
+            raise ValueError(f"Custom index '{name}' must be an expression string or an object with an 'expression'")
+        index_registry.register(name, definition.get('expression', ''), definition.get('description', ''),
+                                definition.get('colormap', colormaps.DEFAULT_COLORMAP))
+
 class ImageryService:
     """Service for processing satellite imagery from Google Drive"""
     
     def __init__(self):
         # Base Google Drive folder URL (set via environment variable)
         self.drive_folder_url = os.environ.get('GDRIVE_IMAGERY_FOLDER', '')
-        self.imagery_cache = {}
+        # Downloaded scenes are kept on disk and reused across analyses
+        self.file_cache = ImageryFileCache()
+        # Concurrent identical downloads and analyses run once; with
+        # cross-process locks, also across uvicorn workers on this host
+        cross_process = os.environ.get('IMAGERY_CROSS_PROCESS_LOCKS', 'true').lower() == 'true'
+        self.single_flight = SingleFlight(
+            os.path.join(self.file_cache.cache_dir, 'locks') if cross_process else None
+        )
+        # Finished overlays, one entry per index, keyed by field, scene
+        # content and boundary, so indices are computed on first request
+        self.imagery_cache = AnalysisResultCache(
+            shared_dir=os.path.join(self.file_cache.cache_dir, 'results') if cross_process else None
+        )
+        # Their overlay images, served as raw bytes by the overlay endpoint
+        # rather than inlined into the analysis JSON
+        self.overlay_cache = OverlayCache(
+            shared_dir=os.path.join(self.file_cache.cache_dir, 'overlays') if cross_process else None
+        )
+        # Rendered map tiles, per process: cheap to redo, too many to share
+        self.tile_cache = OverlayCache(
+            max_bytes=int(os.environ.get('TILE_CACHE_MAX_BYTES', str(64 * 1024 ** 2)))
+        )
+        self.downloader = ImageryDownloader(self.file_cache, self.single_flight)
+        # Imagery processing is blocking (network, rasterio, PIL), so it runs
+        # in a dedicated, size-bounded pool instead of on the event loop.
+        self.executor_kind = os.environ.get('IMAGERY_EXECUTOR', 'thread').lower()
+        self.max_workers = int(os.environ.get('IMAGERY_MAX_WORKERS', '2'))
+        # Pixels of context kept around the field when reading a window
+        self.window_buffer = int(os.environ.get('IMAGERY_WINDOW_BUFFER_PIXELS', '16'))
+        # Overlays are previews: pixels are only read at the size they are shown
+        self.preview_max_dimension = int(os.environ.get('IMAGERY_PREVIEW_MAX_DIMENSION', '1024'))
+        self.preview_resampling = os.environ.get('IMAGERY_PREVIEW_RESAMPLING', 'average')
+        if self.preview_resampling not in Resampling.__members__:
+            raise ValueError(f"Unknown IMAGERY_PREVIEW_RESAMPLING {self.preview_resampling!r}, "
+                             f"expected one of {', '.join(Resampling.__members__)}")
+        # Largest overlay side; indices may be computed at a finer resolution
+        # and are reduced to this size before they are colorized
+        self.overlay_max_dimension = int(os.environ.get('IMAGERY_OVERLAY_MAX_DIMENSION',
+                                                        str(self.preview_max_dimension)))
+        # Overlay and tile encoder settings (see overlay_encoding.encode)
+        self.png_compress_level = int(os.environ.get('IMAGERY_PNG_COMPRESS_LEVEL', '6'))
+        self.webp_quality = int(os.environ.get('IMAGERY_WEBP_QUALITY', '80'))
+        self.webp_method = int(os.environ.get('IMAGERY_WEBP_METHOD', '4'))
+        # Overlays are rendered concurrently (NumPy and PIL's encoders release
+        # the GIL) in a pool shared by all analyses, so that one analysis
+        # can't take every core (of those this process may run on)
+        self.overlay_threads = int(os.environ.get('IMAGERY_OVERLAY_THREADS', str(min(4, usable_cpus()))))
+        # Map tiles render in their own bounded pool, so a map panning over
+        # a field can't take every thread of the loop's default executor
+        self.tile_workers = int(os.environ.get('IMAGERY_TILE_WORKERS', str(min(4, usable_cpus()))))
+        # Working precision for bands, indices and rendering. float32 halves
+        # memory against float64 and is ample for 12-16 bit sensor data.
+        self.dtype = np.dtype(os.environ.get('IMAGERY_DTYPE', 'float32'))
+        # Which GeoTIFF band holds each sensor band, for imagery other than SkySat
+        self.band_map = parse_band_map(os.environ.get('IMAGERY_BAND_MAP', DEFAULT_BAND_MAP))
+        # Extra indices declared as band-algebra expressions (see index_engine)
+        custom_indices = os.environ.get('IMAGERY_CUSTOM_INDICES', '')
+        if custom_indices:
+            register_custom_indices(custom_indices)
+        # Stream full resolution blocks instead of reading a decimated window,
+        # for statistics over the field's native pixels on scenes of any size
+        # within a memory budget. Decimated reads take statistics over the
+        # area-averaged preview pixels, which narrows std, min/max and the
+        # histogram; each result's 'resolution' says which it is.
+        self.streaming = os.environ.get('IMAGERY_STREAMING', 'false').lower() == 'true'
+        self.memory_budget = int(os.environ.get('IMAGERY_MEMORY_BUDGET_BYTES', str(256 * 1024 ** 2)))
+        # Per-index statistics: histogram resolution over [-1, 1], and the
+        # median NDVI range mapped onto a 0-100 field health index
+        self.histogram_bins = int(os.environ.get('IMAGERY_STATS_HISTOGRAM_BINS', '100'))
+        self.health_ndvi_low = float(os.environ.get('HEALTH_NDVI_LOW', '0.2'))
+        self.health_ndvi_high = float(os.environ.get('HEALTH_NDVI_HIGH', '0.8'))
+        # Rasterized field boundaries, keyed by boundary and pixel grid
+        self.mask_cache: 'OrderedDict[Tuple, np.ndarray]' = OrderedDict()
+        self.mask_cache_size = int(os.environ.get('IMAGERY_MASK_CACHE_SIZE', '64'))
+        self._mask_lock = threading.Lock()
+        # Power-of-two index pyramids built after each analysis, for map tiles
+        self.pyramids = os.environ.get('IMAGERY_PYRAMIDS', 'true').lower() == 'true'
+        # Pyramids are built at full resolution in their own small pool, at
+        # lower CPU priority, so they never queue ahead of user analyses
+        self.pyramid_workers = int(os.environ.get('IMAGERY_PYRAMID_WORKERS', '1'))
+        # Builds wait this long, collecting the indices of further analyses
+        # of the same field and scene, so they share one full-resolution pass
+        self.pyramid_delay = float(os.environ.get('IMAGERY_PYRAMID_DELAY_SECONDS', '30'))
+        self._pending_pyramids: Dict[Tuple, set] = {}
+        self._background_tasks = set()
+        self._executor: Optional[Executor] = None
+        self._pyramid_executor: Optional[Executor] = None
+        self._overlay_executor: Optional[ThreadPoolExecutor] = None
+        self._overlay_executor_lock = threading.Lock()
+        self._tile_executor: Optional[ThreadPoolExecutor] = None
+        self._tile_executor_lock = threading.Lock()
         
+    @property
+    def executor(self) -> Executor:
+        """Lazily created executor used for the imagery pipeline"""
+        if self._executor is None:
+            if self.executor_kind == 'process':
+                # Spawned, not forked: a fork would copy the server's threads'
+                # locks and pools (e.g. index_engine's strip pool) half-held
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='imagery'
+                )
+            logger.info(f"Started {self.executor_kind} imagery executor with {self.max_workers} workers")
+        return self._executor
+    
+    @property
+    def pyramid_executor(self) -> Executor:
+        """Lazily created low-priority executor for background pyramid builds"""
+        if self._pyramid_executor is None:
+            if self.executor_kind == 'process':
+                self._pyramid_executor = ProcessPoolExecutor(
+                    max_workers=self.pyramid_workers, initializer=_lower_priority,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            else:
+                self._pyramid_executor = ThreadPoolExecutor(
+                    max_workers=self.pyramid_workers,
+                    thread_name_prefix='pyramids',
+                    initializer=_lower_priority
+                )
+        return self._pyramid_executor
+    
+    @property
+    def overlay_executor(self) -> ThreadPoolExecutor:
+        """Lazily created thread pool for rendering overlays, per process"""
+        with self._overlay_executor_lock:
+            if self._overlay_executor is None:
+                self._overlay_executor = ThreadPoolExecutor(
+                    max_workers=self.overlay_threads,
+                    thread_name_prefix='overlay'
+                )
+            return self._overlay_executor
+    
+    @property
+    def tile_executor(self) -> ThreadPoolExecutor:
+        """Lazily created thread pool for rendering map tiles, per process"""
+        with self._tile_executor_lock:
+            if self._tile_executor is None:
+                self._tile_executor = ThreadPoolExecutor(
+                    max_workers=self.tile_workers,
+                    thread_name_prefix='tiles'
+                )
+            return self._tile_executor
+    
+    async def shutdown(self):
+        """Close the download pool and stop the executor, letting running analyses finish"""
+        await self.downloader.aclose()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._overlay_executor is not None:
+            self._overlay_executor.shutdown(wait=True)
+            self._overlay_executor = None
+        if self._tile_executor is not None:
+            self._tile_executor.shutdown(wait=True)
+            self._tile_executor = None
+        if self._pyramid_executor is not None:
+            # Queued builds are dropped; tiles fall back to the scene
+            self._pyramid_executor.shutdown(wait=True, cancel_futures=True)
+            self._pyramid_executor = None
+    
     def get_field_imagery_url(self, field_id: str) -> str:
         """
         Construct Google Drive direct download URL for field imagery
@@ -33,7 +352,7 @@ class ImageryService:
         # For now, expect direct file links in database or construct from folder
         return f"{self.drive_folder_url}/{field_id}.tif"
     
-    def download_imagery(self, drive_url: str) -> Optional[str]:
+    async def download_imagery(self, drive_url: str) -> Optional[str]:
         """
         Download GeoTIFF from Google Drive
         
@@ -41,245 +360,415 @@ class ImageryService:
             drive_url: Google Drive sharing URL or direct download URL
             
         Returns:
-            Path to downloaded temporary file
+            Path to the cached GeoTIFF (owned by the cache, do not delete)
         """
         try:
-            # Convert sharing URL to direct download URL if needed
-            if 'drive.google.com' in drive_url and '/file/d/' in drive_url:
-                file_id = drive_url.split('/file/d/')[1].split('/')[0]
-                download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-            else:
-                download_url = drive_url
-            
-            logger.info(f"Downloading imagery from: {download_url}")
-            
-            # Download with requests
-            response = requests.get(download_url, stream=True, timeout=60)
-            response.raise_for_status()
-            
-            # Save to temporary file
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.tif')
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    temp_file.write(chunk)
-            
-            temp_file.close()
-            logger.info(f"Imagery downloaded to: {temp_file.name}")
-            return temp_file.name
-            
+            return await self.downloader.download(drive_url)
         except Exception as e:
             logger.error(f"Error downloading imagery: {str(e)}")
             return None
     
-    def read_geotiff(self, file_path: str) -> Optional[Dict]:
+    def field_window(self, src, coordinates: Optional[List[Dict]]) -> Optional[Window]:
+        """
+        Pixel window covering the field boundary's bounding box plus a small
+        buffer, clipped to the raster. None when the field lies outside it.
+        """
+        lngs = [float(c['lng']) for c in coordinates]
+        lats = [float(c['lat']) for c in coordinates]
+        left, bottom, right, top = transform_bounds(
+            'EPSG:4326', src.crs, min(lngs), min(lats), max(lngs), max(lats), densify_pts=21
+        )
+        inverse = ~src.transform
+        cols, rows = zip(*(inverse * corner for corner in
+                           [(left, bottom), (left, top), (right, bottom), (right, top)]))
+        col_start = max(0, math.floor(min(cols)) - self.window_buffer)
+        row_start = max(0, math.floor(min(rows)) - self.window_buffer)
+        col_stop = min(src.width, math.ceil(max(cols)) + self.window_buffer)
+        row_stop = min(src.height, math.ceil(max(rows)) + self.window_buffer)
+        if col_stop <= col_start or row_stop <= row_start:
+            return None
+        return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    
+    def field_geometry(self, coordinates: List[Dict], crs) -> Dict:
+        """Field boundary as a GeoJSON polygon in the raster's CRS"""
+        ring = [(float(c['lng']), float(c['lat'])) for c in coordinates]
+        if ring[0] != ring[-1]:
+            ring.append(ring[0])
+        return transform_geom('EPSG:4326', crs, {'type': 'Polygon', 'coordinates': [ring]})
+    
+    def field_mask(self, coordinates: List[Dict], crs, transform, shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Boolean array that is True for pixels inside the field boundary.
+        Rasterized once per boundary and pixel grid, then served from cache.
+        """
+        key = (coordinates_hash(coordinates), str(crs), tuple(transform)[:6], shape)
+        with self._mask_lock:
+            mask = self.mask_cache.get(key)
+            if mask is not None:
+                self.mask_cache.move_to_end(key)
+                return mask
+        
+        mask = geometry_mask([self.field_geometry(coordinates, crs)], out_shape=shape, transform=transform, invert=True)
+        
+        with self._mask_lock:
+            self.mask_cache[key] = mask
+            while len(self.mask_cache) > self.mask_cache_size:
+                self.mask_cache.popitem(last=False)
+        return mask
+    
+    def read_geotiff(self, file_path: str, coordinates: Optional[List[Dict]] = None,
+                     max_dimension: Optional[int] = None, resampling: str = 'average',
+                     bands: Tuple[str, ...] = BAND_NAMES) -> Optional[Dict]:
         """
         Read Planet SkySat GeoTIFF and extract bands
         
-        Planet SkySat bands:
+        Planet SkySat bands (the default IMAGERY_BAND_MAP):
         Band 1: Blue
         Band 2: Green  
         Band 3: Red
         Band 4: NIR (Near Infrared)
         
+        Only the requested bands are read and decoded; the others are
+        returned as None.
+        
+        When the field coordinates are given, only the window around the
+        field is read, so cost scales with field size rather than scene size,
+        and pixels outside the boundary are set to NaN so they drop out of
+        indices, statistics and overlays.
+        
+        With max_dimension, the window is read decimated so its longer side
+        fits, letting GDAL use overviews and the given resampling method
+        (a rasterio Resampling name) instead of decoding full resolution.
+        
         Returns:
             Dict with band arrays and metadata
         """
         try:
             with rasterio.open(file_path) as src:
-                # Read all bands
-                bands = src.read()
-                
-                # Planet SkySat has 4 bands
-                if bands.shape[0] < 4:
-                    logger.error(f"Expected 4 bands, got {bands.shape[0]}")
+                indexes = [self.band_map[band] for band in bands]
+                if max(indexes) > src.count:
+                    logger.error(f"Band map {self.band_map} needs band {max(indexes)}, got {src.count} bands")
                     return None
                 
-                blue = bands[0].astype(float)
-                green = bands[1].astype(float)
-                red = bands[2].astype(float)
-                nir = bands[3].astype(float)
+                window = Window(0, 0, src.width, src.height)
+                if coordinates and src.crs:
+                    window = self.field_window(src, coordinates)
+                    if window is None:
+                        logger.error("Field boundary does not overlap the imagery")
+                        return None
+                
+                width, height = fit_dimensions(int(window.width), int(window.height), max_dimension)
+                transform = src.window_transform(window) * Affine.scale(window.width / width, window.height / height)
+                
+                # Decode straight into the working dtype, no extra copies
+                data = src.read(
+                    indexes=indexes,
+                    window=window,
+                    out_shape=(len(indexes), height, width),
+                    resampling=Resampling[resampling],
+                    out_dtype=self.dtype
+                )
+                
+                mask = None
+                if coordinates and src.crs:
+                    mask = self.field_mask(coordinates, src.crs, transform, (height, width))
+                    data[:, ~mask] = np.nan
+                
+                result = dict.fromkeys(BAND_NAMES)
+                result.update(zip(bands, data))
                 
                 metadata = {
-                    'bounds': src.bounds,
+                    'bounds': list(src.window_bounds(window)),
                     'crs': str(src.crs),
-                    'transform': src.transform,
-                    'width': src.width,
-                    'height': src.height
+                    'transform': list(transform)[:6],
+                    'width': width,
+                    'height': height,
+                    'window': [int(window.col_off), int(window.row_off), int(window.width), int(window.height)],
+                    'scene_width': src.width,
+                    'scene_height': src.height,
+                    'field_pixels': int(mask.sum()) if mask is not None else width * height
                 }
                 
-                logger.info(f"Read GeoTIFF: {src.width}x{src.height}, {bands.shape[0]} bands")
+                logger.info(f"Read GeoTIFF window {metadata['window']} of {src.width}x{src.height} at {width}x{height}, bands {indexes}")
                 
-                return {
-                    'blue': blue,
-                    'green': green,
-                    'red': red,
-                    'nir': nir,
-                    'metadata': metadata
-                }
+                result['mask'] = mask
+                result['metadata'] = metadata
+                return result
                 
         except Exception as e:
             logger.error(f"Error reading GeoTIFF: {str(e)}")
             return None
     
-    def calculate_indices(self, bands: Dict) -> Dict[str, np.ndarray]:
+    def stream_field_indices(self, file_path: str, coordinates: Optional[List[Dict]],
+                             indices: Tuple[str, ...], max_dimension: int,
+                             progress: Optional[Callable[[float], None]] = None) -> Optional[Dict]:
+        """
+        Compute indices at full resolution without loading the window into
+        memory: the native blocks overlapping the field are read in chunks
+        sized to IMAGERY_MEMORY_BUDGET_BYTES, and each chunk is masked,
+        turned into indices and folded into running statistics and
+        area-averaged previews of at most max_dimension pixels.
+        
+        Returns:
+            Dict with preview index arrays, statistics and metadata
+        """
+        try:
+            with rasterio.open(file_path) as src:
+                bands = required_bands(indices)
+                indexes = [self.band_map[band] for band in bands]
+                if max(indexes) > src.count:
+                    logger.error(f"Band map {self.band_map} needs band {max(indexes)}, got {src.count} bands")
+                    return None
+                
+                window = Window(0, 0, src.width, src.height)
+                geometry = None
+                if coordinates and src.crs:
+                    window = self.field_window(src, coordinates)
+                    if window is None:
+                        logger.error("Field boundary does not overlap the imagery")
+                        return None
+                    geometry = self.field_geometry(coordinates, src.crs)
+                
+                width, height = fit_dimensions(int(window.width), int(window.height), max_dimension)
+                transform = src.window_transform(window) * Affine.scale(window.width / width, window.height / height)
+                
+                # Bands, kernel buffers, plus masks and statistics temporaries
+                itemsize = self.dtype.itemsize
+                bytes_per_pixel = itemsize * (len(indexes) + index_registry.compile(indices).buffers) + 32
+                chunks = plan_chunks(src, window, bytes_per_pixel, self.memory_budget)
+                field_pixels = 0
+                
+                def compute(data: np.ndarray, chunk: Window) -> Dict[str, np.ndarray]:
+                    nonlocal field_pixels
+                    values, chunk_field_pixels = self._chunk_indices(src, data, chunk, geometry, bands, indices)
+                    field_pixels += chunk_field_pixels
+                    return values
+                
+                previews, statistics = stream_window(
+                    src, window, indexes, chunks, self.dtype, compute, (height, width), progress,
+                    histogram_bins=self.histogram_bins
+                )
+                
+                metadata = {
+                    'bounds': list(src.window_bounds(window)),
+                    'crs': str(src.crs),
+                    'transform': list(transform)[:6],
+                    'width': width,
+                    'height': height,
+                    'window': [int(window.col_off), int(window.row_off), int(window.width), int(window.height)],
+                    'scene_width': src.width,
+                    'scene_height': src.height,
+                    'field_pixels': field_pixels,
+                    'chunks': len(chunks)
+                }
+                
+                logger.info(f"Streamed GeoTIFF window {metadata['window']} of {src.width}x{src.height} in {len(chunks)} chunks, bands {indexes}")
+                
+                return {'indices': previews, 'statistics': statistics, 'metadata': metadata}
+                
+        except Exception as e:
+            logger.error(f"Error streaming GeoTIFF: {str(e)}")
+            return None
+    
+    def _chunk_indices(self, src, data: np.ndarray, chunk: Window, geometry: Optional[Dict],
+                       bands: Tuple[str, ...], indices: Tuple[str, ...]) -> Tuple[Dict[str, np.ndarray], int]:
+        """Indices of a chunk of full resolution bands, masked to the field, and its field pixel count"""
+        if geometry is not None:
+            mask = geometry_mask([geometry], out_shape=data.shape[1:],
+                                 transform=src.window_transform(chunk), invert=True)
+            data[:, ~mask] = np.nan
+            field_pixels = int(mask.sum())
+        else:
+            field_pixels = data.shape[1] * data.shape[2]
+        chunk_bands = dict.fromkeys(BAND_NAMES)
+        chunk_bands.update(zip(bands, data))
+        values = compute_indices(chunk_bands['blue'], chunk_bands['green'],
+                                 chunk_bands['red'], chunk_bands['nir'], indices)
+        return values, field_pixels
+    
+    def calculate_indices(self, bands: Dict, indices: Optional[Tuple[str, ...]] = None) -> Dict[str, np.ndarray]:
         """
-        Calculate all vegetation and health indices
+        Calculate registered vegetation and health indices, all by default.
+        Only the requested indices (and what they are derived from) are computed.
         
         Returns dict with index name as key and numpy array as value
         """
+        names = indices or index_registry.names
         try:
-            blue = bands['blue']
-            green = bands['green']
-            red = bands['red']
-            nir = bands['nir']
-            
-            # Avoid division by zero
-            epsilon = 1e-10
-            
-            # NDVI: (NIR - Red) / (NIR + Red)
-            ndvi = (nir - red) / (nir + red + epsilon)
-            
-            # NDWI: (Green - NIR) / (Green + NIR)
-            ndwi = (green - nir) / (green + nir + epsilon)
-            
-            # EVI: 2.5 * ((NIR - Red) / (NIR + 6*Red - 7.5*Blue + 1))
-            evi = 2.5 * ((nir - red) / (nir + 6*red - 7.5*blue + 1 + epsilon))
+            # Fused engine: shared subexpressions, preallocated outputs
+            indices = compute_indices(bands['blue'], bands['green'], bands['red'], bands['nir'], names)
             
-            # SAVI: ((NIR - Red) / (NIR + Red + 0.5)) * 1.5
-            savi = ((nir - red) / (nir + red + 0.5 + epsilon)) * 1.5
+            logger.info(f"Calculated vegetation indices: {', '.join(indices)}")
             
-            # NDRE: For Planet SkySat, we approximate using Red and NIR
-            # True NDRE needs Red Edge band which Planet SkySat doesn't have
-            # Using NIR and Red as approximation
-            ndre = (nir - red) / (nir + red + epsilon)
-            
-            # GNDVI: (NIR - Green) / (NIR + Green)
-            gndvi = (nir - green) / (nir + green + epsilon)
-            
-            logger.info("Calculated all vegetation indices")
-            
-            return {
-                'ndvi': ndvi,
-                'ndwi': ndwi,
-                'evi': evi,
-                'savi': savi,
-                'ndre': ndre,
-                'gndvi': gndvi
-            }
+            return indices
             
         except Exception as e:
             logger.error(f"Error calculating indices: {str(e)}")
             return {}
     
-    def create_colored_overlay(self, index_array: np.ndarray, index_name: str) -> str:
+    def create_colored_overlay(self, index_array: np.ndarray, index_name: str,
+                               colormap: Optional[str] = None) -> bytes:
         """
         Create colored image overlay from index array
-        Red (bad/low) to Green (good/high) gradient
+        Values over -1 to 1 are colored with the named colormap (default: the
+        index's own), semi-transparent; pixels outside the field (NaN) are
+        fully transparent
         
         Returns:
-            Base64 encoded PNG image
+            8-bit palette PNG bytes, from which other formats are derived
         """
         try:
-            # Normalize to 0-1 range
-            # Most indices range from -1 to 1
-            normalized = (index_array + 1) / 2  # Map -1,1 to 0,1
-            normalized = np.clip(normalized, 0, 1)
-            
-            # Create RGB image with Red-Yellow-Green gradient
-            # Red (low) -> Yellow (medium) -> Green (high)
-            height, width = normalized.shape
-            rgb_image = np.zeros((height, width, 4), dtype=np.uint8)  # RGBA
-            
-            # Red channel: high at low values, low at high values
-            rgb_image[:, :, 0] = ((1 - normalized) * 255).astype(np.uint8)
+            # Shrink to display size first (max 1024px by default), averaging
+            # only pixels inside the field, so only shown pixels are colorized
+            height, width = index_array.shape
+            new_width, new_height = fit_dimensions(width, height, self.overlay_max_dimension)
+            if (new_width, new_height) != (width, height):
+                index_array = downsample(index_array, (new_height, new_width))
             
-            # Green channel: increases with value
-            rgb_image[:, :, 1] = (normalized * 255).astype(np.uint8)
-            
-            # Blue channel: stay at 0
-            rgb_image[:, :, 2] = 0
-            
-            # Alpha channel: 180 for semi-transparency
-            rgb_image[:, :, 3] = 180
-            
-            # Convert to PIL Image
-            img = Image.fromarray(rgb_image, mode='RGBA')
-            
-            # Resize for reasonable file size (max 1024px)
-            max_dimension = 1024
-            if max(width, height) > max_dimension:
-                scale = max_dimension / max(width, height)
-                new_width = int(width * scale)
-                new_height = int(height * scale)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # Convert to base64
-            buffer = io.BytesIO()
-            img.save(buffer, format='PNG', optimize=True)
-            img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            # The colormap table is the palette, so quantized values are the pixels
+            img = overlay_encoding.palette_image(
+                colormaps.quantize(index_array), colormaps.get_lut(colormap or index_registry.colormap(index_name))
+            )
+            content = self.encode_image(img, 'png')
             
             logger.info(f"Created colored overlay for {index_name}: {img.size}")
-            return img_base64
+            return content
             
         except Exception as e:
             logger.error(f"Error creating colored overlay: {str(e)}")
-            return ""
+            return b""
     
-    def process_field_imagery(self, field_id: str, drive_url: str) -> Dict:
+    def render_overlays(self, indices: Dict[str, np.ndarray], colormaps_by_index: Dict[str, str],
+                        progress: Optional[Callable[[int], None]] = None) -> Dict[str, bytes]:
         """
-        Complete processing pipeline for field imagery
+        create_colored_overlay for each index in the overlay pool, so the
+        stage takes about as long as the slowest overlay. Only used from the
+        imagery executor, never from the pool itself, so it can't deadlock.
+        
+        Args:
+            indices: Index arrays by name
+            colormaps_by_index: Colormap for each index
+            progress: Optional callback receiving the number of finished overlays
+            
+        Returns:
+            PNG bytes by index name, empty for overlays that failed
+        """
+        if len(indices) <= 1 or self.overlay_threads <= 1:
+            overlays = {}
+            for index_name, index_array in indices.items():
+                overlays[index_name] = self.create_colored_overlay(
+                    index_array, index_name, colormaps_by_index[index_name]
+                )
+                if progress:
+                    progress(len(overlays))
+            return overlays
+        
+        futures = {
+            self.overlay_executor.submit(
+                self.create_colored_overlay, index_array, index_name, colormaps_by_index[index_name]
+            ): index_name
+            for index_name, index_array in indices.items()
+        }
+        overlays = {}
+        for future in as_completed(futures):
+            # create_colored_overlay logs and returns b"" on failure
+            overlays[futures[future]] = future.result()
+            if progress:
+                progress(len(overlays))
+        return overlays
+    
+    def analyze_imagery(self, field_id: str, file_path: str,
+                        coordinates: Optional[List[Dict]] = None,
+                        indices: Optional[Tuple[str, ...]] = None,
+                        colormap: Optional[str] = None,
+                        progress: Optional[Callable[[int, str], None]] = None) -> Dict:
+        """
+        Compute indices and overlays for a downloaded scene. Blocking, so it
+        runs in the imagery executor.
         
         Args:
             field_id: Field ID
-            drive_url: Google Drive URL to GeoTIFF
+            file_path: Path to the cached GeoTIFF
+            coordinates: Field boundary; only the window around it is processed
+            indices: Indices to compute and render (default: all)
+            colormap: Colormap for every overlay (default: each index's own)
+            progress: Optional callback receiving (percent, stage) updates
             
         Returns:
-            Dict with base64 encoded overlays for each index
+            Dict with PNG overlay bytes for each requested index
         """
+        report = progress or (lambda percent, stage: None)
         try:
-            # Download imagery
-            file_path = self.download_imagery(drive_url)
-            if not file_path:
-                return {
-                    'status': 'error',
-                    'message': f'Failed to download imagery for field {field_id}. Please check the Google Drive URL.'
-                }
-            
-            # Read GeoTIFF
-            bands = self.read_geotiff(file_path)
-            if not bands:
-                os.unlink(file_path)
-                return {
-                    'status': 'error',
-                    'message': f'Failed to read GeoTIFF. Ensure the file is a valid Planet SkySat image with 4 bands.'
-                }
-            
-            # Calculate indices
-            indices = self.calculate_indices(bands)
-            if not indices:
-                os.unlink(file_path)
-                return {
-                    'status': 'error',
-                    'message': 'Failed to calculate vegetation indices.'
-                }
+            indices = tuple(indices or index_registry.names)
+            if self.streaming:
+                # Read, mask and compute chunk by chunk at full resolution
+                report(40, 'reading')
+                streamed = self.stream_field_indices(
+                    file_path, coordinates, indices, self.preview_max_dimension,
+                    progress=lambda fraction: report(40 + int(30 * fraction), 'calculating')
+                )
+                if not streamed:
+                    return {
+                        'status': 'error',
+                        'message': f'Failed to read GeoTIFF. Ensure the file is a valid Planet SkySat image with 4 bands that covers the field.'
+                    }
+                metadata = streamed['metadata']
+                indices = streamed['indices']
+                statistics = streamed['statistics']
+            else:
+                # Read GeoTIFF
+                report(40, 'reading')
+                bands = self.read_geotiff(
+                    file_path, coordinates,
+                    max_dimension=self.preview_max_dimension,
+                    resampling=self.preview_resampling,
+                    bands=required_bands(indices)
+                )
+                if not bands:
+                    return {
+                        'status': 'error',
+                        'message': f'Failed to read GeoTIFF. Ensure the file is a valid Planet SkySat image with 4 bands that covers the field.'
+                    }
+                metadata = bands['metadata']
+                
+                # Calculate indices
+                report(55, 'calculating')
+                indices = self.calculate_indices(bands, indices)
+                if not indices:
+                    return {
+                        'status': 'error',
+                        'message': 'Failed to calculate vegetation indices.'
+                    }
+                statistics = {}
+                for index_name, index_array in indices.items():
+                    running = RunningStats(self.histogram_bins)
+                    running.update(index_array)
+                    statistics[index_name] = running.result()
             
-            # Create colored overlays for each index
-            overlays = {}
-            for index_name, index_array in indices.items():
-                overlay_base64 = self.create_colored_overlay(index_array, index_name)
-                if overlay_base64:
-                    overlays[index_name] = f"data:image/png;base64,{overlay_base64}"
+            resolution = statistics_resolution(metadata, self.streaming)
+            for index_statistics in statistics.values():
+                index_statistics['resolution'] = resolution
             
-            # Cleanup temporary file
-            os.unlink(file_path)
+            # Create colored overlays for each index, concurrently
+            report(70, 'rendering')
+            used_colormaps = {
+                index_name: colormap or index_registry.colormap(index_name) for index_name in indices
+            }
+            rendered = self.render_overlays(indices, used_colormaps,
+                                            lambda done: report(70 + 25 * done // len(indices), 'rendering'))
+            # Keep the requested order
+            overlays = {index_name: rendered[index_name] for index_name in indices if rendered.get(index_name)}
             
             logger.info(f"Successfully processed imagery for field {field_id}")
             
             return {
                 'status': 'success',
                 'field_id': field_id,
+                'imagery_hash': self.file_cache.digest_of(file_path),
                 'overlays': overlays,
-                'metadata': bands['metadata'],
+                'statistics': {index_name: statistics[index_name] for index_name in overlays},
+                'colormaps': {index_name: used_colormaps[index_name] for index_name in overlays},
+                'metadata': metadata,
                 'indices': list(overlays.keys())
             }
             
@@ -290,6 +779,520 @@ class ImageryService:
                 'message': f'Unexpected error: {str(e)}'
             }
 
+    def health_index(self, statistics: Dict[str, Dict]) -> Optional[float]:
+        """
+        Field health (0-100) from the median NDVI inside the field, scaled
+        linearly between HEALTH_NDVI_LOW (bare soil, 0) and HEALTH_NDVI_HIGH
+        (dense healthy canopy, 100). None without NDVI statistics.
+        """
+        ndvi = (statistics or {}).get('ndvi')
+        if not ndvi or not ndvi.get('count'):
+            return None
+        median = ndvi['percentiles']['p50']
+        score = (median - self.health_ndvi_low) / (self.health_ndvi_high - self.health_ndvi_low)
+        return round(100 * min(max(score, 0.0), 1.0), 1)
+    
+    def result_cache_key(self, field_id: str, imagery_hash: str,
+                         coordinates: Optional[List[Dict]], index_name: str,
+                         colormap: Optional[str] = None) -> Tuple:
+        band_map = tuple(self.band_map[band] for band in BAND_NAMES)
+        # The definition is part of the key, so redefining an index recomputes it
+        return (field_id, imagery_hash, coordinates_hash(coordinates), band_map,
+                index_name, index_registry.signature(index_name),
+                colormap or index_registry.colormap(index_name))
+    
+    def cached_indices(self, field_id: str, imagery_hash: str, coordinates: Optional[List[Dict]],
+                       indices: Tuple[str, ...], colormap: Optional[str] = None) -> Dict[str, Dict]:
+        """Cached per-index results for a scene, for whichever indices have one"""
+        cached = {}
+        for index_name in indices:
+            key = self.result_cache_key(field_id, imagery_hash, coordinates, index_name, colormap)
+            # A result is only usable while its overlay image is cached too
+            result = self.imagery_cache.get(key)
+            if result and self.overlay_cache.get(key + ('png',)) is not None:
+                cached[index_name] = result
+        return cached
+    
+    def get_cached_analysis(self, field_id: str, drive_url: str,
+                            coordinates: Optional[List[Dict]],
+                            indices: Optional[Tuple[str, ...]] = None,
+                            colormap: Optional[str] = None) -> Optional[Dict]:
+        """
+        Return a cached analysis if the scene is in the disk cache and still
+        fresh and every requested index has been computed, without touching
+        the network
+        """
+        cached_file = self.file_cache.lookup(normalize_source(drive_url))
+        if not cached_file or not cached_file['fresh']:
+            return None
+        indices = tuple(indices or index_registry.names)
+        cached = self.cached_indices(field_id, cached_file['digest'], coordinates, indices, colormap)
+        return merge_index_results(cached, indices)
+    
+    async def process_field_imagery(self, field_id: str, drive_url: str,
+                                    coordinates: Optional[List[Dict]] = None,
+                                    indices: Optional[Tuple[str, ...]] = None,
+                                    colormap: Optional[str] = None,
+                                    progress: Optional[Callable[[int, str], None]] = None) -> Dict:
+        """
+        Complete processing pipeline for field imagery. The download runs on
+        the event loop and the compute stages in the imagery executor, so
+        the loop stays free for other requests.
+        
+        Indices are cached one by one: only those not computed before for
+        this scene and boundary are calculated and rendered.
+        
+        Args:
+            field_id: Field ID
+            drive_url: Google Drive URL to GeoTIFF
+            coordinates: Field boundary; limits processing to the field and keys the result cache
+            indices: Indices to return (default: all registered indices)
+            colormap: Colormap for every overlay (default: each index's own)
+            progress: Optional callback receiving (percent, stage) updates
+            
+        Returns:
+            Dict with overlay URLs (see get_overlay) and statistics for each
+            requested index
+        """
+        indices = tuple(indices or index_registry.names)
+        cached = await asyncio.to_thread(self.get_cached_analysis, field_id, drive_url, coordinates, indices, colormap)
+        if cached:
+            logger.info(f"Using cached analysis for field {field_id}")
+            return cached
+        
+        if progress:
+            progress(5, 'downloading')
+        file_path = await self.download_imagery(drive_url)
+        if not file_path:
+            return {
+                'status': 'error',
+                'message': f'Failed to download imagery for field {field_id}. Please check the Google Drive URL.'
+            }
+        
+        return await self.analyze_scene(field_id, file_path, coordinates, indices, colormap, progress)
+    
+    async def analyze_scene(self, field_id: str, file_path: str,
+                            coordinates: Optional[List[Dict]], indices: Tuple[str, ...],
+                            colormap: Optional[str] = None,
+                            progress: Optional[Callable[[int, str], None]] = None) -> Dict:
+        """
+        Compute stages of process_field_imagery for a scene in the disk
+        cache: the indices not cached yet are computed in the imagery
+        executor, rendered and cached
+        """
+        imagery_hash = self.file_cache.digest_of(file_path)
+        
+        async def cached_results():
+            return await asyncio.to_thread(self.cached_indices, field_id, imagery_hash, coordinates, indices, colormap)
+        
+        # A revalidated scene may still have some or all indices cached
+        results = await cached_results()
+        missing = tuple(index_name for index_name in indices if index_name not in results)
+        if not missing:
+            return merge_index_results(results, indices)
+        
+        async def recheck():
+            # Another worker process may have computed them while we waited
+            done = await cached_results()
+            return done if all(index_name in done for index_name in missing) else None
+        
+        async def analyze():
+            # Callbacks can't cross the process boundary
+            callback = progress if self.executor_kind != 'process' else None
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                self.executor, _analyze_imagery, field_id, file_path, coordinates, missing, colormap, callback
+            )
+            if result.get('status') != 'success':
+                return result
+            computed = split_index_results(result)
+            for index_name, index_result in computed.items():
+                key = self.result_cache_key(field_id, imagery_hash, coordinates, index_name, colormap)
+                await asyncio.to_thread(self.overlay_cache.put, key + ('png',), index_result['overlays'][index_name])
+                index_result['overlays'][index_name] = self.overlay_url(field_id, index_name, key, colormap)
+                await asyncio.to_thread(self.imagery_cache.put, key, index_result)
+            self.schedule_pyramids(field_id, file_path, coordinates, tuple(computed))
+            return computed
+        
+        # Concurrent requests for the same indices share one run
+        key = (field_id, imagery_hash, coordinates_hash(coordinates), missing, colormap)
+        computed = await self.single_flight.run(f"analysis:{key!r}", analyze, recheck)
+        if computed.get('status') == 'error':
+            return computed
+        results.update(computed)
+        # Indices whose overlay failed to render are left out
+        merged = merge_index_results(results, tuple(index_name for index_name in indices if index_name in results))
+        return merged or {
+            'status': 'error',
+            'message': 'Failed to create overlays for the requested indices.'
+        }
+    
+    def encode_image(self, img: Image.Image, image_format: str) -> bytes:
+        return overlay_encoding.encode(img, image_format, self.png_compress_level,
+                                       self.webp_quality, self.webp_method)
+    
+    def overlay_url(self, field_id: str, index_name: str, key: Tuple, colormap: Optional[str] = None) -> str:
+        """
+        API path of an overlay image, in the format negotiated from the
+        client's Accept header. The version parameter changes with the
+        scene, boundary and index definition, so browsers can cache it.
+        """
+        url = f"/api/fields/{field_id}/overlays/{index_name}?v={overlay_version(key)}"
+        return f"{url}&colormap={colormap}" if colormap else url
+    
+    def get_overlay(self, field_id: str, drive_url: str, coordinates: Optional[List[Dict]],
+                    index_name: str, colormap: Optional[str] = None,
+                    image_format: str = 'png') -> Optional[Dict]:
+        """
+        Overlay image of an analyzed index for the cached scene, without
+        touching the network. Formats other than the palette PNG stored at
+        analysis time (see overlay_encoding.FORMATS) are encoded from it on
+        first request.
+        
+        Returns:
+            Dict with content bytes, media type and ETag, or None if the
+            index hasn't been analyzed for this scene and boundary
+        """
+        cached_file = self.file_cache.lookup(normalize_source(drive_url))
+        if not cached_file:
+            return None
+        key = self.result_cache_key(field_id, cached_file['digest'], coordinates, index_name, colormap)
+        content = self.overlay_cache.get(key + (image_format,))
+        if content is None and image_format != 'png':
+            png = self.overlay_cache.get(key + ('png',))
+            if png is None:
+                return None
+            content = self.encode_image(Image.open(io.BytesIO(png)), image_format)
+            self.overlay_cache.put(key + (image_format,), content)
+        if content is None:
+            return None
+        return image_payload(content, image_format)
+    
+    async def fetch_overlay(self, field_id: str, drive_url: str, coordinates: Optional[List[Dict]],
+                            index_name: str, colormap: Optional[str] = None,
+                            image_format: str = 'png', version: Optional[str] = None) -> Optional[Dict]:
+        """
+        get_overlay, re-rendering the overlay from the cached scene when it
+        has dropped out of the overlay cache (TTL or LRU) while an analysis
+        result still links to it. Only a URL's `version` for the current
+        scene, boundary and index definition does that, so an index that
+        was never analyzed still finds nothing.
+        """
+        overlay = await asyncio.to_thread(
+            self.get_overlay, field_id, drive_url, coordinates, index_name, colormap, image_format
+        )
+        if overlay is not None or version is None:
+            return overlay
+        cached_file = await asyncio.to_thread(self.file_cache.lookup, normalize_source(drive_url))
+        if not cached_file:
+            return None
+        key = self.result_cache_key(field_id, cached_file['digest'], coordinates, index_name, colormap)
+        if version != overlay_version(key):
+            return None
+        logger.info(f"Re-rendering expired {index_name} overlay for field {field_id}")
+        result = await self.analyze_scene(field_id, cached_file['path'], coordinates, (index_name,), colormap)
+        if result.get('status') != 'success':
+            return None
+        return await asyncio.to_thread(
+            self.get_overlay, field_id, drive_url, coordinates, index_name, colormap, image_format
+        )
+    
+    def render_tile(self, field_id: str, drive_url: str, coordinates: List[Dict],
+                    index_name: str, z: int, x: int, y: int,
+                    colormap: Optional[str] = None) -> Optional[Dict]:
+        """
+        XYZ map tile of an index over the field, rendered on demand from the
+        cached scene and kept in the tile cache. Only the part of the field
+        window under the tile is read, at about the tile's resolution, so
+        zooming in reaches full resolution without rendering whole scenes.
+        Tiles without field pixels get the shared empty tile without
+        touching the raster. Once the index pyramid is built, tiles read
+        one small block of its matching overview instead.
+        
+        Returns:
+            Dict with PNG content, media type and ETag, or None if the scene
+            hasn't been downloaded
+        """
+        west, south, east, north = tile_lnglat_bounds(z, x, y)
+        lngs = [float(c['lng']) for c in coordinates]
+        lats = [float(c['lat']) for c in coordinates]
+        if min(lngs) > east or max(lngs) < west or min(lats) > north or max(lats) < south:
+            return EMPTY_TILE
+        
+        cached_file = self.file_cache.lookup(normalize_source(drive_url))
+        if not cached_file:
+            return None
+        key = self.result_cache_key(field_id, cached_file['digest'], coordinates, index_name, colormap) + (z, x, y)
+        tile = self.tile_cache.get(key)
+        if tile is not None:
+            return image_payload(tile, 'png')
+        
+        dst_transform = from_bounds(*tile_bounds(z, x, y), TILE_SIZE, TILE_SIZE)
+        inside = geometry_mask([self.field_geometry(coordinates, 'EPSG:3857')], out_shape=(TILE_SIZE, TILE_SIZE),
+                               transform=dst_transform, invert=True)
+        if not inside.any():
+            return EMPTY_TILE
+        
+        pyramid = self.pyramid_path(field_id, cached_file['digest'], coordinates, index_name)
+        if os.path.exists(pyramid):
+            # The overview matching the zoom level already holds the values
+            with rasterio.open(pyramid) as src:
+                warped = self._warp_tile(src, [1], Window(0, 0, src.width, src.height), dst_transform,
+                                         TILE_SIZE, Resampling.nearest)
+            if warped is None:
+                return EMPTY_TILE
+            index_array = warped[0]
+        else:
+            bands = required_bands((index_name,))
+            with rasterio.open(cached_file['path']) as src:
+                field_window = self.field_window(src, coordinates)
+                # Twice the tile's resolution at most; finer source pixels are averaged away
+                warped = None if field_window is None else self._warp_tile(
+                    src, [self.band_map[band] for band in bands], field_window, dst_transform,
+                    2 * TILE_SIZE, Resampling[self.preview_resampling]
+                )
+            if warped is None:
+                return EMPTY_TILE
+            band_arrays = dict.fromkeys(BAND_NAMES)
+            band_arrays.update(zip(bands, warped))
+            index_array = compute_indices(**band_arrays, names=(index_name,))[index_name]
+        index_array[~inside] = np.nan
+        
+        tile = self.encode_image(overlay_encoding.palette_image(
+            colormaps.quantize(index_array), colormaps.get_lut(colormap or index_registry.colormap(index_name))
+        ), 'png')
+        self.tile_cache.put(key, tile)
+        return image_payload(tile, 'png')
+    
+    def _warp_tile(self, src, indexes: List[int], limit: Window, dst_transform: Affine,
+                   max_dimension: int, resampling: Resampling) -> Optional[np.ndarray]:
+        """
+        Bands of the raster under a tile, read within `limit` at most
+        max_dimension pixels across (GDAL picks the matching overview) and
+        reprojected onto the tile grid; NaN where there is no data. None
+        when the tile misses the limit window.
+        """
+        left, bottom, right, top = transform_bounds(
+            'EPSG:3857', src.crs, *array_bounds(TILE_SIZE, TILE_SIZE, dst_transform), densify_pts=21
+        )
+        inverse = ~src.transform
+        cols, rows = zip(*(inverse * corner for corner in
+                           [(left, bottom), (left, top), (right, bottom), (right, top)]))
+        col_start = max(int(limit.col_off), math.floor(min(cols)) - 1)
+        row_start = max(int(limit.row_off), math.floor(min(rows)) - 1)
+        col_stop = min(int(limit.col_off + limit.width), math.ceil(max(cols)) + 1)
+        row_stop = min(int(limit.row_off + limit.height), math.ceil(max(rows)) + 1)
+        if col_stop <= col_start or row_stop <= row_start:
+            return None
+        window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        
+        width, height = fit_dimensions(int(window.width), int(window.height), max_dimension)
+        data = src.read(
+            indexes=indexes,
+            window=window,
+            out_shape=(len(indexes), height, width),
+            resampling=resampling,
+            out_dtype=self.dtype
+        )
+        src_transform = src.window_transform(window) * Affine.scale(window.width / width, window.height / height)
+        warped = np.full((len(indexes), TILE_SIZE, TILE_SIZE), np.nan, self.dtype)
+        reproject(data, warped, src_transform=src_transform, src_crs=src.crs, src_nodata=src.nodata,
+                  dst_transform=dst_transform, dst_crs='EPSG:3857', dst_nodata=np.nan,
+                  resampling=Resampling.nearest)
+        return warped
+    
+    def pyramid_path(self, field_id: str, imagery_hash: str, coordinates: Optional[List[Dict]],
+                     index_name: str) -> str:
+        """Index pyramid file of a field, stored with the scene it was computed from"""
+        # Index values don't depend on the colormap, the last part of the key
+        key = self.result_cache_key(field_id, imagery_hash, coordinates, index_name)[:-1]
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()[:32]
+        return os.path.join(self.file_cache.pyramid_dir(imagery_hash), f"{field_id}-{digest}.tif")
+    
+    def build_pyramids(self, field_id: str, file_path: str, coordinates: Optional[List[Dict]],
+                       indices: Tuple[str, ...]):
+        """
+        Write each index over the field window at full resolution as a tiled
+        GeoTIFF with internal power-of-two overviews (NaN-aware averages)
+        down to a single tile, so map tiles at any zoom read one small block.
+        Computed chunk by chunk within the memory budget; indices that
+        already have a pyramid are skipped. Blocking.
+        """
+        imagery_hash = self.file_cache.digest_of(file_path)
+        paths = {index_name: self.pyramid_path(field_id, imagery_hash, coordinates, index_name)
+                 for index_name in indices}
+        indices = tuple(index_name for index_name in indices if not os.path.exists(paths[index_name]))
+        if not indices:
+            return
+        
+        with rasterio.open(file_path) as src:
+            bands = required_bands(indices)
+            indexes = [self.band_map[band] for band in bands]
+            window = Window(0, 0, src.width, src.height)
+            geometry = None
+            if coordinates and src.crs:
+                window = self.field_window(src, coordinates)
+                if window is None:
+                    return
+                geometry = self.field_geometry(coordinates, src.crs)
+            
+            width, height = int(window.width), int(window.height)
+            factors = []
+            while max(width, height) / (2 ** len(factors)) > TILE_SIZE:
+                factors.append(2 ** (len(factors) + 1))
+            profile = {
+                'driver': 'GTiff', 'width': width, 'height': height, 'count': 1,
+                'dtype': self.dtype.name, 'crs': src.crs, 'transform': src.window_transform(window),
+                'nodata': np.nan, 'tiled': True, 'blockxsize': TILE_SIZE, 'blockysize': TILE_SIZE,
+                'compress': 'deflate', 'predictor': 3
+            }
+            
+            itemsize = self.dtype.itemsize
+            bytes_per_pixel = itemsize * (len(indexes) + index_registry.compile(indices).buffers) + 16
+            os.makedirs(os.path.dirname(paths[indices[0]]), exist_ok=True)
+            temp_paths = {index_name: f"{paths[index_name]}.{os.getpid()}-{threading.get_ident()}.tmp"
+                          for index_name in indices}
+            outputs = {index_name: rasterio.open(temp_paths[index_name], 'w', **profile) for index_name in indices}
+            try:
+                for chunk in plan_chunks(src, window, bytes_per_pixel, self.memory_budget):
+                    data = src.read(indexes=indexes, window=chunk, out_dtype=self.dtype)
+                    values, _ = self._chunk_indices(src, data, chunk, geometry, bands, indices)
+                    target = Window(chunk.col_off - window.col_off, chunk.row_off - window.row_off,
+                                    chunk.width, chunk.height)
+                    for index_name, output in outputs.items():
+                        output.write(values[index_name], 1, window=target)
+                for index_name, output in outputs.items():
+                    if factors:
+                        output.build_overviews(factors, Resampling.average)
+                    output.close()
+                    # Atomic, so tiles never read a half-written pyramid
+                    os.replace(temp_paths[index_name], paths[index_name])
+            finally:
+                for index_name, output in outputs.items():
+                    output.close()
+                    if os.path.exists(temp_paths[index_name]):
+                        os.unlink(temp_paths[index_name])
+        
+        # Pyramids share the scene's cache budget
+        self.file_cache.update_derived_size(imagery_hash)
+        logger.info(f"Built {', '.join(indices)} pyramids of {width}x{height} with overviews {factors} for field {field_id}")
+    
+    def schedule_pyramids(self, field_id: str, file_path: str, coordinates: Optional[List[Dict]],
+                          indices: Tuple[str, ...]):
+        """
+        Build index pyramids in the background, after the analysis has
+        returned. Indices scheduled for the same field and scene within
+        pyramid_delay are built together.
+        """
+        if not self.pyramids or not indices:
+            return
+        
+        key = (field_id, self.file_cache.digest_of(file_path), coordinates_hash(coordinates))
+        pending = self._pending_pyramids.get(key)
+        if pending is not None:
+            pending.update(indices)
+            return
+        self._pending_pyramids[key] = set(indices)
+        
+        async def run():
+            await asyncio.sleep(self.pyramid_delay)
+            pending = self._pending_pyramids.pop(key)
+            batch = tuple(index_name for index_name in index_registry.names if index_name in pending)
+            
+            async def build():
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.pyramid_executor, _build_pyramids, field_id, file_path, coordinates, batch)
+            
+            try:
+                await self.single_flight.run(f"pyramids:{key + (batch,)!r}", build)
+            except Exception as e:
+                logger.error(f"Error building index pyramids for field {field_id}: {str(e)}")
+        
+        task = asyncio.create_task(run())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    def invalidate_field(self, field_id: str):
+        """Drop cached analyses, overlays, tiles and index pyramids of a field"""
+        self.imagery_cache.invalidate_field(field_id)
+        self.overlay_cache.invalidate_field(field_id)
+        self.tile_cache.invalidate_field(field_id)
+        digests = set()
+        for pyramid in glob.glob(os.path.join(self.file_cache.cache_dir, 'pyramids', '*', f"{field_id}-*.tif")):
+            try:
+                os.unlink(pyramid)
+            except OSError:
+                pass
+            digests.add(os.path.basename(os.path.dirname(pyramid)))
+        for digest in digests:
+            self.file_cache.update_derived_size(digest)
+
+
+def statistics_resolution(metadata: Dict, streamed: bool) -> Dict:
+    """
+    What an analysis' statistics were taken over: native pixels (streamed,
+    or a window read without decimation), or preview pixels that each
+    average about pixel_scale x pixel_scale native ones, in which case
+    'count' counts preview pixels too
+    """
+    window_width, window_height = metadata['window'][2:]
+    scale = 1.0 if streamed else max(window_width / metadata['width'], window_height / metadata['height'])
+    return {'native': scale == 1.0, 'pixel_scale': round(scale, 3)}
+
+
+def split_index_results(result: Dict) -> Dict[str, Dict]:
+    """Split an analysis result into one cacheable result per index"""
+    return {
+        index_name: {
+            **result,
+            'overlays': {index_name: overlay},
+            'statistics': {index_name: result['statistics'][index_name]},
+            'colormaps': {index_name: result['colormaps'][index_name]},
+            'indices': [index_name]
+        }
+        for index_name, overlay in result['overlays'].items()
+    }
+
+
+def merge_index_results(results: Dict[str, Dict], indices: Tuple[str, ...]) -> Optional[Dict]:
+    """Combine per-index results into one analysis, or None if any is missing"""
+    if not indices or any(index_name not in results for index_name in indices):
+        return None
+    merged = dict(results[indices[0]])
+    merged['overlays'] = {index_name: results[index_name]['overlays'][index_name] for index_name in indices}
+    merged['statistics'] = {index_name: results[index_name].get('statistics', {}).get(index_name) for index_name in indices}
+    merged['colormaps'] = {index_name: results[index_name].get('colormaps', {}).get(index_name) for index_name in indices}
+    merged['indices'] = list(indices)
+    return merged
+
+
+def _lower_priority():
+    """
+    Pool initializer lowering the worker's CPU priority. On Linux this
+    applies to the calling thread only, so it also works for thread pools.
+    """
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PYRAMID_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+
+def _build_pyramids(field_id: str, file_path: str, coordinates: Optional[List[Dict]],
+                    indices: Tuple[str, ...]):
+    """Executor entry point for build_pyramids, like _analyze_imagery"""
+    imagery_service.build_pyramids(field_id, file_path, coordinates, indices)
+
+
+def _analyze_imagery(field_id: str, file_path: str, coordinates: Optional[List[Dict]] = None,
+                     indices: Optional[Tuple[str, ...]] = None,
+                     colormap: Optional[str] = None,
+                     progress: Optional[Callable[[int, str], None]] = None) -> Dict:
+    """
+    Executor entry point. Module level so it can be pickled for a process pool,
+    where each worker process uses its own global service instance.
+    """
+    return imagery_service.analyze_imagery(field_id, file_path, coordinates, indices, colormap, progress)
+
 
 # Global instance
 imagery_service = ImageryService()
@@ -0,0 +1,211 @@
+"""
+Out-of-Core Imagery Processing
+Streams a raster window block by block, so memory is bounded by a budget
+rather than by the size of the scene
+"""
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from rasterio.windows import Window
+
+logger = logging.getLogger(__name__)
+
+
+# Percentiles reported for every index, estimated from the histogram
+PERCENTILES = (5, 10, 25, 50, 75, 90, 95)
+
+
+class RunningStats:
+    """
+    Summary statistics of a stream of arrays in one pass per array: count,
+    mean and standard deviation (merged batch by batch, Chan et al., in
+    float64), min, max, and a fixed-bin histogram over `value_range` from
+    which percentiles are interpolated. Values outside the range land in
+    the edge bins; min and max stay exact. NaNs (outside the field) and
+    infinities (near-zero denominators) are ignored.
+    """
+
+    def __init__(self, bins: int = 100, value_range: Tuple[float, float] = (-1.0, 1.0)):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.value_range = value_range
+        self.histogram = np.zeros(bins, np.int64)
+
+    def update(self, values: np.ndarray):
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        count = values.size
+        mean = float(np.mean(values, dtype=np.float64))
+        m2 = float(np.sum(np.square(values - mean, dtype=np.float64)))
+        delta = mean - self.mean
+        total = self.count + count
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        low, high = self.value_range
+        bins = self.histogram.size
+        positions = (values - low) * (bins / (high - low))
+        np.clip(positions, 0, bins - 1, out=positions)
+        self.histogram += np.bincount(positions.astype(np.intp), minlength=bins)
+
+    def percentile(self, q: float) -> float:
+        """Percentile interpolated linearly within its histogram bin"""
+        low, high = self.value_range
+        width = (high - low) / self.histogram.size
+        target = q / 100 * self.count
+        cumulative = np.cumsum(self.histogram)
+        position = int(np.searchsorted(cumulative, target, side='left'))
+        position = min(position, self.histogram.size - 1)
+        before = cumulative[position - 1] if position else 0
+        within = (target - before) / self.histogram[position] if self.histogram[position] else 0.0
+        value = low + (position + within) * width
+        return float(min(max(value, self.min), self.max))
+
+    def result(self) -> Dict:
+        if not self.count:
+            return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None,
+                    'percentiles': {}, 'histogram': None}
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'std': (self.m2 / self.count) ** 0.5,
+            'min': self.min,
+            'max': self.max,
+            'percentiles': {f"p{q}": self.percentile(q) for q in PERCENTILES},
+            'histogram': {
+                'range': list(self.value_range),
+                'counts': self.histogram.tolist()
+            }
+        }
+
+
+class PreviewAccumulator:
+    """
+    Area-average (NaN-aware) downsampling of a full resolution window into
+    a fixed preview grid, fed one chunk at a time in any order
+    """
+
+    def __init__(self, window_shape: Tuple[int, int], preview_shape: Tuple[int, int]):
+        self.window_shape = window_shape
+        self.preview_shape = preview_shape
+        self.sum = np.zeros(preview_shape, np.float64)
+        self.count = np.zeros(preview_shape, np.float64)
+
+    def add(self, values: np.ndarray, row_off: int, col_off: int):
+        """Add a chunk whose top left pixel is at (row_off, col_off) in the window"""
+        valid = ~np.isnan(values)
+        row_starts, rows = self._groups(row_off, values.shape[0], 0)
+        col_starts, cols = self._groups(col_off, values.shape[1], 1)
+        sums = np.add.reduceat(np.add.reduceat(np.where(valid, values, 0), row_starts, axis=0), col_starts, axis=1)
+        counts = np.add.reduceat(np.add.reduceat(valid.astype(np.float32), row_starts, axis=0), col_starts, axis=1)
+        self.sum[np.ix_(rows, cols)] += sums
+        self.count[np.ix_(rows, cols)] += counts
+
+    def _groups(self, offset: int, length: int, axis: int):
+        """Chunk positions where a new preview pixel starts, and those pixels"""
+        targets = np.arange(offset, offset + length) * self.preview_shape[axis] // self.window_shape[axis]
+        starts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+        return starts, targets[starts]
+
+    def result(self, dtype) -> np.ndarray:
+        """Mean per preview pixel, NaN where no valid pixel contributed"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.sum / self.count, np.nan).astype(dtype)
+
+
+def downsample(values: np.ndarray, shape: Tuple[int, int], dtype=None) -> np.ndarray:
+    """
+    NaN-aware area mean of a 2-D array onto a smaller grid. Rows are fed in
+    strips of about a million pixels, so temporaries stay strip-sized.
+    """
+    accumulator = PreviewAccumulator(values.shape, shape)
+    rows = max(1, (1 << 20) // values.shape[1])
+    for row_off in range(0, values.shape[0], rows):
+        accumulator.add(values[row_off:row_off + rows], row_off, 0)
+    return accumulator.result(dtype or values.dtype)
+
+
+def plan_chunks(src, window: Window, bytes_per_pixel: int, budget: int) -> List[Window]:
+    """
+    Group the raster's native blocks that overlap the window into chunks
+    of at most `budget` bytes of working memory: whole block rows, merged
+    while they fit, otherwise runs of blocks within a block row. A single
+    block is the smallest chunk, whatever the budget.
+    """
+    max_pixels = max(1, budget // bytes_per_pixel)
+    rows: Dict[int, List[Window]] = {}
+    for _, block in src.block_windows(1):
+        try:
+            clipped = block.intersection(window)
+        except Exception:  # WindowError: no overlap
+            continue
+        if clipped.width > 0 and clipped.height > 0:
+            rows.setdefault(int(clipped.row_off), []).append(clipped)
+
+    chunks: List[Window] = []
+    pending: Optional[Window] = None
+    for row_off in sorted(rows):
+        blocks = sorted(rows[row_off], key=lambda block: block.col_off)
+        band = Window(window.col_off, row_off, window.width, blocks[0].height)
+        if band.width * band.height <= max_pixels:
+            if pending is not None and band.width * (pending.height + band.height) <= max_pixels:
+                pending = Window(pending.col_off, pending.row_off, pending.width, pending.height + band.height)
+            else:
+                if pending is not None:
+                    chunks.append(pending)
+                pending = band
+            continue
+        if pending is not None:
+            chunks.append(pending)
+            pending = None
+        run = blocks[0]
+        for block in blocks[1:]:
+            if (run.width + block.width) * run.height <= max_pixels:
+                run = Window(run.col_off, run.row_off, run.width + block.width, run.height)
+            else:
+                chunks.append(run)
+                run = block
+        chunks.append(run)
+    if pending is not None:
+        chunks.append(pending)
+    return chunks
+
+
+def stream_window(src, window: Window, band_indexes: List[int], chunks: Iterable[Window], dtype,
+                  compute: Callable[[np.ndarray, Window], Dict[str, np.ndarray]],
+                  preview_shape: Tuple[int, int],
+                  progress: Optional[Callable[[float], None]] = None,
+                  histogram_bins: int = 100) -> Tuple[Dict[str, np.ndarray], Dict[str, Dict]]:
+    """
+    Read the chunks one at a time, compute index arrays for each with
+    `compute(bands, chunk)` and fold them into running statistics and
+    downsampled previews. Returns (previews, statistics) per index.
+    """
+    chunks = list(chunks)
+    window_shape = (int(window.height), int(window.width))
+    accumulators: Dict[str, PreviewAccumulator] = {}
+    stats: Dict[str, RunningStats] = {}
+    for position, chunk in enumerate(chunks):
+        bands = src.read(indexes=band_indexes, window=chunk, out_dtype=dtype)
+        values = compute(bands, chunk)
+        del bands
+        row_off, col_off = int(chunk.row_off - window.row_off), int(chunk.col_off - window.col_off)
+        for name, array in values.items():
+            if name not in accumulators:
+                accumulators[name] = PreviewAccumulator(window_shape, preview_shape)
+                stats[name] = RunningStats(histogram_bins)
+            accumulators[name].add(array, row_off, col_off)
+            stats[name].update(array)
+        del values
+        if progress:
+            progress((position + 1) / len(chunks))
+    previews = {name: accumulator.result(dtype) for name, accumulator in accumulators.items()}
+    return previews, {name: running.result() for name, running in stats.items()}
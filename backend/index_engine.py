@@ -0,0 +1,563 @@
+"""
+Vegetation Index Engine
+Indices are declared as band-algebra expressions and compiled once per set
+of requested indices into fused kernels that share common subexpressions
+"""
+import os
+import ast
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from colormaps import DEFAULT_COLORMAP, get_lut
+
+try:
+    import numexpr
+except ImportError:  # pure-NumPy fallback
+    numexpr = None
+
+logger = logging.getLogger(__name__)
+
+# Avoid division by zero
+EPSILON = 1e-10
+
+BAND_NAMES = ('blue', 'green', 'red', 'nir')
+
+
+def usable_cpus() -> int:
+    """CPUs this process may run on, which in a container can be fewer than the host's"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS / Windows
+        return os.cpu_count() or 1
+
+
+# The NumPy kernel runs over row strips of about this many pixels, in
+# parallel: ufuncs release the GIL, and strip-sized temporaries stay in cache
+STRIP_PIXELS = int(os.environ.get('IMAGERY_INDEX_STRIP_PIXELS', str(64 * 1024)))
+STRIP_THREADS = int(os.environ.get('IMAGERY_INDEX_THREADS', str(usable_cpus())))
+
+# 'numpy' (the strip kernel) or 'numexpr', which is opt-in: on the built-in
+# indices it benchmarks slower than the NumPy kernel (see benchmark_imagery.py)
+ENGINE = os.environ.get('IMAGERY_INDEX_ENGINE', 'numpy').lower()
+if ENGINE == 'numexpr' and numexpr is None:
+    logger.warning("IMAGERY_INDEX_ENGINE=numexpr but numexpr is not installed, using NumPy")
+
+# Functions available in index expressions
+FUNCTIONS = {
+    'sqrt': np.sqrt,
+    'abs': np.absolute,
+    'exp': np.exp,
+    'log': np.log
+}
+
+BINARY_OPERATORS = {ast.Add: 'add', ast.Sub: 'sub', ast.Mult: 'mul', ast.Div: 'div', ast.Pow: 'pow'}
+UFUNCS = {
+    'add': np.add,
+    'sub': np.subtract,
+    'mul': np.multiply,
+    'div': np.divide,
+    'pow': np.power,
+    'neg': np.negative,
+    **FUNCTIONS
+}
+NUMEXPR_OPERATORS = {'add': '+', 'sub': '-', 'mul': '*', 'div': '/', 'pow': '**'}
+COMMUTATIVE = {'add', 'mul'}
+
+# Divisions get EPSILON added to the denominator, so it is left out here.
+# Expressions may refer to indices registered before them.
+BUILTIN_INDICES = (
+    ('ndvi', '(nir - red) / (nir + red)', 'Normalized Difference Vegetation Index'),
+    ('gndvi', '(nir - green) / (nir + green)', 'Green NDVI'),
+    ('ndwi', '-gndvi', 'Normalized Difference Water Index, (green - nir) / (green + nir)'),
+    ('evi', '2.5 * ((nir - red) / (nir + 6 * red - 7.5 * blue + 1))', 'Enhanced Vegetation Index'),
+    ('savi', '(nir - red) / (nir + red + 0.5) * 1.5', 'Soil Adjusted Vegetation Index'),
+    # True NDRE needs a red-edge band, which SkySat doesn't have
+    ('ndre', 'ndvi', 'Normalized Difference Red Edge, approximated by NDVI'),
+    ('msavi', '(2 * nir + 1 - sqrt((2 * nir + 1) ** 2 - 8 * (nir - red))) / 2',
+     'Modified Soil Adjusted Vegetation Index'),
+    ('osavi', '1.16 * ((nir - red) / (nir + red + 0.16))', 'Optimized Soil Adjusted Vegetation Index')
+)
+
+# Built-in indices can't be redefined: the health index is derived from NDVI
+BUILTIN_NAMES = frozenset(name for name, _, _ in BUILTIN_INDICES)
+
+# Overlay colormaps of indices not rendered with DEFAULT_COLORMAP
+BUILTIN_COLORMAPS = {'ndwi': 'brown-white-blue'}
+
+# Expression trees are nested tuples, so identical subexpressions compare
+# and hash equal: ('band', 'nir'), ('const', 0.5), ('sub', left, right), ...
+Node = Tuple
+
+
+def parse_expression(expression: str, resolve: Optional[Callable[[str], Node]] = None) -> Node:
+    """
+    Parse a band-algebra expression such as "(nir - red) / (nir + red)"
+    into a canonical expression tree. `resolve` maps other names (e.g.
+    registered indices) to their trees.
+
+    Raises:
+        ValueError: for syntax errors, unknown names or unsupported operations
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Invalid index expression '{expression}': {e.msg}")
+    node = _build(tree.body, resolve)
+    if not _bands_of(node):
+        raise ValueError(f"Index expression '{expression}' does not use any band")
+    return node
+
+
+def _build(tree: ast.AST, resolve) -> Node:
+    if isinstance(tree, ast.Constant) and isinstance(tree.value, (int, float)) and not isinstance(tree.value, bool):
+        return ('const', float(tree.value))
+    if isinstance(tree, ast.Name):
+        if tree.id in BAND_NAMES:
+            return ('band', tree.id)
+        if resolve is not None:
+            return resolve(tree.id)
+        raise ValueError(f"Unknown name '{tree.id}' in index expression")
+    if isinstance(tree, ast.BinOp) and type(tree.op) in BINARY_OPERATORS:
+        return _node(BINARY_OPERATORS[type(tree.op)], _build(tree.left, resolve), _build(tree.right, resolve))
+    if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, (ast.USub, ast.UAdd)):
+        operand = _build(tree.operand, resolve)
+        return _node('neg', operand) if isinstance(tree.op, ast.USub) else operand
+    if (isinstance(tree, ast.Call) and isinstance(tree.func, ast.Name) and tree.func.id in FUNCTIONS
+            and len(tree.args) == 1 and not tree.keywords):
+        return _node(tree.func.id, _build(tree.args[0], resolve))
+    raise ValueError(f"Unsupported operation in index expression: '{ast.unparse(tree)}'")
+
+
+def _node(op: str, *children: Node) -> Node:
+    """Build a node in canonical form, folding constants"""
+    if all(child[0] == 'const' for child in children):
+        with np.errstate(all='ignore'):
+            return ('const', float(UFUNCS[op](*(child[1] for child in children))))
+    if op == 'div' and children[1][0] != 'const':
+        children = (children[0], _node('add', children[1], ('const', EPSILON)))
+    if op == 'neg' and children[0][0] == 'neg':
+        return children[0][1]
+    if op == 'pow' and children[1] == ('const', 2.0):
+        return _node('mul', children[0], children[0])
+    if op in COMMUTATIVE:
+        # (x + c1) + c2 -> x + (c1 + c2), so shared denominators stay shared
+        constant = next((child for child in children if child[0] == 'const'), None)
+        other = children[1] if constant is children[0] else children[0]
+        if constant is not None and other[0] == op and other[2][0] == 'const':
+            return _node(op, other[1], _node(op, other[2], constant))
+        # Constants last, otherwise a stable order, so a + b and b + a match
+        children = tuple(sorted(children, key=lambda child: (child[0] == 'const', repr(child))))
+    return (op,) + tuple(children)
+
+
+def _bands_of(node: Node) -> set:
+    if node[0] == 'band':
+        return {node[1]}
+    if node[0] == 'const':
+        return set()
+    return set().union(*(_bands_of(child) for child in node[1:]))
+
+
+def _is_leaf(node: Node) -> bool:
+    return node[0] in ('band', 'const')
+
+
+def _size(node: Node) -> int:
+    return 1 if _is_leaf(node) else 1 + sum(_size(child) for child in node[1:])
+
+
+class IndexProgram:
+    """
+    Kernel computing one set of indices, compiled once and reused
+
+    The NumPy kernel evaluates every distinct subexpression once, in place,
+    with buffers recycled as soon as their last consumer has run. It works
+    through row strips on a thread pool, each strip writing straight into
+    the preallocated outputs. The numexpr kernel evaluates each index in a
+    single multithreaded (it does its own blocking), GIL-free pass, after
+    computing the subexpressions that several indices share into full-size
+    temporaries, and reuses indices that others are built from.
+    """
+
+    def __init__(self, outputs: Dict[str, Node]):
+        self.outputs = outputs
+        self.bands = tuple(band for band in BAND_NAMES
+                           if any(band in _bands_of(node) for node in outputs.values()))
+        # Smaller indices first: they are often parts of larger ones (ndwi = -gndvi)
+        self._roots = sorted({node for node in outputs.values() if not _is_leaf(node)}, key=_size)
+        self._schedule()
+        self._compile_numexpr()
+
+    def _schedule(self):
+        """
+        Order the distinct subexpressions and assign them to buffers. Indices
+        that share subexpressions are computed next to each other so the
+        shared temporaries are freed early; of a few such orders, the one
+        needing the fewest buffers wins.
+        """
+        subtrees = {root: _subtrees(root) for root in self._roots}
+        candidates = [list(self._roots)]
+        for first in self._roots:
+            order, done = [first], set(subtrees[first])
+            while len(order) < len(self._roots):
+                following = max((root for root in self._roots if root not in order),
+                                key=lambda root: (len(subtrees[root] & done), -_size(root)))
+                order.append(following)
+                done |= subtrees[following]
+            candidates.append(order)
+        self._steps, self._slots, self.buffers = min(
+            (_allocate_buffers(order, set(self._roots)) for order in candidates),
+            key=lambda schedule: schedule[2]
+        )
+
+    def _compile_numexpr(self):
+        """
+        numexpr sources for the indices and the subexpressions shared by more
+        than one of them, smallest first so each can refer to earlier ones by
+        name. Constants become named variables, so float32 data is evaluated
+        in float32 rather than promoted by float64 literals.
+        """
+        computed = set(self._roots)
+        while True:
+            uses = Counter(node for root in computed for node in _subtrees(root, stop=computed - {root}))
+            shared = [node for node, count in uses.items() if count > 1 and node not in computed]
+            if not shared:
+                break
+            # Largest first: its own parts are then only shared if used elsewhere too
+            computed.add(max(shared, key=_size))
+
+        names: Dict[Node, str] = {}
+        last_use: Dict[Node, int] = {}
+        self._constants: Dict[str, float] = {}
+        self._expressions = []
+        for position, node in enumerate(sorted(computed, key=_size)):
+            source = _numexpr_source(node, names, self._constants)
+            for operand in _subtrees(node, stop=computed - {node}) & computed - {node}:
+                last_use[operand] = position
+            names[node] = f"index_{len(names)}"
+            self._expressions.append((node, names[node], source))
+        # Shared temporaries are released after the last expression reading them
+        self._release = [[names[node] for node, last in last_use.items()
+                          if last == position and node not in self._roots]
+                         for position in range(len(self._expressions))]
+
+    def evaluate(self, bands: Dict[str, np.ndarray], use_numexpr: Optional[bool] = None) -> Dict[str, np.ndarray]:
+        """Compute the indices from a dict of same-shaped band arrays"""
+        missing = [band for band in self.bands if bands.get(band) is None]
+        if missing:
+            raise ValueError(f"Missing bands for {', '.join(self.outputs)}: {', '.join(missing)}")
+        inputs = [bands[band] for band in self.bands]
+        shape, dtype = inputs[0].shape, np.result_type(*inputs)
+        if use_numexpr is None:
+            use_numexpr = ENGINE == 'numexpr' and numexpr is not None
+        if use_numexpr:
+            values = self._evaluate_numexpr(bands, shape, dtype)
+        else:
+            values = self._evaluate_numpy(bands, shape, dtype)
+
+        results = {}
+        for name, node in self.outputs.items():
+            if node[0] == 'band':
+                results[name] = bands[node[1]].astype(dtype)
+            else:
+                results[name] = values[node]
+        return results
+
+    def _evaluate_numpy(self, bands, shape, dtype) -> Dict[Node, np.ndarray]:
+        if not self._roots:
+            # Only bare bands were requested; evaluate copies those
+            return {}
+        outputs = {node: np.empty(shape, dtype) for node in self._roots}
+        rows = shape[0] if shape else 1
+        row_pixels = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+        step = max(1, STRIP_PIXELS // max(row_pixels, 1))
+        strips = [slice(start, min(start + step, rows)) for start in range(0, rows, step)]
+
+        def run(strip):
+            self._evaluate_strip(bands, outputs, strip, dtype)
+
+        if len(strips) <= 1 or STRIP_THREADS <= 1:
+            for strip in strips or [slice(None)]:
+                run(strip)
+        else:
+            # list() re-raises the first error from any strip
+            list(_strip_executor().map(run, strips))
+        return outputs
+
+    def _evaluate_strip(self, bands, outputs: Dict[Node, np.ndarray], strip: slice, dtype):
+        # Outputs are computed straight into their strip of the result;
+        # everything else goes into strip-sized scratch buffers
+        buffers: List[Optional[np.ndarray]] = [None] * self.buffers
+        for node in self._roots:
+            buffers[self._slots[node]] = outputs[node][strip]
+        shape = next(iter(outputs.values()))[strip].shape
+        scratch = iter(_scratch_buffers(sum(buffer is None for buffer in buffers), shape, dtype))
+        buffers = [buffer if buffer is not None else next(scratch) for buffer in buffers]
+        inputs = {band: bands[band][strip] for band in self.bands}
+
+        def operand(ref):
+            kind, value = ref
+            if kind == 'band':
+                return inputs[value]
+            if kind == 'const':
+                return value
+            return buffers[value]
+
+        # errstate is per thread; zero denominators give inf/NaN like numexpr
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for ufunc, operands, slot in self._steps:
+                ufunc(*(operand(ref) for ref in operands), out=buffers[slot])
+
+    def _evaluate_numexpr(self, bands, shape, dtype) -> Dict[Node, np.ndarray]:
+        variables = {band: bands[band] for band in self.bands}
+        # 0-d arrays, which numexpr treats as scalars of their dtype
+        variables.update({name: np.array(value, dtype) for name, value in self._constants.items()})
+        values = {}
+        for position, (node, name, source) in enumerate(self._expressions):
+            out = np.empty(shape, dtype)
+            # same_kind lets integer bands write into float outputs
+            numexpr.evaluate(source, local_dict=variables, out=out, casting='same_kind')
+            variables[name] = values[node] = out
+            for released in self._release[position]:
+                del variables[released]
+        return values
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_scratch = threading.local()
+
+
+def _strip_executor() -> ThreadPoolExecutor:
+    """Pool shared by all kernels, created on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=STRIP_THREADS, thread_name_prefix='index-strip')
+        return _executor
+
+
+def _reset_after_fork():
+    """
+    A forked child inherits the pool object but none of its threads (and
+    maybe a held lock), so it would wait on strips forever: start afresh
+    """
+    global _executor, _executor_lock, _scratch
+    _executor = None
+    _executor_lock = threading.Lock()
+    _scratch = threading.local()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _scratch_buffers(count: int, shape: Tuple[int, ...], dtype) -> List[np.ndarray]:
+    """Per-thread scratch buffers, reused across strips of the same size"""
+    key = (shape, np.dtype(dtype))
+    buffers = getattr(_scratch, 'buffers', {}).get(key, [])
+    if len(buffers) < count:
+        buffers = buffers + [np.empty(shape, dtype) for _ in range(count - len(buffers))]
+        # Only the latest strip size is kept, so this stays a few MiB
+        _scratch.buffers = {key: buffers}
+    return buffers[:count]
+
+
+def _subtrees(node: Node, stop: FrozenSet[Node] = frozenset()) -> set:
+    """Distinct non-leaf subtrees of a node, not descending into `stop`"""
+    if _is_leaf(node):
+        return set()
+    if node in stop:
+        return {node}
+    return {node}.union(*(_subtrees(child, stop) for child in node[1:]))
+
+
+def _allocate_buffers(roots: List[Node], pinned: set) -> Tuple[List, Dict[Node, int], int]:
+    """
+    Evaluation steps computing every distinct subexpression of the roots
+    once, with a buffer released as soon as its last consumer has run
+    """
+    order: List[Node] = []
+    seen = set()
+
+    def visit(node):
+        if _is_leaf(node) or node in seen:
+            return
+        seen.add(node)
+        for child in node[1:]:
+            visit(child)
+        order.append(node)
+
+    for root in roots:
+        visit(root)
+
+    remaining = Counter(child for node in order for child in set(node[1:]) if not _is_leaf(child))
+    slots: Dict[Node, int] = {}
+    steps = []
+    buffers = 0
+    free: List[int] = []
+    for node in order:
+        operands = [child if _is_leaf(child) else ('slot', slots[child]) for child in node[1:]]
+        # Operands used for the last time can take the result in place
+        for child in set(node[1:]):
+            if not _is_leaf(child):
+                remaining[child] -= 1
+                if remaining[child] == 0 and child not in pinned:
+                    free.append(slots[child])
+        if free:
+            slots[node] = free.pop()
+        else:
+            slots[node] = buffers
+            buffers += 1
+        steps.append((UFUNCS[node[0]], operands, slots[node]))
+    return steps, slots, buffers
+
+
+def _numexpr_source(node: Node, names: Dict[Node, str], constants: Dict[str, float]) -> str:
+    """
+    numexpr source for a tree, referring to already computed subexpressions
+    by name and to constants through variables added to `constants`
+    """
+    if node in names:
+        return names[node]
+    kind = node[0]
+    if kind == 'band':
+        return node[1]
+    if kind == 'const':
+        name = next((name for name, value in constants.items() if value == node[1]), None)
+        if name is None:
+            name = f"const_{len(constants)}"
+            constants[name] = node[1]
+        return name
+    args = [_numexpr_source(child, names, constants) for child in node[1:]]
+    if kind in NUMEXPR_OPERATORS:
+        return f"({args[0]} {NUMEXPR_OPERATORS[kind]} {args[1]})"
+    if kind == 'neg':
+        return f"(-{args[0]})"
+    return f"{kind}({args[0]})"
+
+
+class IndexRegistry:
+    """
+    Named index definitions and the kernels compiled from them
+
+    Each distinct set of requested indices is compiled once; cached
+    programs are dropped whenever an index is registered.
+    """
+
+    def __init__(self):
+        self._definitions: Dict[str, Dict] = {}
+        self._programs: Dict[FrozenSet[str], IndexProgram] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, expression: str, description: str = '',
+                 colormap: str = DEFAULT_COLORMAP):
+        """
+        Declare an index as a band-algebra expression over blue, green, red
+        and nir, using + - * / **, sqrt, abs, exp, log and indices
+        registered before it, and the colormap its overlay uses by default
+
+        Raises:
+            ValueError: for invalid names, expressions or colormaps, or a
+                built-in name that is already registered
+        """
+        name = name.strip().lower()
+        if not name.isidentifier() or name in BAND_NAMES or name in FUNCTIONS:
+            raise ValueError(f"Invalid index name '{name}'")
+        if name in BUILTIN_NAMES and name in self._definitions:
+            raise ValueError(f"'{name}' is a built-in index and can't be redefined")
+        node = parse_expression(expression, self._resolve)
+        get_lut(colormap)
+        with self._lock:
+            self._definitions[name] = {
+                'name': name,
+                'expression': expression,
+                'description': description,
+                'colormap': colormap,
+                'bands': [band for band in BAND_NAMES if band in _bands_of(node)],
+                'node': node
+            }
+            self._programs.clear()
+        logger.info(f"Registered index {name} = {expression}")
+
+    def _resolve(self, name: str) -> Node:
+        definition = self._definitions.get(name)
+        if definition is None:
+            raise ValueError(f"Unknown name '{name}' in index expression")
+        return definition['node']
+
+    @property
+    def names(self) -> Tuple[str, ...]:
+        return tuple(self._definitions)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._definitions
+
+    def definitions(self) -> List[Dict]:
+        """Name, expression, description, colormap and bands of every registered index"""
+        return [{key: value for key, value in definition.items() if key != 'node'}
+                for definition in self._definitions.values()]
+
+    def colormap(self, name: str) -> str:
+        return self._definitions[name]['colormap']
+
+    def signature(self, name: str) -> str:
+        """Canonical form of an index; changes whenever its definition does"""
+        return repr(self._definitions[name]['node'])
+
+    def validate(self, names: Iterable[str]) -> Tuple[str, ...]:
+        names = tuple(dict.fromkeys(names))
+        unknown = [name for name in names if name not in self._definitions]
+        if unknown:
+            raise ValueError(f"Unknown indices: {', '.join(unknown)}")
+        return names
+
+    def required_bands(self, names: Iterable[str]) -> Tuple[str, ...]:
+        """Bands needed to compute the given indices, in BAND_NAMES order"""
+        needed = {band for name in self.validate(names) for band in self._definitions[name]['bands']}
+        return tuple(band for band in BAND_NAMES if band in needed)
+
+    def compile(self, names: Iterable[str]) -> IndexProgram:
+        names = self.validate(names)
+        key = frozenset(names)
+        with self._lock:
+            program = self._programs.get(key)
+            if program is None:
+                program = IndexProgram({name: self._definitions[name]['node'] for name in names})
+                self._programs[key] = program
+        return program
+
+
+registry = IndexRegistry()
+for _name, _expression, _description in BUILTIN_INDICES:
+    registry.register(_name, _expression, _description, BUILTIN_COLORMAPS.get(_name, DEFAULT_COLORMAP))
+
+
+def required_bands(names: Iterable[str]) -> Tuple[str, ...]:
+    return registry.required_bands(names)
+
+
+def compute_indices(blue: Optional[np.ndarray], green: Optional[np.ndarray],
+                    red: Optional[np.ndarray], nir: np.ndarray,
+                    names: Optional[Iterable[str]] = None,
+                    use_numexpr: Optional[bool] = None) -> Dict[str, np.ndarray]:
+    """
+    Compute the requested registered indices (all by default) for
+    same-shaped bands. Bands that none of the requested indices use (see
+    required_bands) may be None.
+
+    Only what was asked for is computed, and subexpressions shared by the
+    requested indices (nir - red, nir + red, ...) are computed once.
+    Indices with identical definitions, like NDRE and NDVI, share one
+    array. Uses the NumPy strip kernel, or numexpr when installed and
+    IMAGERY_INDEX_ENGINE=numexpr (or use_numexpr) asks for it.
+    """
+    names = registry.validate(registry.names if names is None else names)
+    program = registry.compile(names)
+    results = program.evaluate({'blue': blue, 'green': green, 'red': red, 'nir': nir}, use_numexpr)
+    return {name: results[name] for name in names}
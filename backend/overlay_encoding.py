@@ -0,0 +1,106 @@
+"""
+Overlay Image Encoding
+Overlays are palette images: LUT positions plus the colormap as palette,
+encoded as 8-bit PNG by default or converted to RGBA PNG / WebP on request
+"""
+import io
+from typing import Dict, Optional
+
+import numpy as np
+from PIL import Image
+
+# Encodings by name, with their media type and URL extension
+FORMATS: Dict[str, Dict[str, str]] = {
+    'png': {'media_type': 'image/png', 'extension': 'png', 'description': '8-bit palette PNG'},
+    'png32': {'media_type': 'image/png', 'extension': 'png', 'description': '32-bit RGBA PNG'},
+    'webp': {'media_type': 'image/webp', 'extension': 'webp', 'description': 'Lossless WebP'},
+    'webp-lossy': {'media_type': 'image/webp', 'extension': 'webp', 'description': 'Lossy WebP'}
+}
+
+# Encoding used for each URL extension when no format is requested
+EXTENSION_DEFAULTS = {'png': 'png', 'webp': 'webp'}
+
+
+def palette_image(quantized: np.ndarray, lut: np.ndarray) -> Image.Image:
+    """
+    8-bit palette image of LUT positions (see colormaps.quantize), with the
+    LUT's colors as palette and its alpha as PNG transparency. Lossless
+    with respect to the RGBA rendering, at a quarter of the pixel data.
+    """
+    img = Image.fromarray(quantized)
+    img.putpalette(lut[:, :3].tobytes())
+    img.info['transparency'] = lut[:, 3].tobytes()
+    return img
+
+
+def encode(img: Image.Image, image_format: str, png_compress_level: int = 6,
+           webp_quality: int = 80, webp_method: int = 4) -> bytes:
+    """
+    Encode a palette image in one of FORMATS. png_compress_level is zlib's
+    0-9; webp_method trades encode time for size (0-6); webp_quality only
+    applies to lossy WebP.
+    """
+    buffer = io.BytesIO()
+    if image_format == 'png':
+        img.save(buffer, format='PNG', compress_level=png_compress_level)
+    elif image_format == 'png32':
+        img.convert('RGBA').save(buffer, format='PNG', compress_level=png_compress_level)
+    elif image_format == 'webp':
+        img.convert('RGBA').save(buffer, format='WEBP', lossless=True, method=webp_method)
+    elif image_format == 'webp-lossy':
+        img.convert('RGBA').save(buffer, format='WEBP', quality=webp_quality, method=webp_method)
+    else:
+        raise ValueError(f"Unknown image format '{image_format}'")
+    return buffer.getvalue()
+
+
+def accept_qualities(accept: Optional[str]) -> Dict[str, float]:
+    """Media ranges of an Accept header with their q-values (1 when not given)"""
+    qualities = {}
+    for part in (accept or '').split(','):
+        media_range, *params = [item.strip() for item in part.split(';')]
+        if not media_range:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    pass
+        qualities[media_range.lower()] = quality
+    return qualities
+
+
+def accept_quality(qualities: Dict[str, float], media_type: str) -> float:
+    """q-value of a media type from its most specific matching range, 0 if none"""
+    for media_range in (media_type, media_type.split('/')[0] + '/*', '*/*'):
+        if media_range in qualities:
+            return qualities[media_range]
+    return 0.0
+
+
+def negotiate(extension: Optional[str], requested: Optional[str], accept: Optional[str]) -> str:
+    """
+    Pick an encoding: an explicit `requested` format wins, then the URL
+    extension, then the Accept header (WebP when the client lists it, with
+    a q-value above zero and no lower than PNG's)
+
+    Raises:
+        ValueError: for unknown formats or ones that contradict the extension
+    """
+    requested = (requested or '').strip().lower()
+    if requested:
+        if requested not in FORMATS:
+            raise ValueError(f"Unknown image format '{requested}'. Supported: {', '.join(FORMATS)}")
+        if extension and FORMATS[requested]['extension'] != extension:
+            raise ValueError(f"Format '{requested}' can't be served as .{extension}")
+        return requested
+    if extension:
+        if extension not in EXTENSION_DEFAULTS:
+            raise ValueError(f"Unknown image extension '.{extension}'")
+        return EXTENSION_DEFAULTS[extension]
+    qualities = accept_qualities(accept)
+    webp = qualities.get('image/webp', 0.0)
+    return 'webp' if webp > 0 and webp >= accept_quality(qualities, 'image/png') else 'png'
@@ -1,9 +1,10 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, BackgroundTasks, Query, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field as PydanticField, ConfigDict, EmailStr
@@ -15,7 +16,11 @@ import jwt
 from fastkml import kml
 from lxml import etree
 import io
-from imagery_service import imagery_service
+import colormaps
+import overlay_encoding
+from imagery_service import TILE_MAX_ZOOM, imagery_service, parse_colormap, parse_indices
+from index_engine import registry as index_registry
+from analysis_jobs import AnalysisJobQueue
 
 
 ROOT_DIR = Path(__file__).parent
@@ -26,6 +31,27 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+async def record_field_health(field_id: str, analysis_result: Dict):
+    """
+    Store the health index and per-index means derived from an analysis on
+    the field, so fields can be sorted and filtered without the overlays
+    """
+    statistics = analysis_result.get('statistics') or {}
+    update = {
+        f'index_means.{index_name}': stats['mean']
+        for index_name, stats in statistics.items() if stats and stats.get('count')
+    }
+    health_index = imagery_service.health_index(statistics)
+    if health_index is not None:
+        analysis_result['health_index'] = health_index
+        update['health_index'] = health_index
+        update['health_updated_at'] = datetime.now(timezone.utc).isoformat()
+    if update:
+        await db.fields.update_one({'id': field_id}, {'$set': update})
+
+# Background analysis jobs
+analysis_jobs = AnalysisJobQueue(db.analysis_jobs, imagery_service, on_success=record_field_health)
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -34,6 +60,9 @@ SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-product
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 7
 
+# Overlay URLs are versioned, so browsers may reuse them without asking
+OVERLAY_MAX_AGE_SECONDS = int(os.environ.get('OVERLAY_MAX_AGE_SECONDS', '3600'))
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -178,7 +207,10 @@ class Field(BaseModel):
     name: str
     crop_type: str
     start_date: str
-    health_index: float = PydanticField(default=0, ge=0, le=100)
+    # None until the field's imagery has been analyzed
+    health_index: Optional[float] = PydanticField(default=None, ge=0, le=100)
+    health_updated_at: Optional[datetime] = None
+    index_means: Dict[str, float] = PydanticField(default_factory=dict)
     farmer_name: Optional[str] = None
     contact_number: Optional[str] = None
     imagery_url: Optional[str] = None
@@ -234,7 +266,6 @@ async def register(user_data: UserRegister):
         name="Sample Field - Demo",
         crop_type="Wheat",
         start_date="2024-11-01",
-        health_index=0,  # Calculated from imagery
         farmer_name="Demo Farmer",
         contact_number="+91-9876543210",
         coordinates=[
@@ -321,7 +352,6 @@ async def create_field(field_data: FieldCreate, current_user: dict = Depends(get
         name=field_data.name,
         crop_type=field_data.crop_type,
         start_date=field_data.start_date,
-        health_index=0,  # Will be calculated from satellite imagery
         farmer_name=field_data.farmer_name,
         contact_number=field_data.contact_number,
         imagery_url=field_data.imagery_url,
@@ -338,8 +368,34 @@ async def create_field(field_data: FieldCreate, current_user: dict = Depends(get
     return field
 
 @api_router.get("/fields", response_model=List[Field])
-async def get_fields(current_user: dict = Depends(get_current_user)):
-    fields = await db.fields.find({"user_id": current_user['id']}, {"_id": 0}).to_list(1000)
+async def get_fields(sort: Optional[str] = None, min_health: Optional[float] = None, max_health: Optional[float] = None,
+                     current_user: dict = Depends(get_current_user)):
+    """List fields, optionally filtered by health range and sorted, e.g. ?sort=-health_index&min_health=50"""
+    query = {"user_id": current_user['id']}
+    if min_health is not None or max_health is not None:
+        query['health_index'] = {}
+        if min_health is not None:
+            query['health_index']['$gte'] = min_health
+        if max_health is not None:
+            query['health_index']['$lte'] = max_health
+    
+    sort_key = sort.lstrip('-') if sort else None
+    if sort_key not in (None, 'health_index', 'name', 'created_at'):
+        raise HTTPException(status_code=400, detail="sort must be one of health_index, name, created_at")
+    direction = -1 if sort and sort.startswith('-') else 1
+    
+    if sort_key == 'health_index' and 'health_index' not in query:
+        # Fields not analyzed yet have no health index; list them last
+        # rather than as the least (or most) healthy
+        fields = await db.fields.find({**query, 'health_index': {'$ne': None}}, {"_id": 0}) \
+            .sort('health_index', direction).to_list(1000)
+        if len(fields) < 1000:
+            fields += await db.fields.find({**query, 'health_index': None}, {"_id": 0}).to_list(1000 - len(fields))
+    else:
+        cursor = db.fields.find(query, {"_id": 0})
+        if sort_key:
+            cursor = cursor.sort(sort_key, direction)
+        fields = await cursor.to_list(1000)
     
     # Convert datetime strings back
     for field in fields:
@@ -376,6 +432,17 @@ async def update_field(field_id: str, field_data: FieldUpdate, current_user: dic
         {"$set": update_data}
     )
     
+    # Cached analyses only depend on the imagery and the boundary
+    if any(key in update_data and update_data[key] != existing_field.get(key)
+           for key in ('imagery_url', 'coordinates')):
+        # Removes cache files, so it runs off the event loop
+        await asyncio.to_thread(imagery_service.invalidate_field, field_id)
+        # Health and index means described the old imagery or boundary
+        await db.fields.update_one(
+            {"id": field_id},
+            {"$unset": {"health_index": "", "health_updated_at": "", "index_means": ""}}
+        )
+    
     # Get updated field
     updated_field = await db.fields.find_one({"id": field_id}, {"_id": 0})
     if isinstance(updated_field['created_at'], str):
@@ -389,13 +456,45 @@ async def delete_field(field_id: str, current_user: dict = Depends(get_current_u
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Field not found")
     
+    # Free the field's cached results, overlays and pyramids now rather than at eviction
+    await asyncio.to_thread(imagery_service.invalidate_field, field_id)
+    
     return {"message": "Field deleted successfully"}
 
 
 # Imagery Analysis Routes
+@api_router.get("/indices")
+async def list_indices(current_user: dict = Depends(get_current_user)):
+    """List the vegetation indices available for analysis"""
+    return index_registry.definitions()
+
+@api_router.get("/colormaps")
+async def list_colormaps(current_user: dict = Depends(get_current_user)):
+    """List the overlay colormaps, with their color stops for legends"""
+    return colormaps.definitions()
+
+def parse_requested_indices(indices: Optional[str]) -> tuple:
+    try:
+        return parse_indices(indices)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def parse_requested_colormap(colormap: Optional[str]) -> Optional[str]:
+    try:
+        return parse_colormap(colormap)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @api_router.get("/fields/{field_id}/analysis")
-async def get_field_analysis(field_id: str, current_user: dict = Depends(get_current_user)):
-    """Get satellite imagery analysis for a field"""
+async def get_field_analysis(field_id: str, indices: Optional[str] = None, colormap: Optional[str] = None,
+                             current_user: dict = Depends(get_current_user)):
+    """
+    Get satellite imagery analysis for a field, e.g. ?indices=ndvi,evi (default: all indices)
+    and ?colormap=viridis (default: each index's own colormap)
+    """
+    requested_indices = parse_requested_indices(indices)
+    requested_colormap = parse_requested_colormap(colormap)
+    
     # Get field
     field = await db.fields.find_one({"id": field_id, "user_id": current_user['id']}, {"_id": 0})
     if not field:
@@ -408,11 +507,158 @@ async def get_field_analysis(field_id: str, current_user: dict = Depends(get_cur
             'message': f'No imagery found for field "{field["name"]}". Please add a Google Drive URL for the Planet SkySat GeoTIFF image.'
         }
     
-    # Process imagery
-    analysis_result = imagery_service.process_field_imagery(field_id, field['imagery_url'])
+    # Process imagery in the imagery executor so other requests keep being served
+    analysis_result = await imagery_service.process_field_imagery(
+        field_id, field['imagery_url'], field['coordinates'], requested_indices, requested_colormap
+    )
+    if analysis_result.get('status') == 'success':
+        await record_field_health(field_id, analysis_result)
     
     return analysis_result
 
+@api_router.post("/fields/{field_id}/analysis", status_code=status.HTTP_202_ACCEPTED)
+async def create_field_analysis_job(field_id: str, background_tasks: BackgroundTasks, indices: Optional[str] = None,
+                                    colormap: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Queue a satellite imagery analysis for a field and return the job id"""
+    requested_indices = parse_requested_indices(indices)
+    requested_colormap = parse_requested_colormap(colormap)
+    
+    field = await db.fields.find_one({"id": field_id, "user_id": current_user['id']}, {"_id": 0})
+    if not field:
+        raise HTTPException(status_code=404, detail="Field not found")
+    
+    if not field.get('imagery_url'):
+        raise HTTPException(
+            status_code=400,
+            detail=f'No imagery found for field "{field["name"]}". Please add a Google Drive URL for the Planet SkySat GeoTIFF image.'
+        )
+    
+    job = await analysis_jobs.enqueue(field, current_user['id'], list(requested_indices), requested_colormap)
+    # Wake an idle worker once the response has been sent
+    background_tasks.add_task(analysis_jobs.wake)
+    
+    return {'job_id': job['id'], 'status': job['status']}
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header names the ETag (weak comparison)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+@api_router.get("/fields/{field_id}/overlays/{index_name}.{extension}")
+async def get_field_overlay_file(field_id: str, index_name: str, extension: str, request: Request,
+                                 colormap: Optional[str] = None,
+                                 image_format: Optional[str] = Query(None, alias='format'),
+                                 v: Optional[str] = None,
+                                 current_user: dict = Depends(get_current_user)):
+    """
+    Overlay image of an analyzed index as raw bytes, e.g. /fields/{id}/overlays/ndvi.png
+    (8-bit palette PNG) or ndvi.webp (lossless WebP); ?format=png32 or webp-lossy
+    picks the other encoding for the extension
+    """
+    return await overlay_response(field_id, index_name, extension, image_format, request, colormap, v, current_user)
+
+@api_router.get("/fields/{field_id}/overlays/{index_name}")
+async def get_field_overlay(field_id: str, index_name: str, request: Request,
+                            colormap: Optional[str] = None,
+                            image_format: Optional[str] = Query(None, alias='format'),
+                            v: Optional[str] = None,
+                            current_user: dict = Depends(get_current_user)):
+    """
+    Overlay image of an analyzed index in the format given by ?format= or,
+    failing that, negotiated from the Accept header (WebP when accepted)
+    """
+    return await overlay_response(field_id, index_name, None, image_format, request, colormap, v, current_user)
+
+async def overlay_response(field_id: str, index_name: str, extension: Optional[str], image_format: Optional[str],
+                           request: Request, colormap: Optional[str], version: Optional[str],
+                           current_user: dict) -> Response:
+    """
+    Overlay bytes with ETag revalidation. With the version parameter of the
+    overlay URL an analysis returned, an overlay that has since left the
+    cache is rendered again from the downloaded scene.
+    """
+    if index_name not in index_registry:
+        raise HTTPException(status_code=404, detail="Overlay not found")
+    try:
+        image_format = overlay_encoding.negotiate(extension, image_format, request.headers.get('accept'))
+    except ValueError as e:
+        raise HTTPException(status_code=404 if extension and not image_format else 400, detail=str(e))
+    requested_colormap = parse_requested_colormap(colormap)
+    
+    field = await db.fields.find_one({"id": field_id, "user_id": current_user['id']}, {"_id": 0})
+    if not field:
+        raise HTTPException(status_code=404, detail="Field not found")
+    if not field.get('imagery_url'):
+        raise HTTPException(status_code=404, detail="Overlay not found")
+    
+    overlay = await imagery_service.fetch_overlay(
+        field_id, field['imagery_url'], field['coordinates'],
+        index_name, requested_colormap, image_format, version
+    )
+    if not overlay:
+        raise HTTPException(status_code=404, detail=f"No {index_name} overlay yet. Run an analysis first.")
+    
+    headers = {
+        'ETag': overlay['etag'],
+        'Cache-Control': f'private, max-age={OVERLAY_MAX_AGE_SECONDS}'
+    }
+    if extension is None:
+        headers['Vary'] = 'Accept'
+    if etag_matches(request.headers.get('if-none-match'), overlay['etag']):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=overlay['content'], media_type=overlay['media_type'], headers=headers)
+
+@api_router.get("/fields/{field_id}/tiles/{index_name}/{z}/{x}/{y}.png")
+async def get_field_tile(field_id: str, index_name: str, z: int, x: int, y: int, request: Request,
+                         colormap: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """
+    XYZ map tile of an index over the field, rendered on demand from the
+    downloaded scene. Tiles are revalidated with their ETag on every use.
+    """
+    if index_name not in index_registry or not 0 <= z <= TILE_MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=404, detail="Tile not found")
+    requested_colormap = parse_requested_colormap(colormap)
+    
+    field = await db.fields.find_one({"id": field_id, "user_id": current_user['id']}, {"_id": 0})
+    if not field:
+        raise HTTPException(status_code=404, detail="Field not found")
+    if not field.get('imagery_url'):
+        raise HTTPException(status_code=404, detail="Tile not found")
+    
+    loop = asyncio.get_running_loop()
+    tile = await loop.run_in_executor(
+        imagery_service.tile_executor, imagery_service.render_tile, field_id, field['imagery_url'],
+        field['coordinates'], index_name, z, x, y, requested_colormap
+    )
+    if not tile:
+        raise HTTPException(status_code=404, detail="Imagery not downloaded yet. Run an analysis first.")
+    
+    headers = {'ETag': tile['etag'], 'Cache-Control': 'private, no-cache'}
+    if etag_matches(request.headers.get('if-none-match'), tile['etag']):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=tile['content'], media_type=tile['media_type'], headers=headers)
+
+@api_router.get("/jobs/{job_id}")
+async def get_analysis_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Get status, progress and result of an analysis job"""
+    job = await analysis_jobs.get_job(job_id, current_user['id'])
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return {
+        'job_id': job['id'],
+        'field_id': job['field_id'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'stage': job['stage'],
+        'error': job['error'],
+        'result': job['result'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at']
+    }
+
 
 
 # Include the router in the main app
@@ -433,6 +679,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_analysis_workers():
+    await db.fields.create_index([('user_id', 1), ('health_index', -1)])
+    # Fields created before health was computed stored a placeholder 0
+    await db.fields.update_many({'health_updated_at': None, 'health_index': 0}, {'$unset': {'health_index': ''}})
+    await analysis_jobs.create_indexes()
+    analysis_jobs.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await analysis_jobs.stop()
     client.close()
+    await imagery_service.shutdown()
@@ -0,0 +1,84 @@
+"""
+Single-Flight Request Coalescing
+Concurrent callers asking for the same work share one execution of it
+"""
+import os
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from filelock import FileLock, Timeout
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls by key. The first caller runs the work and
+    everyone else arriving before it finishes awaits the same task.
+
+    With a `lock_dir`, the leader also holds a file lock for the key so
+    leaders in other worker processes on the host wait for it. Once the lock
+    is acquired, `recheck` is given a chance to return the result another
+    process produced (e.g. from a shared cache) before doing the work again.
+
+    Keys are hashed onto a fixed set of `lock_stripes` lock files, so the
+    directory doesn't grow with every key ever seen (unlinking a lock file
+    others may be waiting on isn't safe). Unrelated keys sharing a stripe
+    just run one after the other; work must not start another flight while
+    it holds its lock.
+    """
+
+    def __init__(self, lock_dir: Optional[str] = None, poll_interval: float = 0.2,
+                 lock_stripes: int = 256):
+        self.lock_dir = lock_dir
+        self.poll_interval = poll_interval
+        self.lock_stripes = lock_stripes
+        self._inflight: Dict[str, asyncio.Task] = {}
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    async def run(self, key: str, work: Callable[[], Awaitable[Any]],
+                  recheck: Optional[Callable[[], Awaitable[Any]]] = None) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._lead(key, work, recheck))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            logger.info(f"Joining in-flight work for {key}")
+        # A cancelled caller must not cancel the work other callers wait on
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def _lead(self, key: str, work: Callable[[], Awaitable[Any]],
+                    recheck: Optional[Callable[[], Awaitable[Any]]]) -> Any:
+        if not self.lock_dir:
+            return await work()
+        async with self._file_lock(key):
+            if recheck is not None:
+                result = await recheck()
+                if result is not None:
+                    return result
+            return await work()
+
+    @asynccontextmanager
+    async def _file_lock(self, key: str):
+        """Cross-process lock, polled so waiting never blocks the event loop"""
+        stripe = int(hashlib.sha256(key.encode()).hexdigest(), 16) % self.lock_stripes
+        lock = FileLock(os.path.join(self.lock_dir, f"{stripe:03d}.lock"))
+        while True:
+            try:
+                lock.acquire(timeout=0)
+                break
+            except Timeout:
+                await asyncio.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            lock.release()
@@ -67,6 +67,12 @@ export default function Dashboard({ onLogout }) {
     }
   };
 
+  // Health is recalculated by satellite analysis; mirror it without refetching
+  const handleHealthUpdate = (fieldId, healthIndex) => {
+    setFields(prev => prev.map(f => f.id === fieldId ? { ...f, health_index: healthIndex } : f));
+    setSelectedField(prev => prev?.id === fieldId ? { ...prev, health_index: healthIndex } : prev);
+  };
+
   const handleDeleteField = async (fieldId) => {
     try {
       await axios.delete(`${API}/fields/${fieldId}`, getAuthHeaders());
@@ -164,6 +170,7 @@ export default function Dashboard({ onLogout }) {
             field={selectedField}
             onUpdate={handleUpdateField}
             onDelete={handleDeleteField}
+            onHealthUpdate={handleHealthUpdate}
           />
         </div>
       </div>
@@ -16,7 +16,7 @@ import {
 } from '@/components/ui/alert-dialog';
 import SatelliteAnalysisModal from './SatelliteAnalysisModal';
 
-export default function FieldDetails({ field, onUpdate, onDelete }) {
+export default function FieldDetails({ field, onUpdate, onDelete, onHealthUpdate }) {
   const [isEditing, setIsEditing] = useState(false);
   const [showDeleteDialog, setShowDeleteDialog] = useState(false);
   const [showAnalysisModal, setShowAnalysisModal] = useState(false);
@@ -62,13 +62,16 @@ export default function FieldDetails({ field, onUpdate, onDelete }) {
     );
   }
 
+  // Fields that were never analyzed have no health index
   const getHealthColor = (health) => {
+    if (health == null) return 'text-gray-400';
     if (health >= 80) return 'text-green-700';
     if (health >= 50) return 'text-yellow-600';
     return 'text-red-600';
   };
 
   const getHealthLabel = (health) => {
+    if (health == null) return 'Not Analyzed';
     if (health >= 80) return 'Excellent';
     if (health >= 50) return 'Good';
     return 'Needs Attention';
@@ -279,9 +282,10 @@ export default function FieldDetails({ field, onUpdate, onDelete }) {
           </Label>
           <div className="flex items-center justify-between">
             <span className={`text-3xl font-bold ${getHealthColor(field.health_index)}`} data-testid="field-detail-health">
-              {field.health_index}%
+              {field.health_index != null ? `${field.health_index}%` : '—'}
             </span>
             <span className={`text-sm font-medium px-3 py-1 rounded-full ${
+              field.health_index == null ? 'bg-gray-100 text-gray-600' :
               field.health_index >= 80 ? 'bg-green-100 text-green-800' :
               field.health_index >= 50 ? 'bg-yellow-100 text-yellow-700' :
               'bg-red-100 text-red-700'
@@ -292,10 +296,10 @@ export default function FieldDetails({ field, onUpdate, onDelete }) {
           <div className="w-full h-4 bg-gray-200 rounded-full overflow-hidden">
             <div
               className="h-full bg-gradient-to-r from-green-600 to-emerald-500 rounded-full transition-all duration-500"
-              style={{ width: `${field.health_index}%` }}
+              style={{ width: `${field.health_index ?? 0}%` }}
             />
           </div>
-          {field.health_index === 0 && (
+          {field.health_index == null && (
             <p className="text-xs text-gray-500">
               Run satellite analysis to calculate health index
             </p>
@@ -320,6 +324,7 @@ export default function FieldDetails({ field, onUpdate, onDelete }) {
         open={showAnalysisModal}
         onClose={() => setShowAnalysisModal(false)}
         field={field}
+        onHealthUpdate={onHealthUpdate}
       />
 
       {/* Delete Confirmation Dialog */}
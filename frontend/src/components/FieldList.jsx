@@ -47,11 +47,11 @@ export default function FieldList({ fields, selectedField, onSelectField }) {
                   <div className="flex-1 h-2 bg-gray-200 rounded-full overflow-hidden">
                     <div
                       className="h-full bg-gradient-to-r from-green-500 to-emerald-500 rounded-full transition-all"
-                      style={{ width: `${field.health_index}%` }}
+                      style={{ width: `${field.health_index ?? 0}%` }}
                     />
                   </div>
                   <span className="text-xs font-medium text-gray-700" data-testid={`field-health-${field.id}`}>
-                    {field.health_index}%
+                    {field.health_index != null ? `${field.health_index}%` : '—'}
                   </span>
                 </div>
               </div>
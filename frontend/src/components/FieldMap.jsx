@@ -1,9 +1,33 @@
 import { useEffect, useRef, useState } from 'react';
 import L from 'leaflet';
 import 'leaflet/dist/leaflet.css';
+import axios from 'axios';
 import { Button } from '@/components/ui/button';
+import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
 import { Layers } from 'lucide-react';
 
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+
+const NO_INDEX_LAYER = 'none';
+
+// Index tiles need the auth header, which plain <img> tiles can't send
+const AuthTileLayer = L.GridLayer.extend({
+  createTile(coords, done) {
+    const tile = document.createElement('img');
+    axios.get(L.Util.template(this.options.url, coords), {
+      headers: { Authorization: `Bearer ${localStorage.getItem('token')}` },
+      responseType: 'blob'
+    }).then((response) => {
+      tile.onload = () => {
+        URL.revokeObjectURL(tile.src);
+        done(null, tile);
+      };
+      tile.src = URL.createObjectURL(response.data);
+    }).catch((error) => done(error, tile));
+    return tile;
+  }
+});
+
 // Fix for default marker icons in Leaflet with Webpack
 delete L.Icon.Default.prototype._getIconUrl;
 L.Icon.Default.mergeOptions({
@@ -18,6 +42,32 @@ export default function FieldMap({ fields, selectedField, onSelectField }) {
   const layersRef = useRef([]);
   const [mapLayer, setMapLayer] = useState('street'); // 'street' or 'satellite'
   const tileLayerRef = useRef(null);
+  const indexLayerRef = useRef(null);
+  const [indexLayer, setIndexLayer] = useState(NO_INDEX_LAYER);
+  const [availableIndices, setAvailableIndices] = useState([]);
+
+  useEffect(() => {
+    axios.get(`${BACKEND_URL}/api/indices`, {
+      headers: { Authorization: `Bearer ${localStorage.getItem('token')}` }
+    }).then((response) => setAvailableIndices(response.data.map((index) => index.name)))
+      .catch(() => setAvailableIndices([]));
+  }, []);
+
+  // Index tiles of the selected field, drawn above the base map
+  useEffect(() => {
+    if (!mapInstanceRef.current) return;
+    if (indexLayerRef.current) {
+      mapInstanceRef.current.removeLayer(indexLayerRef.current);
+      indexLayerRef.current = null;
+    }
+    if (!selectedField?.imagery_url || indexLayer === NO_INDEX_LAYER) return;
+
+    indexLayerRef.current = new AuthTileLayer({
+      url: `${BACKEND_URL}/api/fields/${selectedField.id}/tiles/${indexLayer}/{z}/{x}/{y}.png`,
+      maxZoom: 22,
+      zIndex: 10
+    }).addTo(mapInstanceRef.current);
+  }, [selectedField, indexLayer]);
 
   useEffect(() => {
     // Initialize map
@@ -66,7 +116,7 @@ export default function FieldMap({ fields, selectedField, onSelectField }) {
         <div class="text-xs">
           <div class="flex justify-between mb-1">
             <span class="text-gray-500">Health:</span>
-            <span class="font-medium">${selectedField.health_index}%</span>
+            <span class="font-medium">${selectedField.health_index != null ? `${selectedField.health_index}%` : '—'}</span>
           </div>
           <div class="flex justify-between mb-1">
             <span class="text-gray-500">Started:</span>
@@ -118,7 +168,20 @@ export default function FieldMap({ fields, selectedField, onSelectField }) {
       <div ref={mapRef} className="w-full h-full" data-testid="field-map" />
       
       {/* Map Layer Toggle */}
-      <div className="absolute top-4 right-4 z-[1000]">
+      <div className="absolute top-4 right-4 z-[1000] flex items-center space-x-2">
+        {selectedField?.imagery_url && availableIndices.length > 0 && (
+          <Select value={indexLayer} onValueChange={setIndexLayer}>
+            <SelectTrigger className="w-36 bg-white shadow-lg border-2 border-green-200" data-testid="index-layer-select">
+              <SelectValue />
+            </SelectTrigger>
+            <SelectContent className="z-[1001]">
+              <SelectItem value={NO_INDEX_LAYER}>No index layer</SelectItem>
+              {availableIndices.map((name) => (
+                <SelectItem key={name} value={name}>{name.toUpperCase()}</SelectItem>
+              ))}
+            </SelectContent>
+          </Select>
+        )}
         <Button
           onClick={toggleMapLayer}
           data-testid="map-layer-toggle"
@@ -1,40 +1,124 @@
-import { useState } from 'react';
+import { useEffect, useState } from 'react';
 import { X, Loader2 } from 'lucide-react';
 import { Button } from '@/components/ui/button';
 import { Dialog, DialogContent, DialogHeader, DialogTitle } from '@/components/ui/dialog';
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '@/components/ui/tabs';
+import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
 import axios from 'axios';
 import { toast } from 'sonner';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 
+const JOB_POLL_INTERVAL_MS = 2000;
+// Give up on a job that hasn't finished by then, e.g. if no worker picks it up
+const JOB_POLL_TIMEOUT_MS = 10 * 60 * 1000;
+
+// Each index is rendered with its own colormap unless one is picked
+const DEFAULT_COLORMAP = 'default';
+
 const getAuthHeaders = () => ({
   headers: { Authorization: `Bearer ${localStorage.getItem('token')}` }
 });
 
-export default function SatelliteAnalysisModal({ open, onClose, field }) {
+export default function SatelliteAnalysisModal({ open, onClose, field, onHealthUpdate }) {
   const [loading, setLoading] = useState(false);
   const [analysisData, setAnalysisData] = useState(null);
   const [error, setError] = useState(null);
 
-  const runAnalysis = async () => {
+  const [progress, setProgress] = useState(0);
+  const [activeIndex, setActiveIndex] = useState('ndvi');
+  const [availableIndices, setAvailableIndices] = useState(null);
+  const [colormap, setColormap] = useState(DEFAULT_COLORMAP);
+  const [availableColormaps, setAvailableColormaps] = useState([]);
+
+  const loadIndices = async () => {
+    try {
+      const [indices, colormaps] = await Promise.all([
+        axios.get(`${BACKEND_URL}/api/indices`, getAuthHeaders()),
+        axios.get(`${BACKEND_URL}/api/colormaps`, getAuthHeaders())
+      ]);
+      setAvailableIndices(indices.data);
+      setAvailableColormaps(colormaps.data);
+    } catch (err) {
+      // Fall back to the built-in indices below
+    }
+  };
+
+  const pollJob = async (jobId) => {
+    // Poll the job until it finishes instead of holding one long request open
+    const deadline = Date.now() + JOB_POLL_TIMEOUT_MS;
+    while (true) {
+      if (Date.now() > deadline) {
+        throw new Error('Analysis is taking too long. Please try again later.');
+      }
+      const response = await axios.get(
+        `${BACKEND_URL}/api/jobs/${jobId}`,
+        getAuthHeaders()
+      );
+      const job = response.data;
+      setProgress(job.progress || 0);
+
+      if (job.status === 'completed' || job.status === 'failed') {
+        return job;
+      }
+      await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    }
+  };
+
+  // Overlays are served as images behind auth, so they are fetched with the
+  // token and shown through object URLs; the browser still caches them.
+  // The server picks WebP or PNG from the Accept header.
+  const loadOverlayImages = async (overlays) => Object.fromEntries(
+    await Promise.all(Object.entries(overlays || {}).map(async ([indexName, url]) => {
+      const response = await axios.get(`${BACKEND_URL}${url}`, {
+        headers: { ...getAuthHeaders().headers, Accept: 'image/webp,image/png;q=0.9' },
+        responseType: 'blob'
+      });
+      return [indexName, URL.createObjectURL(response.data)];
+    }))
+  );
+
+  // Only the shown index is computed; others are fetched when their tab opens
+  const runAnalysis = async (indexName = activeIndex, selectedColormap = colormap) => {
     if (!field?.id) return;
 
     setLoading(true);
     setError(null);
+    setProgress(0);
     
     try {
-      const response = await axios.get(
+      const response = await axios.post(
         `${BACKEND_URL}/api/fields/${field.id}/analysis`,
-        getAuthHeaders()
+        {},
+        {
+          ...getAuthHeaders(),
+          params: {
+            indices: indexName,
+            ...(selectedColormap !== DEFAULT_COLORMAP && { colormap: selectedColormap })
+          }
+        }
       );
+      const job = await pollJob(response.data.job_id);
 
-      if (response.data.status === 'error') {
-        setError(response.data.message);
-        toast.error(response.data.message);
-      } else if (response.data.status === 'success') {
-        setAnalysisData(response.data);
-        toast.success('Satellite analysis completed successfully!');
+      if (job.status === 'failed') {
+        const errorMsg = job.error || 'Failed to run analysis';
+        setError(errorMsg);
+        toast.error(errorMsg);
+      } else if (job.result?.status === 'success') {
+        const firstResult = !analysisData;
+        const overlayImages = await loadOverlayImages(job.result.overlays);
+        setAnalysisData((previous) => ({
+          ...job.result,
+          overlays: { ...(previous?.overlays || {}), ...overlayImages },
+          statistics: { ...(previous?.statistics || {}), ...(job.result.statistics || {}) },
+          colormaps: { ...(previous?.colormaps || {}), ...(job.result.colormaps || {}) }
+        }));
+        if (job.result.health_index !== undefined) {
+          onHealthUpdate?.(field.id, job.result.health_index);
+        }
+        if (firstResult) {
+          toast.success('Satellite analysis completed successfully!');
+        }
       }
     } catch (err) {
       const errorMsg = err.response?.data?.detail || err.message || 'Failed to run analysis';
@@ -46,6 +130,9 @@ export default function SatelliteAnalysisModal({ open, onClose, field }) {
   };
 
   const handleOpen = () => {
+    if (open && !availableIndices) {
+      loadIndices();
+    }
     if (open && !analysisData && !loading) {
       runAnalysis();
     }
@@ -58,6 +145,38 @@ export default function SatelliteAnalysisModal({ open, onClose, field }) {
     }
   }, [open]);
 
+  const handleTabChange = (indexName) => {
+    setActiveIndex(indexName);
+    if (!analysisData?.overlays?.[indexName] && !loading) {
+      runAnalysis(indexName);
+    }
+  };
+
+  // A tab opened while another index was computing is computed once that
+  // job finishes, instead of showing "Computing..." until it is reopened
+  useEffect(() => {
+    if (open && analysisData && !loading && !error && !analysisData.overlays?.[activeIndex]) {
+      runAnalysis(activeIndex);
+    }
+  }, [loading, activeIndex]);
+
+  // Overlays in the old colormap are dropped and re-rendered on demand
+  const handleColormapChange = (value) => {
+    setColormap(value);
+    setAnalysisData((previous) => {
+      if (!previous) return previous;
+      Object.values(previous.overlays || {}).forEach((url) => URL.revokeObjectURL(url));
+      return { ...previous, overlays: {}, colormaps: {} };
+    });
+    runAnalysis(activeIndex, value);
+  };
+
+  const colormapColors = (indexName) => {
+    const name = analysisData?.colormaps?.[indexName];
+    return availableColormaps.find((item) => item.name === name)?.colors
+      || ['#d73027', '#fee08b', '#1a9850'];
+  };
+
   const indexInfo = {
     ndvi: {
       name: 'NDVI',
@@ -88,9 +207,27 @@ export default function SatelliteAnalysisModal({ open, onClose, field }) {
       name: 'GNDVI',
       fullName: 'Green NDVI',
       description: 'Uses green band for vegetation analysis'
+    },
+    msavi: {
+      name: 'MSAVI',
+      fullName: 'Modified Soil Adjusted Vegetation Index',
+      description: 'Soil-adjusted vegetation analysis for sparse canopies'
+    },
+    osavi: {
+      name: 'OSAVI',
+      fullName: 'Optimized Soil Adjusted Vegetation Index',
+      description: 'Soil-adjusted vegetation analysis with a fixed soil factor'
     }
   };
 
+  // Custom indices registered on the server get a tab too
+  const indexNames = availableIndices
+    ? availableIndices.map((index) => index.name)
+    : Object.keys(indexInfo);
+  const indexDescriptions = Object.fromEntries(
+    (availableIndices || []).map((index) => [index.name, index.description])
+  );
+
   return (
     <Dialog open={open} onOpenChange={onClose}>
       <DialogContent className="max-w-4xl max-h-[90vh] overflow-y-auto">
@@ -114,11 +251,11 @@ export default function SatelliteAnalysisModal({ open, onClose, field }) {
         </DialogHeader>
 
         <div className="mt-4">
-          {loading && (
+          {loading && !analysisData && (
             <div className="flex flex-col items-center justify-center py-12">
               <Loader2 className="w-12 h-12 animate-spin text-green-600 mb-4" />
               <p className="text-gray-600">Processing satellite imagery...</p>
-              <p className="text-sm text-gray-500 mt-2">This may take 30-60 seconds</p>
+              <p className="text-sm text-gray-500 mt-2">This may take 30-60 seconds ({progress}%)</p>
             </div>
           )}
 
@@ -127,7 +264,7 @@ export default function SatelliteAnalysisModal({ open, onClose, field }) {
               <p className="text-red-800 font-medium mb-2">Analysis Failed</p>
               <p className="text-red-600 text-sm">{error}</p>
               <Button
-                onClick={runAnalysis}
+                onClick={() => runAnalysis()}
                 className="mt-4 bg-red-600 hover:bg-red-700"
                 size="sm"
               >
@@ -138,46 +275,94 @@ export default function SatelliteAnalysisModal({ open, onClose, field }) {
 
           {analysisData && analysisData.overlays && (
             <div className="space-y-4">
-              <Tabs defaultValue="ndvi" className="w-full">
-                <TabsList className="grid w-full grid-cols-6 bg-green-100">
-                  {Object.keys(analysisData.overlays).map((index) => (
+              {availableColormaps.length > 0 && (
+                <div className="flex items-center justify-end space-x-2">
+                  <span className="text-sm text-gray-600">Colormap</span>
+                  <Select value={colormap} onValueChange={handleColormapChange} disabled={loading}>
+                    <SelectTrigger className="w-48">
+                      <SelectValue />
+                    </SelectTrigger>
+                    <SelectContent>
+                      <SelectItem value={DEFAULT_COLORMAP}>Index default</SelectItem>
+                      {availableColormaps.map((item) => (
+                        <SelectItem key={item.name} value={item.name}>{item.name}</SelectItem>
+                      ))}
+                    </SelectContent>
+                  </Select>
+                </div>
+              )}
+
+              <Tabs value={activeIndex} onValueChange={handleTabChange} className="w-full">
+                <TabsList className="flex flex-wrap h-auto w-full bg-green-100">
+                  {indexNames.map((index) => (
                     <TabsTrigger
                       key={index}
                       value={index}
                       className="data-[state=active]:bg-green-600 data-[state=active]:text-white uppercase"
                     >
-                      {indexInfo[index]?.name || index}
+                      {indexInfo[index]?.name || index.toUpperCase()}
                     </TabsTrigger>
                   ))}
                 </TabsList>
 
-                {Object.entries(analysisData.overlays).map(([indexName, imageData]) => (
+                {indexNames.map((indexName) => (
                   <TabsContent key={indexName} value={indexName} className="space-y-4">
                     <div className="bg-gray-50 rounded-lg p-4 border border-gray-200">
                       <h3 className="font-bold text-lg text-gray-900 mb-1">
-                        {indexInfo[indexName]?.fullName || indexName.toUpperCase()}
+                        {indexInfo[indexName]?.fullName || indexDescriptions[indexName] || indexName.toUpperCase()}
                       </h3>
                       <p className="text-sm text-gray-600 mb-4">
                         {indexInfo[indexName]?.description || 'Vegetation health indicator'}
                       </p>
                       
                       <div className="bg-white rounded-lg border-2 border-gray-300 overflow-hidden">
-                        <img
-                          src={imageData}
-                          alt={`${indexName} overlay`}
-                          className="w-full h-auto"
-                        />
+                        {analysisData.overlays[indexName] ? (
+                          <img
+                            src={analysisData.overlays[indexName]}
+                            alt={`${indexName} overlay`}
+                            className="w-full h-auto"
+                          />
+                        ) : (
+                          <div className="flex flex-col items-center justify-center py-12">
+                            <Loader2 className="w-8 h-8 animate-spin text-green-600 mb-2" />
+                            <p className="text-sm text-gray-500">Computing {indexInfo[indexName]?.name || indexName.toUpperCase()}... ({progress}%)</p>
+                          </div>
+                        )}
                       </div>
 
-                      <div className="mt-4 flex items-center justify-center space-x-4">
-                        <div className="flex items-center space-x-2">
-                          <div className="w-8 h-4 bg-gradient-to-r from-red-500 to-yellow-500 rounded"></div>
-                          <span className="text-xs text-gray-600">Low/Poor</span>
-                        </div>
-                        <div className="flex items-center space-x-2">
-                          <div className="w-8 h-4 bg-gradient-to-r from-yellow-500 to-green-500 rounded"></div>
-                          <span className="text-xs text-gray-600">High/Good</span>
+                      {analysisData.statistics?.[indexName]?.count > 0 && (
+                        <div className="mt-4 grid grid-cols-4 gap-2 text-center">
+                          {[
+                            ['Mean', analysisData.statistics[indexName].mean],
+                            ['Median', analysisData.statistics[indexName].percentiles.p50],
+                            ['Std Dev', analysisData.statistics[indexName].std],
+                            ['P10 - P90', null]
+                          ].map(([label, value]) => (
+                            <div key={label} className="bg-white rounded-lg border border-gray-200 p-2">
+                              <p className="text-xs text-gray-500">{label}</p>
+                              <p className="text-sm font-bold text-gray-900">
+                                {value !== null
+                                  ? value.toFixed(3)
+                                  : `${analysisData.statistics[indexName].percentiles.p10.toFixed(2)} - ${analysisData.statistics[indexName].percentiles.p90.toFixed(2)}`}
+                              </p>
+                            </div>
+                          ))}
+                          {analysisData.statistics[indexName].resolution?.native === false && (
+                            <p className="col-span-4 text-xs text-gray-500">
+                              From the preview: each sample averages about {analysisData.statistics[indexName].resolution.pixel_scale.toFixed(1)}
+                              {' x '}{analysisData.statistics[indexName].resolution.pixel_scale.toFixed(1)} image pixels
+                            </p>
+                          )}
                         </div>
+                      )}
+
+                      <div className="mt-4 flex items-center justify-center space-x-2">
+                        <span className="text-xs text-gray-600">-1 Low</span>
+                        <div
+                          className="w-48 h-4 rounded"
+                          style={{ background: `linear-gradient(to right, ${colormapColors(indexName).join(', ')})` }}
+                        ></div>
+                        <span className="text-xs text-gray-600">+1 High</span>
                       </div>
                     </div>
                   </TabsContent>
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# The backend is a flat set of modules run from its own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+# Keep the imagery caches of imported services out of the working tree
+os.environ.setdefault('IMAGERY_CACHE_DIR', tempfile.mkdtemp(prefix='imagery-cache-'))
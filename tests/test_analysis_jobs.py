@@ -0,0 +1,136 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from analysis_jobs import JOB_COMPLETED, JOB_RUNNING, AnalysisJobQueue
+
+
+class AsyncCollection:
+    """Motor-style awaitable methods over a mongomock collection"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.name = collection.name
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+    async def find_one_and_update(self, filter, update, sort=None, projection=None, return_document=False):
+        # mongomock looks the updated document up again with the original
+        # filter, which a claim no longer matches; MongoDB returns it by _id
+        document = self._collection.find_one(filter, sort=sort)
+        if document is None:
+            return None
+        self._collection.update_one({'_id': document['_id']}, update)
+        if return_document:
+            document = self._collection.find_one({'_id': document['_id']})
+        return {key: value for key, value in document.items() if key != '_id'}
+
+
+FIELD = {'id': 'field-1', 'imagery_url': 'https://example.com/scene.tif', 'coordinates': []}
+
+
+def make_queue(collection, **settings):
+    queue = AnalysisJobQueue(collection, SimpleNamespace(max_workers=1))
+    for name, value in settings.items():
+        setattr(queue, name, value)
+    return queue
+
+
+@pytest.fixture
+def collection():
+    return AsyncCollection(mongomock.MongoClient().db.analysis_jobs)
+
+
+def test_expired_lease_is_reclaimed(collection):
+    async def scenario():
+        first, second = make_queue(collection), make_queue(collection)
+        job = await first.enqueue(FIELD, 'user-1', ['ndvi'])
+        claimed = await first._claim()
+        assert claimed['id'] == job['id'] and claimed['lease_owner'] == first.owner
+
+        # A live lease is left alone
+        assert await second._claim() is None
+
+        # The first worker died: its lease runs out and the next worker takes over
+        await collection.update_one({'id': job['id']}, {'$set': {
+            'lease_expires_at': datetime.now(timezone.utc) - timedelta(seconds=1)
+        }})
+        reclaimed = await second._claim()
+        assert reclaimed['id'] == job['id']
+        assert reclaimed['status'] == JOB_RUNNING
+        assert reclaimed['lease_owner'] == second.owner
+        assert reclaimed['attempts'] == 2
+
+        # The stale worker can no longer finish the job
+        await first._finish(job['id'], JOB_COMPLETED, result={'status': 'success'})
+        stored = await collection.find_one({'id': job['id']})
+        assert stored['status'] == JOB_RUNNING and stored['finished_at'] is None
+
+        await second._finish(job['id'], JOB_COMPLETED, result={'status': 'success'})
+        stored = await collection.find_one({'id': job['id']})
+        assert stored['status'] == JOB_COMPLETED and stored['finished_at'] is not None
+    asyncio.run(scenario())
+
+
+def test_unfinished_job_is_reused(collection):
+    async def scenario():
+        queue = make_queue(collection)
+        job = await queue.enqueue(FIELD, 'user-1', ['ndvi'], 'viridis')
+        assert (await queue.enqueue(FIELD, 'user-1', ['ndvi'], 'viridis'))['id'] == job['id']
+        assert (await queue.enqueue(FIELD, 'user-1', ['ndvi']))['id'] != job['id']
+    asyncio.run(scenario())
+
+
+def test_finished_jobs_expire(collection):
+    async def scenario():
+        queue = make_queue(collection, retention_seconds=3600)
+        await queue.create_indexes()
+        info = await collection.index_information()
+        ttl = [index for index in info.values() if index['key'] == [('finished_at', 1)]]
+        assert ttl and ttl[0]['expireAfterSeconds'] == 3600
+    asyncio.run(scenario())
+
+
+def test_worker_survives_a_failed_run(collection):
+    async def scenario():
+        async def process_field_imagery(*args, **kwargs):
+            return {'status': 'success'}
+
+        imagery = SimpleNamespace(max_workers=1, process_field_imagery=process_field_imagery)
+        queue = AnalysisJobQueue(collection, imagery)
+        queue.worker_count, queue.poll_interval, queue.lease_seconds = 1, 0.05, 0.5
+        finish = queue._finish
+        failures = []
+
+        async def flaky_finish(*args, **kwargs):
+            if not failures:
+                failures.append(args)
+                raise RuntimeError('connection reset')
+            await finish(*args, **kwargs)
+
+        queue._finish = flaky_finish
+        first = await queue.enqueue(FIELD, 'user-1', ['ndvi'])
+        second = await queue.enqueue(FIELD, 'user-1', ['ndwi'])
+        queue.start()
+        try:
+            for _ in range(100):
+                jobs = {job['id']: await collection.find_one({'id': job['id']}) for job in (first, second)}
+                if all(job['status'] == JOB_COMPLETED for job in jobs.values()):
+                    break
+                await asyncio.sleep(0.05)
+            # The worker outlived the failure, and the failed job was reclaimed
+            assert all(not task.done() for task in queue._workers)
+            assert jobs[second['id']]['status'] == JOB_COMPLETED
+            assert jobs[first['id']]['status'] == JOB_COMPLETED and jobs[first['id']]['attempts'] == 2
+        finally:
+            await queue.stop()
+    asyncio.run(scenario())
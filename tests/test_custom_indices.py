@@ -0,0 +1,23 @@
+import pytest
+
+from imagery_service import register_custom_indices
+from index_engine import registry
+
+
+def test_registers_strings_and_objects():
+    register_custom_indices('{"ci_green": "nir / green - 1", '
+                            '"ci_red": {"expression": "nir / red - 1", "colormap": "viridis"}}')
+    assert 'ci_green' in registry
+    assert registry.colormap('ci_red') == 'viridis'
+
+
+@pytest.mark.parametrize('value, message', [
+    ('{"bad": ', 'must be a JSON object'),
+    ('["nir"]', 'must be a JSON object'),
+    ('{"bad": 5}', "Custom index 'bad'"),
+    ('{"bad": {"description": "no expression"}}', "Custom index 'bad'"),
+    ('{"ndvi": "nir / red"}', 'built-in'),
+])
+def test_rejects_invalid_definitions(value, message):
+    with pytest.raises(ValueError, match=message):
+        register_custom_indices(value)
@@ -0,0 +1,85 @@
+import os
+import time
+
+from imagery_cache import AnalysisResultCache, ImageryFileCache
+
+
+def cache_scene(cache: ImageryFileCache, source_key: str, content: bytes) -> str:
+    with cache.writer(source_key) as writer:
+        writer.write(content)
+        return writer.commit(etag='"v1"')
+
+
+def test_hits_do_not_rewrite_the_index(tmp_path):
+    cache = ImageryFileCache(str(tmp_path), max_bytes=1 << 20)
+    path = cache_scene(cache, 'https://example.com/a.tif', b'scene')
+    index_path = os.path.join(str(tmp_path), ImageryFileCache.INDEX_NAME)
+    before = os.stat(index_path).st_mtime_ns
+    for _ in range(5):
+        entry = cache.lookup('https://example.com/a.tif')
+        assert entry['path'] == path and entry['fresh'] and entry['etag'] == '"v1"'
+    assert os.stat(index_path).st_mtime_ns == before
+
+
+def test_stale_access_time_is_recorded(tmp_path):
+    cache = ImageryFileCache(str(tmp_path), max_bytes=1 << 20)
+    cache_scene(cache, 'https://example.com/a.tif', b'scene')
+    digest = cache.lookup('https://example.com/a.tif')['digest']
+    stale = time.time() - 2 * ImageryFileCache.ACCESS_RESOLUTION_SECONDS
+    with cache._index_lock:
+        cache._index['files'][digest]['last_access'] = stale
+        cache._save_index()
+    cache.lookup('https://example.com/a.tif')
+    assert ImageryFileCache(str(tmp_path))._index['files'][digest]['last_access'] > stale
+
+
+def test_sees_scenes_cached_by_another_process(tmp_path):
+    reader = ImageryFileCache(str(tmp_path), max_bytes=1 << 20)
+    assert reader.lookup('https://example.com/a.tif') is None
+    path = cache_scene(ImageryFileCache(str(tmp_path), max_bytes=1 << 20), 'https://example.com/a.tif', b'scene')
+    assert reader.lookup('https://example.com/a.tif')['path'] == path
+    os.unlink(path)
+    assert reader.lookup('https://example.com/a.tif') is None
+
+
+def test_shared_results_are_bounded_by_bytes(tmp_path):
+    cache = AnalysisResultCache(ttl_seconds=3600, max_bytes=1 << 20,
+                                shared_dir=str(tmp_path), shared_max_bytes=1000)
+    for i in range(20):
+        cache.put(('field', 'scene', 'boundary', f'index{i}'), {'values': 'x' * 100})
+    sizes = [os.path.getsize(os.path.join(str(tmp_path), name)) for name in os.listdir(str(tmp_path))]
+    assert sum(sizes) <= 1000
+    # The newest result survives pruning
+    assert AnalysisResultCache(ttl_seconds=3600, shared_dir=str(tmp_path)).get(
+        ('field', 'scene', 'boundary', 'index19')) == {'values': 'x' * 100}
+
+
+def test_shared_results_are_not_pruned_on_every_write(tmp_path, monkeypatch):
+    cache = AnalysisResultCache(ttl_seconds=3600, max_bytes=1 << 20,
+                                shared_dir=str(tmp_path), shared_max_bytes=1 << 20)
+    passes = []
+    monkeypatch.setattr(cache, '_prune_shared', lambda: passes.append(1))
+    for i in range(10):
+        cache.put(('field', 'scene', 'boundary', f'index{i}'), {'values': i})
+    assert len(passes) == 1
+
+
+def test_pyramids_count_towards_the_budget(tmp_path):
+    cache = ImageryFileCache(str(tmp_path), max_bytes=1000)
+    first = ImageryFileCache.digest_of(cache_scene(cache, 'https://example.com/a.tif', b'a' * 300))
+    os.makedirs(cache.pyramid_dir(first))
+    with open(os.path.join(cache.pyramid_dir(first), 'field-ndvi.tif'), 'wb') as f:
+        f.write(b'p' * 600)
+    cache.update_derived_size(first)
+    # 300 + 600 fit; another 300 byte scene doesn't, and evicts the first with its pyramids
+    cache_scene(cache, 'https://example.com/b.tif', b'b' * 300)
+    assert cache.lookup('https://example.com/a.tif') is None
+    assert not os.path.exists(cache.pyramid_dir(first))
+    assert cache.lookup('https://example.com/b.tif') is not None
+
+
+def test_pyramids_of_evicted_scenes_are_removed(tmp_path):
+    cache = ImageryFileCache(str(tmp_path), max_bytes=1000)
+    os.makedirs(cache.pyramid_dir('gone'))
+    cache.update_derived_size('gone')
+    assert not os.path.exists(cache.pyramid_dir('gone'))
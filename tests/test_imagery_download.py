@@ -0,0 +1,147 @@
+import asyncio
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from imagery_cache import ImageryFileCache
+from imagery_download import ImageryDownloader, ResourceChanged
+
+CONTENT = os.urandom(64 * 1024)
+
+
+class SceneServer:
+    """What the local server serves, and the Range headers it was sent"""
+
+    def __init__(self):
+        self.content = CONTENT
+        self.etag = '"v1"'
+        self.ranges = True
+        # Range starts whose first response is cut off halfway
+        self.drop = set()
+        # Change the file after this many requests
+        self.change_after = None
+        self.requests = []
+
+
+def make_handler(scene: SceneServer):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            requested = self.headers.get('Range')
+            scene.requests.append(requested)
+            if scene.change_after is not None and len(scene.requests) > scene.change_after:
+                scene.etag = '"v2"'
+            if_range = self.headers.get('If-Range')
+            if not requested or not scene.ranges or (if_range and if_range != scene.etag):
+                return self.respond(200, scene.content)
+            start, end = (int(value) for value in requested.split('=')[1].split('-'))
+            end = min(end, len(scene.content) - 1)
+            body = scene.content[start:end + 1]
+            cut = start in scene.drop and start != 0
+            scene.drop.discard(start)
+            self.respond(206, body, {'Content-Range': f"bytes {start}-{end}/{len(scene.content)}"},
+                         cut=cut)
+
+        def respond(self, status, body, headers=None, cut=False):
+            self.send_response(status)
+            self.send_header('ETag', scene.etag)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2] if cut else body)
+            self.close_connection = True
+    return Handler
+
+
+@pytest.fixture
+def scene():
+    state = SceneServer()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state.url = f"http://127.0.0.1:{server.server_address[1]}/scene.tif"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def make_downloader(cache_dir, **settings) -> ImageryDownloader:
+    downloader = ImageryDownloader(ImageryFileCache(str(cache_dir)))
+    downloader.segments = 4
+    downloader.min_segment_bytes = 8 * 1024
+    downloader.chunk_size = 4 * 1024
+    for name, value in settings.items():
+        setattr(downloader, name, value)
+    return downloader
+
+
+def download(downloader: ImageryDownloader, url: str) -> str:
+    async def run():
+        try:
+            return await downloader.download(url)
+        finally:
+            await downloader.aclose()
+    return asyncio.run(run())
+
+
+def read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def segment_starts(requests):
+    return sorted(int(value.split('=')[1].split('-')[0]) for value in requests if value != 'bytes=0-0')
+
+
+def test_segmented_download(scene, tmp_path):
+    path = download(make_downloader(tmp_path), scene.url)
+    assert read(path) == CONTENT
+    assert scene.requests[0] == 'bytes=0-0'
+    assert segment_starts(scene.requests) == [0, 16384, 32768, 49152]
+
+
+def test_dropped_segment_resumes_where_it_stopped(scene, tmp_path):
+    scene.drop = {16384}
+    path = download(make_downloader(tmp_path), scene.url)
+    assert read(path) == CONTENT
+    # The retry asks for the rest of the segment, not all of it
+    assert segment_starts(scene.requests) == [0, 16384, 16384 + 8192, 32768, 49152]
+
+
+def test_partial_download_survives_a_restart(scene, tmp_path):
+    scene.drop = {16384}
+    with pytest.raises(Exception):
+        download(make_downloader(tmp_path, retries=0), scene.url)
+    scene.requests.clear()
+    path = download(make_downloader(tmp_path), scene.url)
+    assert read(path) == CONTENT
+    # The dropped segment picks up at its midpoint
+    starts = segment_starts(scene.requests)
+    assert 16384 + 8192 in starts and 16384 not in starts
+
+
+def test_file_changed_during_download(scene, tmp_path):
+    scene.change_after = 1
+    with pytest.raises(ResourceChanged):
+        download(make_downloader(tmp_path), scene.url)
+    # The partial download of the old file is thrown away
+    assert not os.listdir(os.path.join(str(tmp_path), 'partial'))
+
+
+def test_falls_back_to_a_single_stream(scene, tmp_path):
+    scene.ranges = False
+    path = download(make_downloader(tmp_path), scene.url)
+    assert read(path) == CONTENT
+    assert scene.requests == ['bytes=0-0']
+
+
+def test_cached_scene_is_reused(scene, tmp_path):
+    first = download(make_downloader(tmp_path), scene.url)
+    scene.requests.clear()
+    assert download(make_downloader(tmp_path), scene.url) == first
+    assert scene.requests == []
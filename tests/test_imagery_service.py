@@ -0,0 +1,179 @@
+import asyncio
+import io
+import math
+
+import numpy as np
+import pytest
+import rasterio
+from PIL import Image
+from rasterio.transform import from_bounds, from_origin
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+from imagery_service import (EMPTY_TILE, MERCATOR_EXTENT, ImageryService, statistics_resolution,
+                             tile_bounds, tile_lnglat_bounds)
+
+METADATA = {'window': [10, 20, 4000, 2000], 'width': 1024, 'height': 512}
+
+# A 200x200 px, 4 band scene of 0.001 degree pixels from (10.0 E, 50.0 N),
+# and a field covering pixel columns and rows 50-99
+SCENE_SIZE = 200
+FIELD = [
+    {'lat': 49.9498, 'lng': 10.0502},
+    {'lat': 49.9498, 'lng': 10.0998},
+    {'lat': 49.9002, 'lng': 10.0998},
+    {'lat': 49.9002, 'lng': 10.0502},
+]
+
+
+@pytest.fixture
+def scene(tmp_path):
+    path = str(tmp_path / 'scene.tif')
+    data = np.stack([np.full((SCENE_SIZE, SCENE_SIZE), band * 100, dtype='uint16') for band in range(1, 5)])
+    with rasterio.open(path, 'w', driver='GTiff', width=SCENE_SIZE, height=SCENE_SIZE, count=4,
+                       dtype='uint16', crs='EPSG:4326', transform=from_origin(10.0, 50.0, 0.001, 0.001)) as dst:
+        dst.write(data)
+    return path
+
+
+@pytest.fixture
+def service():
+    service = ImageryService()
+    service.window_buffer = 16
+    return service
+
+
+def test_decimated_statistics_are_labelled():
+    assert statistics_resolution(METADATA, streamed=False) == {'native': False, 'pixel_scale': 3.906}
+
+
+def test_native_statistics():
+    assert statistics_resolution(METADATA, streamed=True)['native']
+    small = {'window': [0, 0, 800, 600], 'width': 800, 'height': 600}
+    assert statistics_resolution(small, streamed=False) == {'native': True, 'pixel_scale': 1.0}
+
+
+def test_field_window_is_buffered_and_clipped(scene, service):
+    with rasterio.open(scene) as src:
+        assert service.field_window(src, FIELD) == Window(34, 34, 82, 82)
+        service.window_buffer = 100
+        assert service.field_window(src, FIELD) == Window(0, 0, SCENE_SIZE, SCENE_SIZE)
+        outside = [{'lat': c['lat'], 'lng': c['lng'] + 1} for c in FIELD]
+        assert service.field_window(src, outside) is None
+
+
+def test_field_mask(scene, service):
+    with rasterio.open(scene) as src:
+        mask = service.field_mask(FIELD, src.crs, src.transform, (SCENE_SIZE, SCENE_SIZE))
+    assert mask.sum() == 50 * 50
+    assert mask[50:100, 50:100].all()
+    assert service.field_mask(FIELD, src.crs, src.transform, (SCENE_SIZE, SCENE_SIZE)) is mask
+
+
+def test_read_field_window(scene, service):
+    result = service.read_geotiff(scene, FIELD)
+    metadata = result['metadata']
+    assert metadata['window'] == [34, 34, 82, 82]
+    assert (metadata['width'], metadata['height']) == (82, 82)
+    assert metadata['field_pixels'] == 50 * 50
+    red = result['red']
+    assert red.dtype == service.dtype and red.shape == (82, 82)
+    # Pixels outside the boundary are NaN, inside keep their values
+    assert np.isnan(red[0, 0]) and np.isnan(red[~result['mask']]).all()
+    assert (red[result['mask']] == 300).all()
+
+
+def test_read_decimated(scene, service):
+    result = service.read_geotiff(scene, FIELD, max_dimension=41)
+    assert result['nir'].shape == (41, 41)
+    assert (result['metadata']['width'], result['metadata']['height']) == (41, 41)
+    assert result['metadata']['window'] == [34, 34, 82, 82]
+    assert np.nanmax(result['nir']) == 400
+
+
+def test_unrequested_bands_are_none(scene, service):
+    result = service.read_geotiff(scene, FIELD, bands=('red', 'nir'))
+    assert result['blue'] is None and result['green'] is None
+    assert result['red'] is not None and result['nir'] is not None
+
+
+def test_band_map_past_band_count(scene, service):
+    service.band_map = {'blue': 1, 'green': 2, 'red': 3, 'nir': 5}
+    assert service.read_geotiff(scene, FIELD) is None
+    # Bands the map doesn't reach are still readable
+    assert service.read_geotiff(scene, FIELD, bands=('red',))['red'] is not None
+
+
+def test_unknown_preview_resampling_fails_at_startup(monkeypatch):
+    monkeypatch.setenv('IMAGERY_PREVIEW_RESAMPLING', 'avg')
+    with pytest.raises(ValueError, match='IMAGERY_PREVIEW_RESAMPLING'):
+        ImageryService()
+
+
+def test_tile_bounds():
+    assert tile_bounds(0, 0, 0) == pytest.approx((-MERCATOR_EXTENT, -MERCATOR_EXTENT, MERCATOR_EXTENT, MERCATOR_EXTENT))
+    assert tile_bounds(1, 1, 0) == pytest.approx((0, 0, MERCATOR_EXTENT, MERCATOR_EXTENT))
+    assert tile_lnglat_bounds(1, 0, 1) == pytest.approx((-180, -85.0511288, 0, 0))
+    # Both describe the same square
+    west, south, east, north = tile_lnglat_bounds(12, 2162, 1400)
+    expected = transform_bounds('EPSG:4326', 'EPSG:3857', west, south, east, north)
+    assert tile_bounds(12, 2162, 1400) == pytest.approx(expected, abs=1e-3)
+
+
+def field_tile(z):
+    """XYZ tile holding the field's first corner"""
+    lat, lng = math.radians(FIELD[0]['lat']), FIELD[0]['lng']
+    x = int((lng + 180) / 360 * 2 ** z)
+    y = int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * 2 ** z)
+    return z, x, y
+
+
+def test_tiles_off_the_field_are_empty(service, monkeypatch):
+    def lookup(source):
+        raise AssertionError('the scene was looked up')
+
+    monkeypatch.setattr(service.file_cache, 'lookup', lookup)
+    z, x, y = field_tile(12)
+    assert service.render_tile('field', 'https://example.com/a.tif', FIELD, 'ndvi', z, x + 2, y) is EMPTY_TILE
+
+
+def test_tiles_read_the_pyramid(service, monkeypatch, tmp_path):
+    # A pyramid of NDVI 0.5 over the field, and no scene on disk at all
+    pyramid = str(tmp_path / 'pyramid.tif')
+    bounds = transform_bounds('EPSG:4326', 'EPSG:3857', 10.05, 49.9, 10.1, 49.95)
+    with rasterio.open(pyramid, 'w', driver='GTiff', width=64, height=64, count=1, dtype='float32',
+                       crs='EPSG:3857', transform=from_bounds(*bounds, 64, 64)) as dst:
+        dst.write(np.full((1, 64, 64), 0.5, dtype='float32'))
+    monkeypatch.setattr(service.file_cache, 'lookup',
+                        lambda source: {'path': str(tmp_path / 'missing.tif'), 'digest': 'scene'})
+    monkeypatch.setattr(service, 'pyramid_path', lambda *args: pyramid)
+    tile = service.render_tile('field', 'https://example.com/a.tif', FIELD, 'ndvi', *field_tile(12))
+    assert tile is not EMPTY_TILE and tile['media_type'] == 'image/png'
+    alpha = np.asarray(Image.open(io.BytesIO(tile['content'])).convert('RGBA'))[..., 3]
+    assert alpha.any() and not alpha.all()
+
+
+def test_pyramid_builds_are_batched(service, monkeypatch):
+    import imagery_service
+
+    builds = []
+    monkeypatch.setattr(imagery_service, '_build_pyramids', lambda *args: builds.append(args))
+    service.pyramids, service.pyramid_delay = True, 0.05
+
+    async def scenario():
+        service.schedule_pyramids('field', '/cache/scene.tif', FIELD, ('ndvi',))
+        service.schedule_pyramids('field', '/cache/scene.tif', FIELD, ('savi', 'ndvi'))
+        service.schedule_pyramids('other', '/cache/scene.tif', FIELD, ('ndvi',))
+        await asyncio.sleep(0.3)
+
+    asyncio.run(scenario())
+    service.pyramid_executor.shutdown()
+    assert sorted((args[0], args[3]) for args in builds) == [('field', ('ndvi', 'savi')), ('other', ('ndvi',))]
+
+
+def test_overlay_threads_follow_the_cpu_affinity(monkeypatch):
+    import imagery_service
+
+    monkeypatch.delenv('IMAGERY_OVERLAY_THREADS', raising=False)
+    monkeypatch.setattr(imagery_service, 'usable_cpus', lambda: 1)
+    assert ImageryService().overlay_threads == 1
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from imagery_streaming import PERCENTILES, RunningStats, downsample
+
+
+def sample(shape=(300, 200), seed=3):
+    rng = np.random.default_rng(seed)
+    values = np.clip(rng.normal(0.4, 0.2, shape), -1, 1).astype(np.float32)
+    values[:20] = np.nan
+    values[50, :5] = np.inf
+    return values
+
+
+def test_running_stats_match_numpy_across_chunks():
+    values = sample()
+    running = RunningStats(bins=200)
+    for chunk in np.array_split(values, 7):
+        running.update(chunk)
+    result = running.result()
+    finite = values[np.isfinite(values)].astype(np.float64)
+    assert result['count'] == finite.size
+    assert result['mean'] == pytest.approx(finite.mean(), rel=1e-9)
+    assert result['std'] == pytest.approx(finite.std(), rel=1e-9)
+    assert result['min'] == finite.min() and result['max'] == finite.max()
+    assert sum(result['histogram']['counts']) == finite.size
+    # Percentiles are interpolated within one histogram bin
+    bin_width = 2 / 200
+    for q in PERCENTILES:
+        assert result['percentiles'][f"p{q}"] == pytest.approx(np.percentile(finite, q), abs=bin_width)
+
+
+def test_values_outside_the_range_land_in_edge_bins():
+    running = RunningStats(bins=10)
+    running.update(np.array([-5.0, 0.05, 5.0]))
+    counts = running.result()['histogram']['counts']
+    assert counts[0] == 1 and counts[5] == 1 and counts[-1] == 1
+    assert running.result()['min'] == -5.0
+
+
+def test_empty_stats():
+    running = RunningStats()
+    running.update(np.full((4, 4), np.nan))
+    assert running.result()['count'] == 0 and running.result()['mean'] is None
+
+
+def test_downsample_averages_valid_pixels_only():
+    values = np.arange(16, dtype=np.float32).reshape(4, 4)
+    values[0, 0] = np.nan
+    reduced = downsample(values, (2, 2))
+    assert reduced[0, 0] == pytest.approx((1 + 4 + 5) / 3)
+    assert reduced[1, 1] == pytest.approx((10 + 11 + 14 + 15) / 4)
@@ -0,0 +1,149 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+import index_engine
+from index_engine import compute_indices, registry
+
+BUILTIN = ('ndvi', 'gndvi', 'ndwi', 'evi', 'savi', 'ndre', 'msavi', 'osavi')
+
+
+def make_bands(shape=(64, 48), dtype='float32'):
+    rng = np.random.default_rng(7)
+    return [rng.integers(1, 4000, shape).astype(dtype) for _ in range(4)]
+
+
+def legacy_ndvi(red, nir):
+    return (nir - red) / (nir + red + 1e-10)
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+def test_numpy_kernel_matches_the_formulas(dtype):
+    blue, green, red, nir = make_bands(dtype=dtype)
+    results = compute_indices(blue, green, red, nir, BUILTIN, use_numexpr=False)
+    assert all(result.dtype == np.dtype(dtype) for result in results.values())
+    np.testing.assert_allclose(results['ndvi'], legacy_ndvi(red, nir), rtol=1e-6)
+    np.testing.assert_allclose(results['ndwi'], -results['gndvi'])
+    assert results['ndre'] is results['ndvi']
+
+
+def test_numexpr_kernel_matches_numpy():
+    pytest.importorskip('numexpr')
+    bands = make_bands()
+    expected = compute_indices(*bands, BUILTIN, use_numexpr=False)
+    results = compute_indices(*bands, BUILTIN, use_numexpr=True)
+    for name in BUILTIN:
+        # float32 throughout: constants must not promote to float64
+        assert results[name].dtype == np.float32
+        np.testing.assert_allclose(results[name], expected[name], rtol=1e-5, atol=1e-6)
+
+
+def test_numexpr_computes_shared_subexpressions_once():
+    program = registry.compile(('ndvi', 'savi', 'osavi'))
+    sources = [source for _, _, source in program._expressions]
+    difference = ('sub', ('band', 'nir'), ('band', 'red'))
+    assert sum(node == difference for node, _, _ in program._expressions) == 1
+    assert not any('e-10' in source or '0.5' in source for source in sources)
+
+
+def test_strip_kernel_is_the_default(monkeypatch):
+    calls = []
+    monkeypatch.setattr(index_engine.IndexProgram, '_evaluate_numexpr',
+                        lambda *args: calls.append('numexpr'))
+    compute_indices(*make_bands(), ('ndvi',))
+    assert calls == []
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_strip_pool_survives_fork(monkeypatch):
+    monkeypatch.setattr(index_engine, 'STRIP_THREADS', 2)
+    bands = make_bands(shape=(512, 512))
+    # Start the strip pool in the parent
+    expected = compute_indices(*bands, ('ndvi',))['ndvi']
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+
+    def child():
+        results.put(compute_indices(*bands, ('ndvi',))['ndvi'])
+
+    process = context.Process(target=child)
+    process.start()
+    try:
+        np.testing.assert_array_equal(results.get(timeout=30), expected)
+    finally:
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+
+
+def parse(expression):
+    return index_engine.parse_expression(expression)
+
+
+NIR, RED = ('band', 'nir'), ('band', 'red')
+
+
+def test_commuted_operands_share_one_tree():
+    assert parse('nir + red') == parse('red + nir')
+    assert parse('(nir - red) / (nir + red)') == parse('(nir - red) / (red + nir)')
+
+
+def test_constants_are_folded():
+    assert parse('2 * 3 * nir') == parse('nir * 6')
+    assert parse('(nir + red + 0.25) + 0.25') == parse('nir + red + 0.5')
+
+
+def test_divisions_get_epsilon():
+    assert parse('nir / red') == ('div', NIR, ('add', RED, ('const', index_engine.EPSILON)))
+    # Constant denominators are left alone
+    assert parse('nir / 2') == ('div', NIR, ('const', 2.0))
+
+
+def test_squares_and_negations_are_rewritten():
+    assert parse('nir ** 2') == ('mul', NIR, NIR)
+    assert parse('--nir') == NIR
+
+
+@pytest.mark.parametrize('expression, message', [
+    ('nir +', 'Invalid index expression'),
+    ('nir + swir', "Unknown name 'swir'"),
+    ('nir % red', 'Unsupported operation'),
+    ('max(nir, red)', 'Unsupported operation'),
+    ('nir > red', 'Unsupported operation'),
+    ('True * nir', 'Unsupported operation'),
+    ('1 + 2', 'does not use any band'),
+])
+def test_invalid_expressions(expression, message):
+    with pytest.raises(ValueError, match=message):
+        parse(expression)
+
+
+def test_registry_resolves_earlier_indices():
+    indices = index_engine.IndexRegistry()
+    indices.register('diff', 'nir - red')
+    indices.register('scaled', '2 * diff')
+    assert indices.definitions()[1]['bands'] == ['red', 'nir']
+    with pytest.raises(ValueError, match="Unknown name 'later'"):
+        indices.register('early', 'later + nir')
+
+
+@pytest.mark.parametrize('name', ['nir', 'sqrt', '1abc', 'ci-green'])
+def test_invalid_index_names(name):
+    with pytest.raises(ValueError, match='Invalid index name'):
+        index_engine.IndexRegistry().register(name, 'nir / green - 1')
+
+
+def test_builtin_indices_cannot_be_redefined():
+    with pytest.raises(ValueError, match='built-in'):
+        registry.register('NDVI', 'nir / red')
+
+
+def test_bare_band_index():
+    indices = index_engine.IndexRegistry()
+    indices.register('nirraw', 'nir')
+    nir = np.arange(12, dtype=np.float32).reshape(3, 4)
+    for use_numexpr in (False, True) if index_engine.numexpr is not None else (False,):
+        results = indices.compile(('nirraw',)).evaluate({'nir': nir}, use_numexpr)
+        np.testing.assert_array_equal(results['nirraw'], nir)
@@ -0,0 +1,64 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from colormaps import DEFAULT_COLORMAP, get_lut
+from overlay_encoding import FORMATS, encode, negotiate, palette_image
+
+BROWSER_ACCEPT = 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8'
+
+
+@pytest.mark.parametrize('accept, expected', [
+    (None, 'png'),
+    ('', 'png'),
+    ('image/png', 'png'),
+    ('*/*', 'png'),
+    ('image/webp', 'webp'),
+    (BROWSER_ACCEPT, 'webp'),
+    ('image/webp,image/png;q=0.9', 'webp'),
+    ('image/webp;q=0', 'png'),
+    ('image/webp;q=0.0, */*', 'png'),
+    ('image/webp;q=0.5, image/png', 'png'),
+    ('image/webp;q=0.5, image/*;q=0.4', 'webp'),
+    ('IMAGE/WEBP ; Q=0.8', 'webp'),
+    ('image/webp;q=bogus', 'webp'),
+])
+def test_negotiate_accept(accept, expected):
+    assert negotiate(None, None, accept) == expected
+
+
+def test_negotiate_format_and_extension():
+    assert negotiate('png', None, 'image/webp') == 'png'
+    assert negotiate('webp', None, None) == 'webp'
+    assert negotiate('png', 'PNG32', None) == 'png32'
+    assert negotiate(None, 'webp-lossy', 'image/png') == 'webp-lossy'
+    with pytest.raises(ValueError):
+        negotiate('png', 'webp', None)
+    with pytest.raises(ValueError):
+        negotiate(None, 'gif', None)
+    with pytest.raises(ValueError):
+        negotiate('gif', None, None)
+
+
+@pytest.mark.parametrize('image_format', list(FORMATS))
+def test_encode_round_trips(image_format):
+    quantized = np.arange(64 * 64, dtype=np.uint8).reshape(64, 64)
+    lut = get_lut(DEFAULT_COLORMAP)
+    content = encode(palette_image(quantized, lut), image_format)
+    img = Image.open(io.BytesIO(content))
+    assert Image.MIME[img.format] == FORMATS[image_format]['media_type']
+    assert img.size == (64, 64)
+    rgba = np.asarray(img.convert('RGBA'))
+    expected = lut[quantized]
+    if image_format != 'webp-lossy':
+        # Lossless up to the color of fully transparent pixels
+        np.testing.assert_array_equal(rgba[..., 3], expected[..., 3])
+        visible = expected[..., 3] > 0
+        np.testing.assert_array_equal(rgba[visible], expected[visible])
+
+
+def test_encode_rejects_unknown_formats():
+    with pytest.raises(ValueError):
+        encode(Image.new('P', (1, 1)), 'gif')
@@ -0,0 +1,120 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test')
+
+import server
+from imagery_service import image_payload, overlay_version
+
+FIELD = {'id': 'field-1', 'user_id': 'user-1', 'imagery_url': 'https://example.com/scene.tif',
+         'coordinates': [{'lat': 50.0, 'lng': 10.0}, {'lat': 50.0, 'lng': 10.1}, {'lat': 49.9, 'lng': 10.1}]}
+USER = {'id': 'user-1'}
+PAYLOAD = image_payload(b'overlay', 'png')
+
+
+def make_request(**headers) -> Request:
+    return Request({
+        'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'',
+        'headers': [(name.replace('_', '-').encode(), value.encode()) for name, value in headers.items()]
+    })
+
+
+@pytest.fixture
+def fields(monkeypatch):
+    async def find_one(query, projection=None):
+        return FIELD if query == {'id': FIELD['id'], 'user_id': USER['id']} else None
+
+    monkeypatch.setattr(server, 'db', SimpleNamespace(fields=SimpleNamespace(find_one=find_one)))
+
+
+def respond(request: Request, version=None, extension=None):
+    return asyncio.run(server.overlay_response(
+        FIELD['id'], 'ndvi', extension, None, request, None, version, USER
+    ))
+
+
+def test_etag_matches():
+    assert not server.etag_matches(None, '"a"')
+    assert server.etag_matches('"a"', '"a"')
+    assert server.etag_matches('"b", W/"a"', '"a"')
+    assert server.etag_matches('*', '"a"')
+    assert not server.etag_matches('"b"', '"a"')
+
+
+def test_overlay_response(fields, monkeypatch):
+    calls = []
+
+    async def fetch_overlay(*args):
+        calls.append(args)
+        return PAYLOAD
+
+    monkeypatch.setattr(server.imagery_service, 'fetch_overlay', fetch_overlay)
+    response = respond(make_request(accept='image/png'), version='abc')
+    assert response.status_code == 200 and response.body == b'overlay'
+    assert response.headers['etag'] == PAYLOAD['etag']
+    assert response.headers['vary'] == 'Accept'
+    assert calls[0][-2:] == ('png', 'abc')
+
+
+def test_matching_etag_is_not_modified(fields, monkeypatch):
+    async def fetch_overlay(*args):
+        return PAYLOAD
+
+    monkeypatch.setattr(server.imagery_service, 'fetch_overlay', fetch_overlay)
+    response = respond(make_request(if_none_match=PAYLOAD['etag']), extension='png')
+    assert response.status_code == 304 and response.body == b''
+    assert response.headers['etag'] == PAYLOAD['etag'] and 'vary' not in response.headers
+
+
+def test_missing_overlay_is_not_found(fields, monkeypatch):
+    async def fetch_overlay(*args):
+        return None
+
+    monkeypatch.setattr(server.imagery_service, 'fetch_overlay', fetch_overlay)
+    with pytest.raises(HTTPException) as error:
+        respond(make_request())
+    assert error.value.status_code == 404
+
+
+def expire_overlay(monkeypatch):
+    """Service whose overlay cache misses until the index is analyzed again"""
+    service = server.imagery_service
+    analyzed = []
+
+    def get_overlay(*args):
+        return PAYLOAD if analyzed else None
+
+    async def analyze_scene(field_id, file_path, coordinates, indices, colormap=None, progress=None):
+        analyzed.append((file_path, indices))
+        return {'status': 'success'}
+
+    monkeypatch.setattr(service, 'get_overlay', get_overlay)
+    monkeypatch.setattr(service, 'analyze_scene', analyze_scene)
+    monkeypatch.setattr(service.file_cache, 'lookup',
+                        lambda source: {'path': '/cache/scene.tif', 'digest': 'scene-digest'})
+    key = service.result_cache_key(FIELD['id'], 'scene-digest', FIELD['coordinates'], 'ndvi')
+    return service, analyzed, overlay_version(key)
+
+
+def test_expired_overlay_is_rendered_again(monkeypatch):
+    service, analyzed, version = expire_overlay(monkeypatch)
+    overlay = asyncio.run(service.fetch_overlay(
+        FIELD['id'], FIELD['imagery_url'], FIELD['coordinates'], 'ndvi', version=version
+    ))
+    assert overlay == PAYLOAD
+    assert analyzed == [('/cache/scene.tif', ('ndvi',))]
+
+
+def test_overlays_of_other_versions_are_not_rendered(monkeypatch):
+    service, analyzed, _ = expire_overlay(monkeypatch)
+    for version in (None, 'stale-version'):
+        assert asyncio.run(service.fetch_overlay(
+            FIELD['id'], FIELD['imagery_url'], FIELD['coordinates'], 'ndvi', version=version
+        )) is None
+    assert analyzed == []
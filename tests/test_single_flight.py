@@ -0,0 +1,74 @@
+import asyncio
+import os
+
+from single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_run():
+    calls = []
+
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            return 'result'
+
+        callers = [asyncio.ensure_future(flight.run('key', work)) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        release.set()
+        assert await asyncio.gather(*callers) == ['result'] * 5
+        # Finished work is forgotten, the next call runs again
+        assert await flight.run('key', work) == 'result'
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def test_waiting_leader_rechecks_for_a_shared_result(tmp_path):
+    # Two instances on one lock directory stand in for two worker processes
+    shared = {}
+    calls = []
+
+    async def scenario():
+        first = SingleFlight(str(tmp_path), poll_interval=0.01)
+        second = SingleFlight(str(tmp_path), poll_interval=0.01)
+        release = asyncio.Event()
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            shared['key'] = 'result'
+            return 'result'
+
+        async def recheck():
+            return shared.get('key')
+
+        leader = asyncio.ensure_future(first.run('key', work, recheck))
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(second.run('key', work, recheck))
+        await asyncio.sleep(0.05)
+        # The follower is still waiting for the lock
+        assert not follower.done()
+        release.set()
+        assert await leader == 'result'
+        assert await follower == 'result'
+
+    asyncio.run(scenario())
+    assert len(calls) == 1
+
+
+def test_lock_files_are_striped(tmp_path):
+    async def scenario():
+        flight = SingleFlight(str(tmp_path), lock_stripes=4)
+
+        async def work():
+            return 'result'
+
+        for i in range(50):
+            await flight.run(f"key{i}", work)
+
+    asyncio.run(scenario())
+    assert len(os.listdir(str(tmp_path))) <= 4